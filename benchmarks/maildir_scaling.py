@@ -0,0 +1,303 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Maildir queue scaling benchmark.
+
+Builds mail queues of increasing size and measures how expensive it is
+to list them and to claim messages from them, the two things the queue
+processor does on every pass.
+
+For each queue size and each listing strategy this reports:
+
+- the time until the first message path is available,
+- the time to list the whole queue,
+- the peak memory allocated while listing (as seen by ``tracemalloc``).
+
+Afterwards a sample of unclaimed messages is run through the claim protocol of
+``QueueProcessorThread._process_one_file`` (stat, utime, link, unlink)
+with a mailer that does nothing, to measure the per-message claim cost.
+
+The queue contains a realistic mix of entries: most messages are in
+``new``, some are in ``cur``, some are already claimed by another
+processor (``.sending-`` links) and some were rejected (``.rejected-``
+links).
+
+Example::
+
+    python benchmarks/maildir_scaling.py --sizes 10000 100000
+    python benchmarks/maildir_scaling.py --strategy maildir --strategy scandir
+
+Building a queue of a million messages needs a few GiB of free inodes
+and takes several minutes; use ``--directory`` to put it on the file
+system you want to measure and ``--keep`` to reuse it across runs.
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from zope.sendmail.maildir import Maildir
+from zope.sendmail.queue import QueueProcessorThread
+
+
+MESSAGE = (b'X-Zope-From: sender@example.com\n'
+           b'X-Zope-To: recipient@example.com\n'
+           b'From: sender@example.com\n'
+           b'To: recipient@example.com\n'
+           b'Subject: Benchmark message %d\n'
+           b'\n' + b'Lorem ipsum dolor sit amet.\n' * 40)
+
+
+def _skip(name):
+    return name.startswith('.')
+
+
+def scan_maildir(path):
+    """The strategy currently used by the queue processor."""
+    return iter(Maildir(path))
+
+
+def scan_listdir(path):
+    """``os.listdir`` followed by one ``stat`` per message."""
+    join = os.path.join
+    paths = []
+    for subdir in ('new', 'cur'):
+        directory = join(path, subdir)
+        paths.extend(join(directory, name)
+                     for name in os.listdir(directory) if not _skip(name))
+    decorated = [(os.stat(p).st_mtime, p) for p in paths]
+    decorated.sort()
+    return (p for _, p in decorated)
+
+
+def scan_scandir(path):
+    """``os.scandir``, reusing the directory entry for the ``stat``."""
+    decorated = []
+    for subdir in ('new', 'cur'):
+        with os.scandir(os.path.join(path, subdir)) as entries:
+            for entry in entries:
+                if not _skip(entry.name):
+                    decorated.append((entry.stat().st_mtime, entry.path))
+    decorated.sort()
+    return (p for _, p in decorated)
+
+
+def scan_unsorted(path):
+    """Lazy, unordered listing; a lower bound for any strategy."""
+    for subdir in ('new', 'cur'):
+        with os.scandir(os.path.join(path, subdir)) as entries:
+            for entry in entries:
+                if not _skip(entry.name):
+                    yield entry.path
+
+
+STRATEGIES = {
+    'maildir': scan_maildir,
+    'listdir': scan_listdir,
+    'scandir': scan_scandir,
+    'unsorted': scan_unsorted,
+}
+
+
+def populate(path, size, cur_ratio, claimed_ratio, rejected_ratio, seed=0):
+    """Create a maildir at `path` holding `size` messages."""
+    rnd = random.Random(seed)
+    Maildir(path, True)
+    now = time.time()
+    for i in range(size):
+        subdir = 'cur' if rnd.random() < cur_ratio else 'new'
+        directory = os.path.join(path, subdir)
+        name = '%d.%d.benchmark.%d' % (now, i, rnd.randrange(0x7fffffff))
+        filename = os.path.join(directory, name)
+        fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+        try:
+            os.write(fd, MESSAGE % i)
+        finally:
+            os.close(fd)
+        # spread the mtimes over a day so that sorting has work to do
+        mtime = now - rnd.uniform(0, 86400)
+        os.utime(filename, (mtime, mtime))
+        r = rnd.random()
+        if r < claimed_ratio:
+            os.link(filename, os.path.join(directory, '.sending-' + name))
+        elif r < claimed_ratio + rejected_ratio:
+            os.link(filename, os.path.join(directory, '.rejected-' + name))
+            os.unlink(filename)
+        if i and not i % 100000:
+            print('  ... %d messages written' % i, file=sys.stderr)
+
+
+def measure_scan(strategy, path):
+    """Return (first, total, count, peak bytes) for one listing."""
+    start = time.perf_counter()
+    it = strategy(path)
+    first = None
+    count = 0
+    for _ in it:
+        if first is None:
+            first = time.perf_counter() - start
+        count += 1
+    total = time.perf_counter() - start
+
+    tracemalloc.start()
+    try:
+        for _ in strategy(path):
+            pass
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return first or 0.0, total, count, peak
+
+
+class _NullMailer:
+
+    def send(self, fromaddr, toaddrs, message):
+        pass
+
+
+class _QuietProcessor(QueueProcessorThread):
+
+    class log:
+        @staticmethod
+        def info(*args, **kw):
+            pass
+
+        @staticmethod
+        def error(*args, **kw):
+            pass
+
+
+def measure_claims(path, count):
+    """Run `count` messages through the claim protocol.
+
+    The messages are really "sent" to a mailer that does nothing, so they
+    are removed from the queue afterwards.  Messages that `populate`
+    claimed for another processor would only be skipped, so they are
+    left out and their number is returned separately.
+
+    Returns (messages measured, elapsed seconds, messages left out).
+    """
+    processor = _QuietProcessor()
+    processor.setMailer(_NullMailer())
+    processor.setMaildir(Maildir(path))
+    filenames = []
+    skipped = 0
+    for filename in scan_unsorted(path):
+        if len(filenames) >= count:
+            break
+        head, tail = os.path.split(filename)
+        if os.path.exists(os.path.join(head, '.sending-' + tail)):
+            skipped += 1
+        else:
+            filenames.append(filename)
+    start = time.perf_counter()
+    for filename in filenames:
+        processor._process_one_file(filename)
+    elapsed = time.perf_counter() - start
+    return len(filenames), elapsed, skipped
+
+
+def _fmt_time(seconds):
+    if seconds < 1:
+        return '%8.2f ms' % (seconds * 1000)
+    return '%8.2f s ' % seconds
+
+
+def _fmt_bytes(n):
+    return '%8.1f MiB' % (n / 1024.0 / 1024.0)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Measure maildir scan and claim cost at scale.')
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+        help='Queue sizes to measure. Default is %(default)s.')
+    parser.add_argument(
+        '--strategy', action='append', choices=sorted(STRATEGIES),
+        help='Listing strategy to measure; can be repeated. '
+             'Default is all of them.')
+    parser.add_argument(
+        '--cur-ratio', type=float, default=0.1,
+        help='Share of messages placed in cur. Default is %(default)s.')
+    parser.add_argument(
+        '--claimed-ratio', type=float, default=0.05,
+        help='Share of messages with a .sending- claim. '
+             'Default is %(default)s.')
+    parser.add_argument(
+        '--rejected-ratio', type=float, default=0.05,
+        help='Share of messages that were rejected. Default is %(default)s.')
+    parser.add_argument(
+        '--claims', type=int, default=1000,
+        help='Number of messages to run through the claim protocol. '
+             'Default is %(default)s.')
+    parser.add_argument(
+        '--directory',
+        help='Where to build the queues. Default is a temporary directory.')
+    parser.add_argument(
+        '--keep', action='store_true',
+        help='Keep (and reuse) the queues instead of deleting them.')
+    opts = parser.parse_args(argv)
+
+    strategies = opts.strategy or sorted(STRATEGIES)
+    base = opts.directory or tempfile.mkdtemp(prefix='maildir-bench-')
+    try:
+        for size in opts.sizes:
+            path = os.path.join(base, 'queue-%d' % size)
+            if not os.path.exists(path):
+                print('Building queue of %d messages in %s'
+                      % (size, path), file=sys.stderr)
+                populate(path, size, opts.cur_ratio, opts.claimed_ratio,
+                         opts.rejected_ratio)
+            print()
+            print('Queue of %d messages' % size)
+            print('%-10s %11s %11s %9s %12s'
+                  % ('strategy', 'first', 'full scan', 'listed', 'peak mem'))
+            for name in strategies:
+                first, total, count, peak = measure_scan(
+                    STRATEGIES[name], path)
+                print('%-10s %s %s %9d %s'
+                      % (name, _fmt_time(first), _fmt_time(total), count,
+                         _fmt_bytes(peak)))
+            if opts.claims:
+                if opts.keep:
+                    # claiming consumes messages; work on a copy
+                    claim_path = path + '-claims'
+                    shutil.rmtree(claim_path, True)
+                    shutil.copytree(path, claim_path)
+                else:
+                    claim_path = path
+                claimed, elapsed, skipped = measure_claims(
+                    claim_path, opts.claims)
+                if claimed:
+                    print('claim+send of %d messages: %s (%.1f us each)'
+                          % (claimed, _fmt_time(elapsed).strip(),
+                             elapsed / claimed * 1e6))
+                if skipped:
+                    print('%d messages already claimed, not measured'
+                          % skipped)
+                if opts.keep:
+                    shutil.rmtree(claim_path, True)
+            if not opts.keep:
+                shutil.rmtree(path, True)
+    finally:
+        if not opts.keep and not opts.directory:
+            shutil.rmtree(base, True)
+
+
+if __name__ == '__main__':
+    main()
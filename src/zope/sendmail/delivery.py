@@ -17,6 +17,7 @@ This module contains various implementations of `MailDeliverys`.
 """
 __docformat__ = 'restructuredtext'
 
+import datetime
 import email.parser
 import logging
 import os
@@ -24,12 +25,14 @@ import warnings
 from random import randrange
 from socket import gethostname
 from time import strftime
+from time import time
 
 import transaction
 from transaction.interfaces import IDataManagerSavepoint
 from transaction.interfaces import ISavepointDataManager
 from zope.interface import implementer
 
+from zope.sendmail import digest as _digest
 from zope.sendmail.interfaces import IDirectMailDelivery
 from zope.sendmail.interfaces import IQueuedMailDelivery
 from zope.sendmail.maildir import Maildir
@@ -116,7 +119,7 @@ class AbstractMailDelivery:
                                   randrange(0, randmax))
         return f"{left_part}@{gethostname()}"
 
-    def send(self, fromaddr, toaddrs, message):
+    def send(self, fromaddr, toaddrs, message, **options):
         # Switch the message to be bytes immediately, any encoding
         # peculiarities should be handled before.
         if message is None:
@@ -142,10 +145,10 @@ class AbstractMailDelivery:
             message = b'Message-Id: <%s>%s%s' % (
                 messageid.encode(), line_sep, message)
         transaction.get().join(
-            self.createDataManager(fromaddr, toaddrs, message))
+            self.createDataManager(fromaddr, toaddrs, message, **options))
         return messageid
 
-    def createDataManager(self, fromaddr, toaddrs, message):
+    def createDataManager(self, fromaddr, toaddrs, message, **options):
         raise NotImplementedError()
 
 
@@ -177,16 +180,86 @@ class DirectMailDelivery(AbstractMailDelivery):
 class QueuedMailDelivery(AbstractMailDelivery):
     __doc__ = IQueuedMailDelivery.__doc__
 
-    def __init__(self, queuePath):
+    def __init__(self, queuePath, ttl=None, quota=None, digest_window=None):
         self._queuePath = queuePath
+        self.ttl = ttl
+        self.quota = quota
+        self.digest_window = digest_window
 
     queuePath = property(lambda self: self._queuePath)
 
-    def createDataManager(self, fromaddr, toaddrs, message):
+    def send(self, fromaddr, toaddrs, message, priority=0, send_after=None,
+             ttl=None, route=None, tenant=None, digest=None):
+        if route is not None and ('\n' in route or '\r' in route):
+            raise ValueError('Malformed route')
+        if tenant is not None and ('\n' in tenant or '\r' in tenant):
+            raise ValueError('Malformed tenant')
+        if digest is not None and ('\n' in digest or '\r' in digest):
+            raise ValueError('Malformed digest')
+        return super().send(fromaddr, toaddrs, message, priority=priority,
+                            send_after=send_after, ttl=ttl, route=route,
+                            tenant=tenant, digest=digest)
+
+    def createDataManager(self, fromaddr, toaddrs, message, priority=0,
+                          send_after=None, ttl=None, route=None,
+                          tenant=None, digest=None):
+        now = time()
+        if isinstance(send_after, datetime.datetime):
+            send_after = send_after.timestamp()
+        if send_after is not None and send_after <= now:
+            send_after = None
+        if digest and send_after is None and self.digest_window:
+            # held back until the digest is sent
+            send_after = _digest.due(
+                self.queuePath, (digest, fromaddr, tuple(toaddrs)),
+                self.digest_window, now)
+        if ttl is None:
+            ttl = self.ttl
+        envelope = [b'X-Zope-From: %s\n' % fromaddr.encode(),
+                    b'X-Zope-To: %s\n' % ", ".join(toaddrs).encode()]
+        if ttl is not None:
+            # the lifetime starts when the message may first be sent
+            expires = (now if send_after is None else send_after) + ttl
+            envelope.append(b'X-Zope-Expires: %d\n' % expires)
+        if route is not None:
+            envelope.append(b'X-Zope-Route: %s\n' % route.encode())
+        if tenant is not None:
+            envelope.append(b'X-Zope-Tenant: %s\n' % tenant.encode())
+        if digest:
+            envelope.append(b'X-Zope-Digest: %s\n' % digest.encode())
+        envelope = b''.join(envelope)
+        if self.quota is None:
+            msg = self._write(priority, send_after, envelope, message)
+            return MailDataManager(msg.commit, onAbort=msg.abort)
+
+        # raises QueueFullError while the transaction can still be aborted
+        group = tenant or fromaddr
+        size = len(envelope) + len(message)
+        self.quota.reserve(self.queuePath, group, size)
+        try:
+            msg = self._write(priority, send_after, envelope, message)
+        except BaseException:
+            self.quota.release(self.queuePath, group, size)
+            raise
+
+        def commit():
+            try:
+                msg.commit()
+            except BaseException:
+                self.quota.release(self.queuePath, group, size)
+                raise
+            self.quota.commit(self.queuePath, group, size)
+
+        def abort():
+            msg.abort()
+            self.quota.release(self.queuePath, group, size)
+
+        return MailDataManager(commit, onAbort=abort)
+
+    def _write(self, priority, send_after, envelope, message):
         maildir = Maildir(self.queuePath, True)
-        msg = maildir.newMessage()
-        msg.write(b'X-Zope-From: %s\n' % fromaddr.encode())
-        msg.write(b'X-Zope-To: %s\n' % ", ".join(toaddrs).encode())
+        msg = maildir.newMessage(priority, send_after)
+        msg.write(envelope)
         msg.write(message)
         msg.close()
-        return MailDataManager(msg.commit, onAbort=msg.abort)
+        return msg
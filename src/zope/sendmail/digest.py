@@ -0,0 +1,82 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Digests of notifications.
+
+Messages queued with a digest key are held back for the ``digest_window``
+of the delivery, counted from the first message of the digest.  They are
+then released into the queue together, and the queue processor sends the
+messages with the same key, sender and recipients as one message, put
+together by a combiner such as `combine`.
+"""
+__docformat__ = 'restructuredtext'
+
+import email
+import os
+import threading
+from email.mime.message import MIMEMessage
+from email.mime.multipart import MIMEMultipart
+from email.utils import formatdate
+from email.utils import make_msgid
+
+
+_dues = {}
+_dues_lock = threading.Lock()
+
+
+def due(path, key, window, now):
+    """Returns the time the messages of the digest `key` queued in `path`
+    are sent.
+
+    The first message of a digest opens it for `window` seconds, the
+    messages queued until then are sent with it.  Only the messages
+    queued by this process are known.
+    """
+    key = (os.path.realpath(path),) + tuple(key)
+    with _dues_lock:
+        result = _dues.get(key)
+        if result is None or result <= now:
+            # forget the digests that are closed
+            for other, other_due in list(_dues.items()):
+                if other_due <= now:
+                    del _dues[other]
+            result = _dues[key] = now + window
+        return result
+
+
+def combine(fromaddr, toaddrs, messages):
+    """Put `messages` together into a MIME digest.
+
+    This is the default combiner of the queue processor.  Combiners are
+    called with the envelope sender and recipients and the messages (as
+    bytes, in the order they were queued), and return the message to send
+    instead.
+
+    The digest has the ``From`` and ``To`` headers of the first message
+    and its ``Subject`` with the number of messages; the messages are its
+    parts.
+    """
+    parsed = [email.message_from_bytes(message) for message in messages]
+    first = parsed[0]
+    digest = MIMEMultipart('digest')
+    for name in ('From', 'To', 'Reply-To'):
+        if first[name] is not None:
+            digest[name] = first[name]
+    subject = first['Subject']
+    digest['Subject'] = ('%s (%d messages)' % (subject, len(parsed))
+                         if subject else '%d messages' % len(parsed))
+    digest['Date'] = formatdate(localtime=True)
+    digest['Message-Id'] = make_msgid()
+    for message in parsed:
+        digest.attach(MIMEMessage(message))
+    return digest.as_bytes()
@@ -52,6 +52,7 @@ from zope.i18nmessageid import MessageFactory
 from zope.interface import Attribute
 from zope.interface import Interface
 from zope.schema import Bool
+from zope.schema import Float
 from zope.schema import Int
 from zope.schema import Password
 from zope.schema import TextLine
@@ -105,6 +106,121 @@ class IQueuedMailDelivery(IMailDelivery):
         title=_("Queue path"),
         description=_("Pathname of the directory used to queue mail."))
 
+    ttl = Int(
+        title=_("Time to live"),
+        description=_("Default number of seconds after which a queued"
+                      " message is no longer sent."),
+        required=False)
+
+    quota = Attribute("An IQueueQuota for the queue, or None")
+
+    digest_window = Float(
+        title=_("Digest window"),
+        description=_("The number of seconds messages queued with a"
+                      " digest key are held back, counted from the first"
+                      " message of the digest."),
+        required=False)
+
+    def send(fromaddr, toaddrs, message, priority=0, send_after=None,
+             ttl=None, route=None, tenant=None, digest=None):
+        """Queue an email message.
+
+        This works like `IMailDelivery.send`, but accepts the following
+        additional options:
+
+        `priority` is an integer; messages with a higher priority are
+        sent before messages with a lower one.  The default is ``0``.
+
+        `send_after` is the time before which the message must not be sent,
+        either a `datetime.datetime` (naive ones are in local time) or
+        seconds since the epoch.  The default is to send it right away.
+
+        `ttl` is the number of seconds (counted from `send_after`, if given)
+        after which the message is no longer worth sending; the queue
+        processor then puts it aside without sending it.  The default is
+        the ``ttl`` of the delivery utility.
+
+        `route` is a routing key for an `IRoutingMailer` used by the queue
+        processor.
+
+        `tenant` is the key a queue processor with fair scheduling groups
+        the message by; by default messages are grouped by `fromaddr`.
+
+        `digest` is a key for notifications that may be sent together.
+        Unless `send_after` is given, the message is held back for the
+        `digest_window` of the delivery, and the queue processor sends
+        the messages with the same digest key, `fromaddr` and `toaddrs`
+        as one message, see `zope.sendmail.digest`.
+
+        If the message does not fit into the `quota` of the queue,
+        `zope.sendmail.quota.QueueFullError` is raised, before the
+        transaction is committed.
+        """
+
+
+class IQueueQuota(Interface):
+    """Limits for the messages in a mail queue.
+
+    Messages are counted by group: their tenant, or their sender if they
+    were queued without one.
+    """
+
+    max_messages = Int(
+        title=_("Maximum messages"),
+        description=_("The number of messages the queue may hold."),
+        required=False)
+
+    max_bytes = Int(
+        title=_("Maximum bytes"),
+        description=_("The size of the messages the queue may hold."),
+        required=False)
+
+    max_tenant_messages = Int(
+        title=_("Maximum messages per tenant"),
+        description=_("The number of messages of one tenant (or sender)"
+                      " the queue may hold."),
+        required=False)
+
+    max_tenant_bytes = Int(
+        title=_("Maximum bytes per tenant"),
+        description=_("The size of the messages of one tenant (or sender)"
+                      " the queue may hold."),
+        required=False)
+
+    min_free_bytes = Int(
+        title=_("Minimum free bytes"),
+        description=_("The disk space that must be left free when a"
+                      " message was queued."),
+        required=False)
+
+    timeout = Float(
+        title=_("Timeout"),
+        description=_("Seconds to wait for space in the queue before"
+                      " giving up; by default a full queue is reported"
+                      " right away."),
+        required=False)
+
+    def prepare(path):
+        """Start counting the usage of the queue in `path` in the
+        background, so that the first message does not wait for it.
+        """
+
+    def reserve(path, group, size):
+        """Make room for a message of `group` with `size` bytes in the queue
+        in `path`.
+
+        Raises `zope.sendmail.quota.QueueFullError` if the message does not
+        fit, after waiting for up to `timeout` seconds.  Without a
+        `timeout`, it waits for the queue to be counted if necessary.
+        """
+
+    def commit(path, group, size):
+        """Note that the message room was reserved for is in the queue now.
+        """
+
+    def release(path, group, size):
+        """Give back the room of a message that was not queued after all."""
+
 
 class IMailQueueProcessor(Interface):
     """A mail queue processor that delivers queueud messages asynchronously.
@@ -138,6 +254,14 @@ class IMailer(Interface):
         headers.
 
         Messages are sent immediately.
+
+        Mailers that can tell return a dict of the recipients that did not
+        get the message, mapping them to the ``(code, reply)`` of the
+        server, like ``smtplib.SMTP.sendmail`` does.  If none of them got
+        the message, ``smtplib.SMTPRecipientsRefused`` with that dict is
+        raised.  The queue processor keeps the message queued for the
+        recipients refused with a 4xx reply and sets it aside for the
+        others.
         """
 
     def abort():
@@ -183,6 +307,376 @@ class ISMTPMailer(IMailer):
             "known as SMTPS and commonly used on TCP port 465. "
             "force_tls and no_tls are ignored if this is set."),)
 
+    pool_size = Int(
+        title=_("Connection pool size"),
+        description=_(
+            "Keep up to this many connections to the SMTP server open and "
+            "reuse them for later messages.  No more connections than this "
+            "are opened at the same time.  Connections are not pooled if "
+            "this is not set."),
+        required=False)
+
+    pool_idle_timeout = Float(
+        title=_("Connection pool idle timeout"),
+        description=_(
+            "Close pooled connections that were not used for this many "
+            "seconds."),
+        required=False)
+
+    pool_max_messages = Int(
+        title=_("Messages per pooled connection"),
+        description=_(
+            "Close pooled connections after sending this many messages."),
+        required=False)
+
+    pool_timeout = Float(
+        title=_("Connection pool timeout"),
+        description=_(
+            "How many seconds to wait for a pooled connection when all of "
+            "them are in use before giving up with "
+            "`zope.sendmail.mailer.PoolTimeoutError`.  By default it waits "
+            "as long as it takes."),
+        required=False)
+
+    connect_timeout = Float(
+        title=_("Connect timeout"),
+        description=_(
+            "How many seconds to wait for the connection to the SMTP "
+            "server."),
+        required=False)
+
+    command_timeout = Float(
+        title=_("Command timeout"),
+        description=_(
+            "How many seconds to wait for the SMTP server to answer a "
+            "command."),
+        required=False)
+
+    send_timeout = Float(
+        title=_("Send timeout"),
+        description=_(
+            "How many seconds sending a single message may take in total. "
+            "A send that takes longer fails with a TimeoutError."),
+        required=False)
+
+    ssl_context = Attribute(
+        "The ssl.SSLContext used for STARTTLS and implicit TLS. It is shared "
+        "by all connections, and the TLS session of the last connection is "
+        "resumed by the next one.")
+
+    tls_ca_file = TextLine(
+        title=_("CA file"),
+        description=_(
+            "File with the certificates of the authorities trusted to sign "
+            "the certificate of the SMTP server."),
+        required=False)
+
+    tls_verify = Bool(
+        title=_("Verify TLS"),
+        description=_(
+            "Check the certificate and host name of the SMTP server."),
+        required=False)
+
+    tls_minimum_version = TextLine(
+        title=_("Minimum TLS version"),
+        description=_(
+            "The oldest TLS version to accept, as the name of a member of "
+            "ssl.TLSVersion, e.g. TLSv1_2."),
+        required=False)
+
+    dns_cache_ttl = Float(
+        title=_("DNS cache TTL"),
+        description=_(
+            "Remember the addresses of the SMTP server for this many "
+            "seconds, connect to them in turn and try the next one when a "
+            "connection fails.  By default the host name is resolved for "
+            "every connection."),
+        required=False)
+
+    max_recipients = Int(
+        title=_("Maximum recipients"),
+        description=_(
+            "Send a message to at most this many recipients per SMTP "
+            "transaction, in as many transactions over the same connection "
+            "as needed.  The recipients of the transactions that fail are "
+            "refused with the reply of the server.  Unlimited by default."),
+        required=False,
+        min=1)
+
+
+class ILMTPMailer(IMailer):
+    """A mailer that hands mail to a local MTA over a UNIX domain socket.
+
+    It speaks LMTP, or SMTP if `lmtp` is false, and keeps its sessions open
+    for later messages.  As with LMTP the server accepts or refuses the
+    message for every recipient separately, ``send`` returns the refused
+    recipients like ``smtplib.SMTP.sendmail`` does, and only fails if none
+    of them got the message.
+    """
+
+    path = TextLine(
+        title=_("Socket path"),
+        description=_("Path of the UNIX domain socket of the MTA."))
+
+    lmtp = Bool(
+        title=_("LMTP"),
+        description=_("Speak LMTP instead of SMTP."),
+        default=True)
+
+    username = TextLine(
+        title=_("Username"),
+        description=_("Username used for optional authentication."))
+
+    password = Password(
+        title=_("Password"),
+        description=_("Password used for optional authentication."))
+
+    pool_size = Int(
+        title=_("Sessions"),
+        description=_(
+            "How many sessions with the MTA to keep open at most."),
+        default=1)
+
+    pool_timeout = Float(
+        title=_("Session timeout"),
+        description=_(
+            "How many seconds to wait for a session when all of them are "
+            "in use, see `ISMTPMailer.pool_timeout`."),
+        required=False)
+
+    command_timeout = Float(
+        title=_("Command timeout"),
+        description=_(
+            "How many seconds to wait for the MTA to answer a command."),
+        required=False)
+
+    send_timeout = Float(
+        title=_("Send timeout"),
+        description=_(
+            "How many seconds handing over a single message may take."),
+        required=False)
+
+
+class ISendmailMailer(IMailer):
+    """A mailer that talks SMTP to a long running ``sendmail -bs`` process.
+
+    The process is started when the first message is sent, used for the
+    following ones and restarted when it fails.
+    """
+
+    command = TextLine(
+        title=_("Command"),
+        description=_(
+            "Path of the sendmail program, or a sequence of the program "
+            "and its arguments.  ``-bs`` is added to them."),
+        default='/usr/sbin/sendmail')
+
+    pool_size = Int(
+        title=_("Processes"),
+        description=_("How many sendmail processes to run at most."),
+        default=1)
+
+    pool_max_messages = Int(
+        title=_("Messages per process"),
+        description=_(
+            "Start a new process after this many messages."),
+        required=False)
+
+    pool_timeout = Float(
+        title=_("Process timeout"),
+        description=_(
+            "How many seconds to wait for a process when all of them are "
+            "in use, see `ISMTPMailer.pool_timeout`."),
+        required=False)
+
+    send_timeout = Float(
+        title=_("Send timeout"),
+        description=_(
+            "How many seconds handing over a single message may take. "
+            "The process is killed if it takes longer."),
+        required=False)
+
+
+class IBatchMailer(IMailer):
+    """A mailer that can deliver several messages at once more cheaply."""
+
+    batch_size = Int(
+        title=_("Batch size"),
+        description=_(
+            "How many messages to pass to ``sendMany`` at most."),
+        default=100)
+
+    def sendMany(messages):
+        """Send several messages.
+
+        `messages` is a sequence of ``(fromaddr, toaddrs, message)``
+        tuples, as taken by ``send``.
+
+        Returns a list with one item per message, ``None`` if it was
+        sent or the exception that ``send`` would have raised.  An
+        exception raised by this method concerns all the messages.
+        """
+
+
+class IPickupDirectoryMailer(IBatchMailer):
+    """A mailer that drops messages into the pickup directory of an MTA.
+
+    Every message is written to a hidden file in the directory and renamed
+    when it is complete, so the MTA never sees a partial message.
+    """
+
+    path = TextLine(
+        title=_("Path"),
+        description=_("The pickup directory."))
+
+    envelope = TextLine(
+        title=_("Envelope format"),
+        description=_(
+            "How the sender and the recipients are written before the "
+            "message: 'none' (the MTA reads the headers), 'x-sender' "
+            "(X-Sender and X-Receiver lines, for IIS and Exchange) or "
+            "'zope' (X-Zope-From and X-Zope-To lines, like in the mail "
+            "queue)."),
+        default='none')
+
+    fsync = Bool(
+        title=_("Fsync"),
+        description=_(
+            "Make the messages durable before returning.  ``sendMany`` "
+            "syncs the directory only once for all messages."),
+        default=True)
+
+
+class IHTTPMailer(IBatchMailer):
+    """A mailer that submits messages to the HTTP API of a mail service.
+
+    Every message is posted to `url` as a JSON object with the keys
+    ``from``, ``to`` and ``raw`` (the base64 encoded message).  If
+    `batch_url` is set, ``sendMany`` posts a JSON object with the key
+    ``messages``, holding a list of such objects, in a single request.
+
+    Connections are kept open between requests.  An error status is
+    raised as :class:`zope.sendmail.mailer.HTTPMailerError`, which the
+    queue processor handles like an SMTP reply: server errors, time outs
+    and rate limits (429) are temporary, failed authentication or lookup
+    (401, 403 and 404, which are caused by the configuration) make the
+    service unavailable, so that the circuit breaker pauses the delivery,
+    and other error statuses are permanent.
+    """
+
+    url = TextLine(
+        title=_("URL"),
+        description=_("The URL to post single messages to."))
+
+    batch_url = TextLine(
+        title=_("Batch URL"),
+        description=_(
+            "The URL to post several messages to at once.  If it is not "
+            "set, ``sendMany`` posts the messages one by one."),
+        required=False)
+
+    api_key = Password(
+        title=_("API key"),
+        description=_("Sent as bearer token in the Authorization header."),
+        required=False)
+
+    timeout = Float(
+        title=_("Timeout"),
+        description=_(
+            "How many seconds to wait for connecting and for the service "
+            "to answer."),
+        required=False)
+
+    pool_size = Int(
+        title=_("Idle connections"),
+        description=_("How many idle connections to keep open at most."),
+        default=2)
+
+    pool_idle_timeout = Float(
+        title=_("Idle timeout"),
+        description=_(
+            "Close connections that were not used for this many seconds."),
+        required=False)
+
+
+class IBalancingMailer(IMailer):
+    """A mailer that spreads the messages over several other mailers.
+
+    The mailers are used in turn, according to their weights, or the one
+    with the fewest sends in progress relative to its weight is used.  If
+    a mailer fails, the message is sent with the next one.  Permanent
+    errors (5xx replies and refused recipients) concern the message and
+    are raised at once.
+
+    A mailer that failed or was slow `max_failures` times in a row is
+    taken out of rotation for `retry_after` seconds.  Then a single
+    message probes it, and it is put back if that message is sent.
+    """
+
+    mailers = Attribute("The sequence of IMailers to use.")
+
+    weights = Attribute(
+        "The positive integer weights of the mailers, one for each.")
+
+    strategy = TextLine(
+        title=_("Strategy"),
+        description=_(
+            "How to choose a mailer: 'round-robin' or "
+            "'least-outstanding'."),
+        default='round-robin')
+
+    max_failures = Int(
+        title=_("Maximum failures"),
+        description=_(
+            "Take a mailer out of rotation after this many consecutive "
+            "failures."),
+        default=3)
+
+    slow_threshold = Float(
+        title=_("Slow threshold"),
+        description=_(
+            "Count a send taking longer than this many seconds as a "
+            "failure."),
+        required=False)
+
+    retry_after = Float(
+        title=_("Retry after"),
+        description=_(
+            "How many seconds a mailer stays out of rotation before it is "
+            "probed again."),
+        default=30.0)
+
+
+class IRoutingMailer(IMailer):
+    """A mailer that hands every message to the mailer of its route.
+
+    The routes are tried in order for every recipient; the first matching
+    route gives the name of the `IMailer` utility that sends the message
+    to that recipient.  A message for recipients with different routes is
+    split into one message per mailer.
+    """
+
+    routes = Attribute(
+        "The sequence of `zope.sendmail.mailer.Route` objects to try.")
+
+    default = TextLine(
+        title=_("Default mailer"),
+        description=_(
+            "Name of the mailer for recipients that match no route."),
+        required=False)
+
+    def send(fromaddr, toaddrs, message, route=None):
+        """Send an email message.
+
+        `route` is the routing key given when the message was queued, if
+        any.
+
+        If the message could not be sent to some of the recipients, a
+        dictionary of them, mapped to the SMTP code and the error message,
+        is returned like ``smtplib.SMTP.sendmail`` does.  If it could not
+        be sent to any of them, the error is raised.
+        """
+
 
 class IMaildirFactory(Interface):
 
@@ -208,15 +702,77 @@ class IMaildir(Interface):
 
     def __iter__():
         """Returns an iterator over the pathnames of messages in this folder.
+
+        Messages with a higher priority come first; messages of the same
+        priority are ordered by modification time.
         """
 
-    def newMessage():
+    def priorities():
+        """Returns the priorities that have messages, highest first.
+
+        The default priority, ``0``, is always included.
+        """
+
+    def messages(min_priority=None):
+        """Returns an iterator over the pathnames of messages in this folder.
+
+        This is like iterating over the folder, but if `min_priority` is
+        not ``None``, only messages with at least that priority are
+        returned.
+        """
+
+    def scheduled():
+        """Returns the messages scheduled for later delivery.
+
+        The result is a list of ``(due, priority, pathname)`` tuples sorted
+        by the time (in seconds since the epoch) the messages are due.
+        Scheduled messages are not part of the iteration until they are
+        released with ``releaseScheduled``.
+        """
+
+    def version():
+        """Returns a value that changes whenever messages are added.
+
+        This only looks at the folders, so it is much cheaper than
+        listing the messages.
+        """
+
+    def scheduledVersion():
+        """Returns a value that changes whenever the scheduled messages
+        change, or ``None`` if no message was ever scheduled.
+
+        This is cheaper than calling ``scheduled()`` to find out whether
+        anything changed.
+        """
+
+    def releaseScheduled(pathname):
+        """Moves a scheduled message into the folder for its priority.
+
+        Returns ``False`` if the message no longer exists because it was
+        released by someone else.
+        """
+
+    def defer(pathname, send_after):
+        """Moves a queued message back to the scheduled messages, to be
+        sent after `send_after` (in seconds since the epoch).
+
+        Returns the new pathname of the message.
+        """
+
+    def newMessage(priority=0, send_after=None):
         """Creates a new message in the `maildir`.
 
         Returns a file-like object for a new file in the ``tmp`` subdirectory
         of the `Maildir`.  After writing message contents to it, call the
         ``commit()`` or ``abort()`` method on it.
 
+        Messages with a `priority` other than ``0`` are stored in a
+        separate subfolder for that priority.
+
+        If `send_after` is not ``None``, it is the time (in seconds since the
+        epoch) before which the message must not be sent; the message is
+        then stored with the scheduled messages.
+
         The returned object implements `IMaildirMessageWriter`.
         """
 
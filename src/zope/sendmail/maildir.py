@@ -27,6 +27,17 @@ from zope.sendmail.interfaces import IMaildirFactory
 from zope.sendmail.interfaces import IMaildirMessageWriter
 
 
+# Messages with a priority other than the default one are kept in
+# Maildir++ style subfolders of the queue, one for each priority.
+PRIORITY_PREFIX = '.priority'
+
+# Messages that must not be sent before a given time are kept in this
+# subfolder until they are due.  Their file names start with the time they
+# are due and their priority, so that they can be indexed without reading
+# them.
+SCHEDULED_FOLDER = '.scheduled'
+
+
 @provider(IMaildirFactory)
 @implementer(IMaildir)
 class Maildir:
@@ -57,9 +68,41 @@ class Maildir:
 
     def __iter__(self):
         "See :class:`zope.sendmail.interfaces.IMaildir`"
+        return self.messages()
+
+    def _lanePath(self, priority):
+        if not priority:
+            return self.path
+        return os.path.join(self.path, PRIORITY_PREFIX + '%+d' % priority)
+
+    def priorities(self):
+        "See :class:`zope.sendmail.interfaces.IMaildir`"
+        priorities = {0}
+        for name in os.listdir(self.path):
+            if not name.startswith(PRIORITY_PREFIX):
+                continue
+            try:
+                priority = int(name[len(PRIORITY_PREFIX):])
+            except ValueError:
+                continue
+            if os.path.isdir(os.path.join(self.path, name, 'new')):
+                priorities.add(priority)
+        return sorted(priorities, reverse=True)
+
+    def messages(self, min_priority=None):
+        "See :class:`zope.sendmail.interfaces.IMaildir`"
+        for priority in self.priorities():
+            if min_priority is not None and priority < min_priority:
+                break
+            # A lane is only listed once the higher ones have been
+            # consumed, so the listing of lower lanes is as fresh as
+            # possible.
+            yield from self._laneMessages(self._lanePath(priority))
+
+    def _laneMessages(self, path):
         join = os.path.join
-        subdir_cur = join(self.path, 'cur')
-        subdir_new = join(self.path, 'new')
+        subdir_cur = join(path, 'cur')
+        subdir_new = join(path, 'new')
         # http://www.qmail.org/man/man5/maildir.html says:
         #     "It is a good idea for readers to skip all filenames in new
         #     and cur starting with a dot.  Other than this, readers
@@ -73,16 +116,108 @@ class Maildir:
         msgs_sorted = [(m, os.path.getmtime(m)) for m
                        in new_messages + cur_messages]
         msgs_sorted.sort(key=lambda x: x[1])
-        return iter([m[0] for m in msgs_sorted])
+        return [m[0] for m in msgs_sorted]
 
-    def newMessage(self):
+    def _makeFolder(self, path):
+        for subdir in ('cur', 'new', 'tmp'):
+            try:
+                os.makedirs(os.path.join(path, subdir))
+            except FileExistsError:
+                pass
+
+    def version(self):
+        "See :class:`zope.sendmail.interfaces.IMaildir`"
+        # New messages are renamed into a ``new`` folder, and new lanes are
+        # created in the queue folder, which changes their mtimes.
+        join = os.path.join
+        return tuple(
+            [os.stat(self.path).st_mtime_ns]
+            + [os.stat(join(self._lanePath(priority), 'new')).st_mtime_ns
+               for priority in self.priorities()])
+
+    def scheduledVersion(self):
+        "See :class:`zope.sendmail.interfaces.IMaildir`"
+        try:
+            return os.stat(os.path.join(
+                self.path, SCHEDULED_FOLDER, 'new')).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def scheduled(self):
+        "See :class:`zope.sendmail.interfaces.IMaildir`"
+        subdir_new = os.path.join(self.path, SCHEDULED_FOLDER, 'new')
+        try:
+            names = os.listdir(subdir_new)
+        except FileNotFoundError:
+            return []
+        result = []
+        for name in names:
+            if name.startswith('.'):
+                continue
+            try:
+                due, priority, _ = name.split('.', 2)
+                due, priority = int(due), int(priority)
+            except ValueError:
+                # not written by us, send it right away
+                due, priority = 0, 0
+            result.append((due, priority, os.path.join(subdir_new, name)))
+        result.sort()
+        return result
+
+    def releaseScheduled(self, filename):
+        "See :class:`zope.sendmail.interfaces.IMaildir`"
+        name = os.path.basename(filename)
+        try:
+            _, priority, unique = name.split('.', 2)
+            priority = int(priority)
+        except ValueError:
+            priority, unique = 0, name
+        path = self._lanePath(priority)
+        if path != self.path:
+            self._makeFolder(path)
+        try:
+            os.rename(filename, os.path.join(path, 'new', unique))
+        except FileNotFoundError:
+            # someone else released it
+            return False
+        return True
+
+    def defer(self, filename, send_after):
+        "See :class:`zope.sendmail.interfaces.IMaildir`"
+        lane = os.path.dirname(os.path.dirname(filename))
+        name = os.path.basename(lane)
+        priority = 0
+        if name.startswith(PRIORITY_PREFIX):
+            try:
+                priority = int(name[len(PRIORITY_PREFIX):])
+            except ValueError:
+                pass
+        path = os.path.join(self.path, SCHEDULED_FOLDER)
+        self._makeFolder(path)
+        # named like a new scheduled message, so that it is released into
+        # its lane under its old name
+        scheduled = os.path.join(path, 'new', '%d.%d.%s' % (
+            send_after, priority, os.path.basename(filename)))
+        os.rename(filename, scheduled)
+        return scheduled
+
+    def newMessage(self, priority=0, send_after=None):
         "See :class:`zope.sendmail.interfaces.IMaildir`"
         # NOTE: http://www.qmail.org/man/man5/maildir.html says, that the first
         #       step of the delivery process should be a chdir.  Chdirs and
         #       threading do not mix.  Is that chdir really necessary?
         join = os.path.join
-        subdir_tmp = join(self.path, 'tmp')
-        subdir_new = join(self.path, 'new')
+        priority = int(priority)
+        if send_after is not None:
+            path = join(self.path, SCHEDULED_FOLDER)
+            prefix = '%d.%d.' % (send_after, priority)
+        else:
+            path = self._lanePath(priority)
+            prefix = ''
+        if path != self.path:
+            self._makeFolder(path)
+        subdir_tmp = join(path, 'tmp')
+        subdir_new = join(path, 'new')
         pid = os.getpid()
         host = socket.gethostname()
         randmax = 0x7fffffff
@@ -109,7 +244,7 @@ class Maildir:
             else:
                 break
         return MaildirMessageWriter(os.fdopen(fd, 'wb'), filename,
-                                    join(subdir_new, unique))
+                                    join(subdir_new, prefix + unique))
 
 
 def _encode_utf8(s):
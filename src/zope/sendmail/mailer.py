@@ -15,13 +15,40 @@
 """
 __docformat__ = 'restructuredtext'
 
+import base64
+import errno
+import http.client
+import json
+import os
+import random
+import socket
+import ssl
+import subprocess
+import threading
+import time
+from email.utils import parseaddr
+from smtplib import LMTP
 from smtplib import SMTP
 from smtplib import SMTP_SSL
+from smtplib import SMTPConnectError
+from smtplib import SMTPDataError
+from smtplib import SMTPRecipientsRefused
+from smtplib import SMTPResponseException
+from smtplib import SMTPServerDisconnected
 from ssl import SSLError
 from threading import local
+from urllib.parse import urlsplit
 
+from zope.component import getUtility
 from zope.interface import implementer
 
+from zope.sendmail.interfaces import IBalancingMailer
+from zope.sendmail.interfaces import IHTTPMailer
+from zope.sendmail.interfaces import ILMTPMailer
+from zope.sendmail.interfaces import IMailer
+from zope.sendmail.interfaces import IPickupDirectoryMailer
+from zope.sendmail.interfaces import IRoutingMailer
+from zope.sendmail.interfaces import ISendmailMailer
 from zope.sendmail.interfaces import ISMTPMailer
 
 
@@ -29,6 +56,265 @@ class _SMTPState(local):
     connection = None
     code = None
     response = None
+    # whether the connection was checked out of the pool
+    pooled = False
+
+
+def _quit(connection):
+    try:
+        connection.quit()
+    except SSLError:
+        # something weird happened while quiting
+        connection.close()
+
+
+def _quit_quietly(connection):
+    try:
+        _quit(connection)
+    except Exception:
+        pass
+
+
+class _ResumingContext:
+    """Wraps an SSL context to resume the mailer's last TLS session.
+
+    smtplib only calls ``wrap_socket``, everything else is delegated to
+    the real context.
+    """
+
+    def __init__(self, context, mailer):
+        self._context = context
+        self._mailer = mailer
+
+    def __getattr__(self, name):
+        return getattr(self._context, name)
+
+    def wrap_socket(self, sock, *args, **kw):
+        session = self._mailer._tls_session
+        if session is not None and 'session' not in kw:
+            kw['session'] = session
+        return self._context.wrap_socket(sock, *args, **kw)
+
+
+def _make_ssl_context(ca_file=None, verify=False, minimum_version=None):
+    """Returns the client SSL context used by `SMTPMailer`.
+
+    Without `verify`, the certificate of the server is not checked, which
+    is what smtplib does by default.
+    """
+    if verify:
+        context = ssl.create_default_context(cafile=ca_file)
+    else:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        if ca_file:
+            context.load_verify_locations(cafile=ca_file)
+    if minimum_version:
+        if isinstance(minimum_version, str):
+            minimum_version = ssl.TLSVersion[minimum_version]
+        context.minimum_version = minimum_version
+    return context
+
+
+class AddressCache:
+    """Caches the addresses a host name resolves to for `ttl` seconds.
+
+    `resolver` is called like ``socket.getaddrinfo``.  Every call to
+    ``addresses`` starts with the next address, so connections are spread
+    over all of them.
+    """
+
+    def __init__(self, ttl, resolver=None):
+        self.ttl = ttl
+        self.resolver = resolver or socket.getaddrinfo
+        self._lock = threading.Lock()
+        # (host, port) -> (expires, addresses)
+        self._cache = {}
+        self._next = 0
+
+    def addresses(self, host, port):
+        """Returns all addresses of `host`, starting with the next one."""
+        now = time.monotonic()
+        with self._lock:
+            expires, addresses = self._cache.get((host, port), (0, None))
+            if expires <= now:
+                addresses = None
+        if addresses is None:
+            addresses = []
+            for info in self.resolver(host, port, 0, socket.SOCK_STREAM):
+                address = info[4][0]
+                if address not in addresses:
+                    addresses.append(address)
+            if not addresses:
+                raise OSError('No address found for %s' % host)
+            with self._lock:
+                self._cache[(host, port)] = (now + self.ttl, addresses)
+        with self._lock:
+            start = self._next % len(addresses)
+            self._next += 1
+        return addresses[start:] + addresses[:start]
+
+    def invalidate(self, host, port):
+        """Forgets the addresses of `host`."""
+        with self._lock:
+            self._cache.pop((host, port), None)
+
+
+class PoolTimeoutError(TimeoutError):
+    """No pooled connection became available in time."""
+
+
+class SMTPConnectionPool:
+    """A bounded, thread-safe pool of open SMTP connections.
+
+    `connect` is called without arguments to open a new connection that is
+    ready for sending.  No more than `size` connections are open at the same
+    time; when all of them are in use, ``checkout`` waits for one to be
+    returned, for up to `timeout` seconds if given.  Idle connections are
+    closed after `idle_timeout` seconds and connections are closed after
+    they were used for `max_messages` messages.  An idle connection is
+    checked with ``NOOP`` before it is reused.
+    """
+
+    def __init__(self, connect, size, idle_timeout=None, max_messages=None,
+                 timeout=None):
+        self._connect = connect
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        # (connection, last used) pairs, the most recently used last
+        self._idle = []
+        # number of messages sent over each open connection
+        self._messages = {}
+        # number of connections being opened
+        self._opening = 0
+
+    def _expire(self, now):
+        # must hold the lock; returns the connections to close
+        if self.idle_timeout is None:
+            return []
+        expired = [conn for conn, last_used in self._idle
+                   if now - last_used > self.idle_timeout]
+        if expired:
+            self._idle = [(conn, last_used)
+                          for conn, last_used in self._idle
+                          if now - last_used <= self.idle_timeout]
+            for conn in expired:
+                del self._messages[conn]
+            self._cond.notify_all()
+        return expired
+
+    def _healthy(self, connection):
+        try:
+            code, _ = connection.noop()
+        except Exception:
+            return False
+        return code == 250
+
+    def checkout(self):
+        """Returns an open connection, waiting for one if necessary.
+
+        Raises `PoolTimeoutError` if none was returned within `timeout`
+        seconds.
+        """
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+        while True:
+            connection = None
+            timed_out = False
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    expired = self._expire(now)
+                    if self._idle:
+                        connection = self._idle.pop()[0]
+                        break
+                    if len(self._messages) + self._opening < self.size:
+                        # reserve a slot for a new connection
+                        self._opening += 1
+                        break
+                    if deadline is None:
+                        self._cond.wait()
+                    elif now < deadline:
+                        self._cond.wait(deadline - now)
+                    else:
+                        timed_out = True
+                        break
+            for conn in expired:
+                _quit_quietly(conn)
+            if timed_out:
+                raise PoolTimeoutError(
+                    'No connection was available within %s seconds'
+                    % self.timeout)
+            if connection is None:
+                break
+            if self._healthy(connection):
+                return connection
+            self.discard(connection)
+
+        try:
+            connection = self._connect()
+        except BaseException:
+            with self._cond:
+                self._opening -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._opening -= 1
+            self._messages[connection] = 0
+        return connection
+
+    def checkin(self, connection, sent=True):
+        """Returns a connection to the pool.
+
+        `sent` tells whether a message was sent over the connection.
+        """
+        with self._cond:
+            if sent:
+                self._messages[connection] += 1
+            if (self.max_messages is not None
+                    and self._messages[connection] >= self.max_messages):
+                del self._messages[connection]
+                retire = True
+            else:
+                self._idle.append((connection, time.monotonic()))
+                retire = False
+            self._cond.notify()
+        if retire:
+            _quit_quietly(connection)
+
+    def discard(self, connection):
+        """Closes a connection that is broken or in an unknown state."""
+        with self._cond:
+            self._messages.pop(connection, None)
+            self._cond.notify()
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """Closes all idle connections."""
+        with self._cond:
+            idle = [conn for conn, _ in self._idle]
+            self._idle = []
+            for conn in idle:
+                del self._messages[conn]
+            self._cond.notify_all()
+        for conn in idle:
+            _quit_quietly(conn)
+
+
+class SendTimeoutError(TimeoutError):
+    """Sending a message did not finish in time.
+
+    The server may have got the message already, e.g. when the reply to
+    its data timed out, so it must not be sent again right away.
+    """
 
 
 @implementer(ISMTPMailer)
@@ -39,7 +325,12 @@ class SMTPMailer:
 
     def __init__(self, hostname='localhost', port=25,
                  username=None, password=None, no_tls=False, force_tls=False,
-                 implicit_tls=False):
+                 implicit_tls=False, pool_size=None, pool_idle_timeout=None,
+                 pool_max_messages=None, connect_timeout=None,
+                 command_timeout=None, send_timeout=None, ssl_context=None,
+                 tls_ca_file=None, tls_verify=False,
+                 tls_minimum_version=None, dns_cache_ttl=None,
+                 resolver=None, max_recipients=None, pool_timeout=None):
         self.hostname = hostname
         self.port = port
         self.username = username
@@ -47,11 +338,41 @@ class SMTPMailer:
         self.force_tls = force_tls
         self.no_tls = no_tls
         self.implicit_tls = implicit_tls
+        self.pool_size = pool_size
+        self.pool_idle_timeout = pool_idle_timeout
+        self.pool_max_messages = pool_max_messages
+        self.pool_timeout = pool_timeout
+        self.connect_timeout = connect_timeout
+        self.command_timeout = command_timeout
+        self.send_timeout = send_timeout
+        self.tls_ca_file = tls_ca_file
+        self.tls_verify = tls_verify
+        self.tls_minimum_version = tls_minimum_version
+        self.max_recipients = max_recipients
+        if ssl_context is None:
+            ssl_context = _make_ssl_context(
+                tls_ca_file, tls_verify, tls_minimum_version)
+        # one context for all connections, so that the TLS session of the
+        # last connection can be resumed by the next one
+        self.ssl_context = ssl_context
+        self._tls_context = _ResumingContext(ssl_context, self)
+        self._tls_session = None
         self._smtp = _SMTPState()
         # this is for backwards compatibility, in case someone has been
         # overrided this class with a custom `smtp` attribute.
         if self.smtp is None:
             self.smtp = SMTP_SSL if self.implicit_tls else SMTP
+        self.dns_cache_ttl = dns_cache_ttl
+        if dns_cache_ttl is not None:
+            self.address_cache = AddressCache(dns_cache_ttl, resolver)
+        else:
+            self.address_cache = None
+        if pool_size:
+            self.pool = SMTPConnectionPool(
+                self._connectPooled, pool_size, pool_idle_timeout,
+                pool_max_messages, pool_timeout)
+        else:
+            self.pool = None
 
     def _make_property(name):
         return property(lambda self: getattr(self._smtp, name),
@@ -60,34 +381,156 @@ class SMTPMailer:
     connection = _make_property('connection')
     code = _make_property('code')
     response = _make_property('response')
+    pooled = _make_property('pooled')
 
     del _make_property
 
-    def vote(self, fromaddr, toaddrs, message):
-        self.connection = self.smtp(self.hostname, str(self.port))
+    def _connectAddresses(self, **kw):
+        # Tries the cached addresses of the host in turn and returns a
+        # connection to the first one that answers.
+        port = int(self.port)
+        addresses = self.address_cache.addresses(self.hostname, port)
+        for i, address in enumerate(addresses):
+            connection = self.smtp(**kw)
+            # used for the TLS server name, like smtplib does
+            connection._host = self.hostname
+            try:
+                code, msg = connection.connect(address, port)
+                if code != 220:
+                    raise SMTPConnectError(code, msg)
+            except OSError:
+                connection.close()
+                if i == len(addresses) - 1:
+                    # none of them works, maybe the addresses changed
+                    self.address_cache.invalidate(self.hostname, port)
+                    raise
+            else:
+                return connection
 
-        code, response = self.connection.ehlo()
+    def _connect(self):
+        kw = {}
+        if self.connect_timeout is not None:
+            kw['timeout'] = self.connect_timeout
+        if self.implicit_tls:
+            kw['context'] = self._tls_context
+        if self.address_cache is not None:
+            connection = self._connectAddresses(**kw)
+        else:
+            connection = self.smtp(self.hostname, str(self.port), **kw)
+        if (self.connect_timeout is not None
+                or self.command_timeout is not None):
+            # the connect timeout must not limit the commands that follow
+            connection.timeout = self.command_timeout
+            sock = getattr(connection, 'sock', None)
+            if sock is not None:
+                sock.settimeout(self.command_timeout)
+
+        code, response = connection.ehlo()
         if code < 200 or code >= 300:
-            code, response = self.connection.helo()
+            code, response = connection.helo()
             if code < 200 or code >= 300:
                 raise RuntimeError('Error sending HELO to the SMTP server '
                                    '(code=%s, response=%s)' % (code, response))
 
         self.code, self.response = code, response
+        return connection
+
+    def _prepare(self, connection):
+        # encryption support
+        if not self.implicit_tls:
+            have_tls = connection.has_extn('starttls')
+            if not have_tls and self.force_tls:
+                raise RuntimeError('TLS is not available but TLS is required')
+
+            if have_tls and not self.no_tls:
+                connection.starttls(context=self._tls_context)
+                connection.ehlo()
+                self._rememberSession(connection)
+
+        if connection.does_esmtp:
+            if self.username is not None and self.password is not None:
+                username, password = self.username, self.password
+                connection.login(username, password)
+        elif self.username:
+            raise RuntimeError(
+                'Mailhost does not support ESMTP but a username is configured')
 
-    def _close_connection(self):
+    def _connectPooled(self):
+        # pooled connections are secured and authenticated once, when
+        # they are opened
+        connection = self._connect()
         try:
-            self.connection.quit()
-        except SSLError:
-            # something weird happened while quiting
-            self.connection.close()
+            self._prepare(connection)
+        except BaseException:
+            _quit_quietly(connection)
+            raise
+        return connection
+
+    def vote(self, fromaddr, toaddrs, message):
+        if self.connection is not None:
+            # this thread already has a connection for the next message
+            return
+        if self.pool is not None:
+            self.connection = self.pool.checkout()
+            self.pooled = True
+        else:
+            self.connection = self._connect()
+
+    def _rememberSession(self, connection):
+        # With TLS 1.3 the session ticket arrives after the handshake, so
+        # this is also done when the connection is given up.
+        session = getattr(getattr(connection, 'sock', None), 'session', None)
+        if session is not None:
+            self._tls_session = session
+
+    def _close_connection(self, reuse=True, sent=False):
+        connection = self.connection
         self.connection = None
+        self._rememberSession(connection)
+        if self.pooled:
+            self.pooled = False
+            if reuse:
+                self.pool.checkin(connection, sent)
+            else:
+                self.pool.discard(connection)
+        elif reuse:
+            _quit(connection)
+        else:
+            # the connection is in an unknown state, don't talk to the
+            # server any more
+            connection.close()
 
     def abort(self):
         if self.connection is None:
             return
         self._close_connection()
 
+    def close(self):
+        """Closes this thread's connection and all idle pooled ones."""
+        self.abort()
+        if self.pool is not None:
+            self.pool.close()
+
+    def _watchdog(self, connection):
+        # Returns a started timer that shuts the connection's socket down
+        # when sending takes longer than `send_timeout`, which makes the
+        # blocked command fail, and an event that tells whether it fired.
+        fired = threading.Event()
+
+        def expire():
+            fired.set()
+            sock = getattr(connection, 'sock', None)
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+        timer = threading.Timer(self.send_timeout, expire)
+        timer.daemon = True
+        timer.start()
+        return timer, fired
+
     def send(self, fromaddr, toaddrs, message):
         connection = self.connection
         if connection is None:
@@ -95,25 +538,866 @@ class SMTPMailer:
 
         connection = self.connection
 
-        # encryption support
-        if not self.implicit_tls:
-            have_tls = connection.has_extn('starttls')
-            if not have_tls and self.force_tls:
-                raise RuntimeError('TLS is not available but TLS is required')
+        if self.send_timeout is None:
+            return self._send(connection, fromaddr, toaddrs, message)
 
-            if have_tls and not self.no_tls:
-                connection.starttls()
-                connection.ehlo()
+        timer, fired = self._watchdog(connection)
+        try:
+            return self._send(connection, fromaddr, toaddrs, message)
+        except Exception as e:
+            if fired.is_set():
+                if self.connection is connection:
+                    # timed out while securing or authenticating
+                    self._close_connection(reuse=False)
+                raise SendTimeoutError(
+                    'Sending the message took more than %s seconds'
+                    % self.send_timeout) from e
+            raise
+        finally:
+            timer.cancel()
+            # don't leave the timer's thread behind
+            timer.join()
 
-        if connection.does_esmtp:
-            if self.username is not None and self.password is not None:
-                username, password = self.username, self.password
-                connection.login(username, password)
-        elif self.username:
-            raise RuntimeError(
-                'Mailhost does not support ESMTP but a username is configured')
+    def _send(self, connection, fromaddr, toaddrs, message):
+        if not self.pooled:
+            try:
+                self._prepare(connection)
+            except BaseException:
+                # the session may be half secured or authenticated, don't
+                # send the next message over it
+                self._close_connection(reuse=False)
+                raise
+
+        try:
+            refused, broken = self._sendmail(
+                connection, fromaddr, toaddrs, message)
+        except (SMTPRecipientsRefused, SMTPResponseException) as e:
+            # the server refused the message, but the connection can still
+            # be used, unless the server is shutting down
+            code = getattr(e, 'smtp_code', None)
+            self._close_connection(reuse=code != 421)
+            raise
+        except TimeoutError as e:
+            self._close_connection(reuse=False)
+            if isinstance(e, SendTimeoutError):
+                raise
+            raise SendTimeoutError(str(e) or 'timed out') from e
+        except BaseException:
+            self._close_connection(reuse=False)
+            raise
+        else:
+            if broken:
+                self._close_connection(reuse=False)
+            else:
+                self._close_connection(sent=True)
+            return refused
+
+    def _sendmail(self, connection, fromaddr, toaddrs, message):
+        """Send the message to at most `max_recipients` recipients per
+        transaction, over the same connection.
+
+        The recipients of the transactions that failed are refused with
+        the reply of the server, so that the caller can retry just them.
+        If all of them failed, the (first) error is raised.  Returns the
+        refused recipients and whether the connection is broken.
+        """
+        size = self.max_recipients
+        if not size or len(toaddrs) <= size:
+            return connection.sendmail(fromaddr, toaddrs, message), False
+        toaddrs = list(toaddrs)
+        chunks = [toaddrs[i:i + size] for i in range(0, len(toaddrs), size)]
+        refused = {}
+        errors = []
+        broken = None
+        for i, chunk in enumerate(chunks):
+            try:
+                refused.update(connection.sendmail(fromaddr, chunk, message))
+            except SMTPRecipientsRefused as e:
+                refused.update(e.recipients)
+                errors.append(e)
+            except SMTPResponseException as e:
+                refused.update(
+                    dict.fromkeys(chunk, (e.smtp_code, e.smtp_error)))
+                errors.append(e)
+                if e.smtp_code == 421:
+                    broken = e
+            except (SMTPServerDisconnected, OSError) as e:
+                refused.update(dict.fromkeys(chunk, (451, str(e).encode())))
+                errors.append(e)
+                broken = e
+            if broken is not None:
+                # the rest cannot be sent over this connection
+                for chunk in chunks[i + 1:]:
+                    refused.update(dict.fromkeys(
+                        chunk, (451, b'Not sent: %s' % str(broken).encode())))
+                    errors.append(broken)
+                break
+        if len(errors) < len(chunks):
+            return refused, broken is not None
+        if broken is not None:
+            raise broken
+        if all(isinstance(e, SMTPRecipientsRefused) for e in errors):
+            raise SMTPRecipientsRefused(refused)
+        raise errors[0]
+
+
+class _UnixSocketMixin:
+    # Connects to the UNIX domain socket `host` instead of a TCP port.
+
+    def connect(self, host='localhost', port=0, source_address=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            self.sock.settimeout(self.timeout)
+        self.file = None
+        try:
+            self.sock.connect(host)
+        except OSError:
+            self.close()
+            raise
+        return self.getreply()
+
+
+class _UnixSMTP(_UnixSocketMixin, SMTP):
+    pass
+
+
+class _UnixLMTP(_UnixSocketMixin, LMTP):
+    # After the message data an LMTP server replies once for every
+    # accepted recipient.  smtplib only reads the first reply, which
+    # would leave the others to confuse the next command of the session.
+
+    def mail(self, sender, options=()):
+        self._accepted = []
+        self._refused = {}
+        return super().mail(sender, options)
+
+    def rcpt(self, recip, options=()):
+        code, resp = super().rcpt(recip, options)
+        if code in (250, 251):
+            self._accepted.append(recip)
+        else:
+            self._refused[recip] = (code, resp)
+        return code, resp
+
+    def data(self, msg):
+        first = super().data(msg)
+        replies = [first] + [self.getreply() for _ in self._accepted[1:]]
+        delivered = None
+        for recip, (code, resp) in zip(self._accepted, replies):
+            if code == 250:
+                delivered = code, resp
+            else:
+                self._refused[recip] = (code, resp)
+        if delivered is not None:
+            return delivered
+        # nobody got the message; prefer a transient failure, so that it
+        # is tried again
+        for code, resp in replies:
+            if 400 <= code <= 499:
+                return code, resp
+        return first
+
+    def sendmail(self, from_addr, to_addrs, msg, mail_options=(),
+                 rcpt_options=()):
+        try:
+            refused = super().sendmail(from_addr, to_addrs, msg, mail_options,
+                                       rcpt_options)
+        except SMTPDataError as e:
+            if e.smtp_code == 421 or any(
+                    recip not in self._refused for recip in self._accepted):
+                raise
+            # every recipient refused the message; tell how, so that only
+            # those refused temporarily are tried again
+            raise SMTPRecipientsRefused(self._refused)
+        refused.update(self._refused)
+        return refused
+
+
+@implementer(ILMTPMailer)
+class LMTPMailer(SMTPMailer):
+    """Implementation of :class:`zope.sendmail.interfaces.ILMTPMailer`."""
+
+    def __init__(self, path, lmtp=True, username=None, password=None,
+                 pool_size=1, pool_idle_timeout=None, pool_max_messages=None,
+                 command_timeout=None, send_timeout=None, pool_timeout=None):
+        self.path = path
+        self.lmtp = lmtp
+        if self.smtp is None:
+            self.smtp = _UnixLMTP if lmtp else _UnixSMTP
+        # the local MTA is trusted, TLS would only cost time
+        super().__init__(path, 0, username, password, no_tls=True,
+                         pool_size=pool_size,
+                         pool_idle_timeout=pool_idle_timeout,
+                         pool_max_messages=pool_max_messages,
+                         pool_timeout=pool_timeout,
+                         command_timeout=command_timeout,
+                         send_timeout=send_timeout)
+
+
+class _PipeSocket:
+    # Lets smtplib talk to a child process over its stdin and stdout.
 
+    def __init__(self, process):
+        self.process = process
+
+    def sendall(self, data):
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+    def makefile(self, mode='rb'):
+        return self.process.stdout
+
+    def settimeout(self, timeout):
+        # pipes have no timeouts, only the send timeout applies
+        pass
+
+    def shutdown(self, how):
+        self.process.kill()
+
+    def close(self):
+        process = self.process
+        for pipe in (process.stdin, process.stdout):
+            try:
+                pipe.close()
+            except OSError:
+                pass
+        try:
+            process.wait(5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+class _PipeSMTP(SMTP):
+    # `host` is the command line of the process to talk to.
+
+    def __init__(self, host='', port=0, local_hostname='localhost', **kw):
+        # the default, the FQDN, may need a slow DNS lookup and does not
+        # matter to the local sendmail
+        super().__init__(host, port, local_hostname, **kw)
+
+    def connect(self, host='localhost', port=0, source_address=None):
+        process = subprocess.Popen(
+            host, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.sock = _PipeSocket(process)
+        self.file = None
+        return self.getreply()
+
+
+@implementer(ISendmailMailer)
+class SendmailMailer(SMTPMailer):
+    """Implementation of :class:`zope.sendmail.interfaces.ISendmailMailer`.
+    """
+
+    def __init__(self, command='/usr/sbin/sendmail', pool_size=1,
+                 pool_idle_timeout=None, pool_max_messages=None,
+                 send_timeout=None, pool_timeout=None):
+        self.command = command
+        if self.smtp is None:
+            self.smtp = self._spawn
+        super().__init__(command, 0, no_tls=True, pool_size=pool_size,
+                         pool_idle_timeout=pool_idle_timeout,
+                         pool_max_messages=pool_max_messages,
+                         pool_timeout=pool_timeout,
+                         send_timeout=send_timeout)
+
+    def _spawn(self, host, port, **kw):
+        if isinstance(self.command, str):
+            argv = [self.command]
+        else:
+            argv = list(self.command)
+        # the addresses are passed over SMTP, never on the command line
+        return _PipeSMTP(argv + ['-bs'], **kw)
+
+
+def _envelope_none(fromaddr, toaddrs, eol):
+    return b''
+
+
+def _envelope_x_sender(fromaddr, toaddrs, eol):
+    # the format of the pickup directories of IIS and Exchange
+    lines = [b'X-Sender: %s' % fromaddr.encode()]
+    lines.extend(b'X-Receiver: %s' % to.encode() for to in toaddrs)
+    return eol.join(lines) + eol
+
+
+def _envelope_zope(fromaddr, toaddrs, eol):
+    # the format of the messages in the mail queue
+    return (b'X-Zope-From: %s%s' % (fromaddr.encode(), eol)
+            + b'X-Zope-To: %s%s' % (', '.join(toaddrs).encode(), eol))
+
+
+ENVELOPE_FORMATS = {
+    'none': _envelope_none,
+    'x-sender': _envelope_x_sender,
+    'zope': _envelope_zope,
+}
+
+
+@implementer(IPickupDirectoryMailer)
+class PickupDirectoryMailer:
+    """Implementation of
+    :class:`zope.sendmail.interfaces.IPickupDirectoryMailer`.
+    """
+
+    def __init__(self, path, envelope='none', batch_size=100, fsync=True):
+        if envelope not in ENVELOPE_FORMATS:
+            raise ValueError('Unknown envelope format %r' % (envelope,))
+        self.path = path
+        self.envelope = envelope
+        self.batch_size = batch_size
+        self.fsync = fsync
+
+    def vote(self, fromaddr, toaddrs, message):
+        if not os.path.isdir(self.path):
+            raise FileNotFoundError(
+                errno.ENOENT, 'No pickup directory', self.path)
+        if not os.access(self.path, os.W_OK | os.X_OK):
+            raise PermissionError(
+                errno.EACCES, 'Cannot write to the pickup directory',
+                self.path)
+
+    def abort(self):
+        pass
+
+    def send(self, fromaddr, toaddrs, message):
+        error, = self.sendMany([(fromaddr, toaddrs, message)])
+        if error is not None:
+            raise error
+
+    def sendMany(self, messages):
+        results = []
+        written = False
+        for fromaddr, toaddrs, message in messages:
+            try:
+                self._write(fromaddr, toaddrs, message)
+            except Exception as e:
+                results.append(e)
+            else:
+                results.append(None)
+                written = True
+        if written and self.fsync:
+            # one fsync makes all the new names durable
+            self._fsyncDirectory()
+        return results
+
+    def _write(self, fromaddr, toaddrs, message):
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        eol = b'\r\n' if b'\r\n' in message[:1000] else b'\n'
+        envelope = ENVELOPE_FORMATS[self.envelope](fromaddr, toaddrs, eol)
+        name = self._uniqueName()
+        # Write to a hidden file first and rename it when it is complete,
+        # so that the MTA never picks up a partial message.
+        tmp_filename = os.path.join(self.path, '.tmp-' + name)
+        fd = os.open(tmp_filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                     0o600)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(envelope)
+                f.write(message)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.rename(tmp_filename, os.path.join(self.path, name))
+        except BaseException:
+            try:
+                os.unlink(tmp_filename)
+            except OSError:
+                pass
+            raise
+
+    def _uniqueName(self):
+        return '%d.%d.%s.%d.eml' % (time.time(), os.getpid(),
+                                    socket.gethostname(),
+                                    random.randrange(0x7fffffff))
+
+    def _fsyncDirectory(self):
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError:  # pragma: no cover
+            # directories cannot be opened on Windows
+            return
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+# HTTP statuses that are worth retrying later: besides the server errors
+# these are time outs and rate limits.
+_HTTP_TRANSIENT = frozenset([408, 425, 429])
+# Authentication and lookup failures are caused by the configuration
+# rather than the message, no message can be sent until it is fixed.
+_HTTP_UNAVAILABLE = frozenset([401, 403, 404])
+
+
+class HTTPMailerError(SMTPResponseException):
+    """An error status returned by the HTTP API of a mail service.
+
+    It is raised as a 451 SMTP reply for statuses that are worth retrying,
+    as a 421 SMTP reply (service not available) for statuses caused by the
+    configuration and as a 554 SMTP reply for the others, so that the
+    queue processor handles it like the corresponding SMTP error.
+    `status` is the HTTP status.
+    """
+
+    def __init__(self, status, reason=None):
+        if reason is None:
+            reason = http.client.responses.get(status, '')
+        if status in _HTTP_UNAVAILABLE:
+            code = 421
+        elif status in _HTTP_TRANSIENT or status >= 500:
+            code = 451
+        else:
+            code = 554
+        super().__init__(code, 'HTTP %d %s' % (status, reason))
+        self.status = status
+
+
+@implementer(IHTTPMailer)
+class HTTPMailer:
+    """Implementation of :class:`zope.sendmail.interfaces.IHTTPMailer`."""
+
+    def __init__(self, url, batch_url=None, api_key=None, timeout=None,
+                 batch_size=100, pool_size=2, pool_idle_timeout=None,
+                 ssl_context=None, headers=None):
+        self.url = url
+        self.batch_url = batch_url
+        self.api_key = api_key
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.pool_size = pool_size
+        self.pool_idle_timeout = pool_idle_timeout
+        self.ssl_context = ssl_context
+        self.headers = {'Content-Type': 'application/json'}
+        if api_key:
+            self.headers['Authorization'] = 'Bearer ' + api_key
+        if headers:
+            self.headers.update(headers)
+        self._lock = threading.Lock()
+        # idle connections by (scheme, netloc), the most recently used last
+        self._idle = {}
+
+    def _connect(self, scheme, netloc):
+        if scheme == 'https':
+            if self.ssl_context is None:
+                self.ssl_context = ssl.create_default_context()
+            return http.client.HTTPSConnection(
+                netloc, timeout=self.timeout, context=self.ssl_context)
+        if scheme == 'http':
+            return http.client.HTTPConnection(netloc, timeout=self.timeout)
+        raise ValueError('Unsupported URL scheme %r' % (scheme,))
+
+    def _checkout(self, key):
+        # Returns a connection and whether it was used before.
+        stale = []
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                connection, last_used = idle.pop()
+                if (self.pool_idle_timeout is None
+                        or time.monotonic() - last_used
+                        <= self.pool_idle_timeout):
+                    return connection, True
+                # the others were used even longer ago
+                stale = [connection] + [conn for conn, _ in idle]
+                del idle[:]
+        for conn in stale:
+            conn.close()
+        return self._connect(*key), False
+
+    def _checkin(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.pool_size:
+                idle.append((connection, time.monotonic()))
+                return
+        connection.close()
+
+    def _post(self, url, payload):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        body = json.dumps(payload).encode('utf-8')
+        connection, reused = self._checkout(key)
         try:
-            connection.sendmail(fromaddr, toaddrs, message)
+            try:
+                connection.request('POST', path, body, self.headers)
+            except (BrokenPipeError, ConnectionResetError):
+                if not reused:
+                    raise
+                # The server closed the idle connection before the request
+                # was written completely, so it cannot have processed it
+                # and it is safe to send it again over a new connection.
+                # Failures while waiting for the response are not retried,
+                # the message may have been sent.
+                connection.close()
+                connection.request('POST', path, body, self.headers)
+            response = connection.getresponse()
+            # the response must be read completely before the connection
+            # can be used again
+            result = response.status, response.reason, response.read()
+        except BaseException:
+            connection.close()
+            raise
+        self._checkin(key, connection)
+        return result
+
+    def _encode(self, fromaddr, toaddrs, message):
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        return {'from': fromaddr,
+                'to': list(toaddrs),
+                'raw': base64.b64encode(message).decode('ascii')}
+
+    def vote(self, fromaddr, toaddrs, message):
+        pass
+
+    def abort(self):
+        pass
+
+    def close(self):
+        """Closes the idle connections."""
+        with self._lock:
+            idle = [conn for conns in self._idle.values()
+                    for conn, _ in conns]
+            self._idle = {}
+        for conn in idle:
+            conn.close()
+
+    def send(self, fromaddr, toaddrs, message):
+        status, reason, _ = self._post(
+            self.url, self._encode(fromaddr, toaddrs, message))
+        if status >= 300:
+            raise HTTPMailerError(status, reason)
+
+    def sendMany(self, messages):
+        if not self.batch_url:
+            results = []
+            for fromaddr, toaddrs, message in messages:
+                try:
+                    self.send(fromaddr, toaddrs, message)
+                except Exception as e:
+                    results.append(e)
+                else:
+                    results.append(None)
+            return results
+
+        payload = {'messages': [self._encode(*m) for m in messages]}
+        status, reason, body = self._post(self.batch_url, payload)
+        if status >= 300:
+            raise HTTPMailerError(status, reason)
+        return self._batchResults(body, len(payload['messages']))
+
+    def _batchResults(self, body, count):
+        # The service may answer with {"results": [{"status": ...,
+        # "error": ...}, ...]}, one item per message; otherwise all of
+        # them were accepted.
+        try:
+            results = json.loads(body.decode('utf-8'))['results']
+            statuses = [(int(result['status']), result.get('error'))
+                        for result in results]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return [None] * count
+        if len(statuses) != count:
+            return [None] * count
+        return [HTTPMailerError(status, error) if status >= 300 else None
+                for status, error in statuses]
+
+
+def _isRelayFailure(error):
+    # Permanent replies and refused recipients concern the message, not
+    # the mailer that reported them.
+    if isinstance(error, SMTPRecipientsRefused):
+        return False
+    if isinstance(error, SMTPResponseException):
+        return not 500 <= error.smtp_code <= 599
+    return True
+
+
+class _Relay:
+    """The state of one of the mailers of a `BalancingMailer`."""
+
+    def __init__(self, mailer, weight):
+        self.mailer = mailer
+        self.weight = weight
+        # for the smooth weighted round-robin
+        self.current_weight = 0
+        self.outstanding = 0
+        self.failures = 0
+        # None while the mailer is in rotation
+        self.down_until = None
+        self.probing = False
+
+
+@implementer(IBalancingMailer)
+class BalancingMailer:
+    """Implementation of :class:`zope.sendmail.interfaces.IBalancingMailer`.
+    """
+
+    STRATEGIES = ('round-robin', 'least-outstanding')
+
+    def __init__(self, mailers, weights=None, strategy='round-robin',
+                 max_failures=3, slow_threshold=None, retry_after=30.0):
+        mailers = tuple(mailers)
+        if not mailers:
+            raise ValueError('At least one mailer is needed')
+        weights = (1,) * len(mailers) if weights is None else tuple(weights)
+        if len(weights) != len(mailers) or min(weights) < 1:
+            raise ValueError('Need a positive weight for every mailer')
+        if strategy not in self.STRATEGIES:
+            raise ValueError('Unknown strategy %r' % (strategy,))
+        self.mailers = mailers
+        self.weights = weights
+        self.strategy = strategy
+        self.max_failures = max_failures
+        self.slow_threshold = slow_threshold
+        self.retry_after = retry_after
+        self._relays = [_Relay(mailer, weight)
+                        for mailer, weight in zip(mailers, weights)]
+        self._lock = threading.Lock()
+        # the relay that voted for this thread's message
+        self._local = local()
+
+    def _order(self, relays):
+        # Returns `relays`, the preferred one first; must hold the lock.
+        if self.strategy == 'least-outstanding':
+            return sorted(relays, key=lambda r: r.outstanding / r.weight)
+        if not relays:
+            return relays
+        total = sum(r.weight for r in relays)
+        for relay in relays:
+            relay.current_weight += relay.weight
+        best = max(relays, key=lambda r: r.current_weight)
+        best.current_weight -= total
+        i = relays.index(best)
+        return relays[i:] + relays[:i]
+
+    def _candidates(self, exclude=None):
+        # Returns the relays to try in turn.
+        now = time.monotonic()
+        with self._lock:
+            up = [r for r in self._relays
+                  if r.down_until is None and r is not exclude]
+            due = [r for r in self._relays
+                   if r.down_until is not None and r.down_until <= now
+                   and not r.probing and r is not exclude]
+            relays = self._order(up)
+            if due:
+                # half open: this message probes a relay that is out of
+                # rotation, and is sent by the others if that fails
+                relays.insert(0, due[0])
+        return relays
+
+    def _begin(self, relay):
+        # Counts a call of `relay`.  Returns False if it is out of
+        # rotation and another message probes it already.
+        with self._lock:
+            if relay.down_until is not None:
+                if relay.probing:
+                    return False
+                # only a relay that is called is marked, `_record` clears
+                # the mark
+                relay.probing = True
+            relay.outstanding += 1
+            return True
+
+    def _call(self, relay, method, args):
+        # `_begin` must have been called for `relay`
+        start = time.monotonic()
+        ok = False
+        try:
+            result = getattr(relay.mailer, method)(*args)
+            ok = (self.slow_threshold is None
+                  or time.monotonic() - start <= self.slow_threshold)
+        except Exception as e:
+            ok = not _isRelayFailure(e)
+            raise
         finally:
-            self._close_connection()
+            self._record(relay, ok)
+        return result
+
+    def _record(self, relay, ok):
+        with self._lock:
+            relay.outstanding -= 1
+            relay.probing = False
+            if ok:
+                relay.failures = 0
+                relay.down_until = None
+                return
+            relay.failures += 1
+            if (relay.down_until is not None
+                    or relay.failures >= self.max_failures):
+                # take it out of rotation, or keep it out if it failed
+                # the probe
+                relay.down_until = time.monotonic() + self.retry_after
+
+    def _run(self, method, args, first=None):
+        # Calls `method` of the relays in turn, starting with `first`,
+        # until one succeeds and returns that relay and the result.
+        relays = self._candidates(exclude=first)
+        if first is not None:
+            relays.insert(0, first)
+        error = None
+        for relay in relays:
+            if not self._begin(relay):
+                continue
+            try:
+                return relay, self._call(relay, method, args)
+            except Exception as e:
+                if not _isRelayFailure(e):
+                    raise
+                error = e
+        if error is not None:
+            raise error
+        raise ConnectionError('All mailers are out of rotation')
+
+    def vote(self, fromaddr, toaddrs, message):
+        self.abort()
+        self._local.relay, _ = self._run(
+            'vote', (fromaddr, toaddrs, message))
+
+    def abort(self):
+        relay = getattr(self._local, 'relay', None)
+        self._local.relay = None
+        if relay is not None:
+            relay.mailer.abort()
+
+    def close(self):
+        """Closes the mailers that can be closed."""
+        for mailer in self.mailers:
+            close = getattr(mailer, 'close', None)
+            if close is not None:
+                close()
+
+    def send(self, fromaddr, toaddrs, message):
+        relay = getattr(self._local, 'relay', None)
+        self._local.relay = None
+        # start with the mailer that voted for the message, if any
+        return self._run('send', (fromaddr, toaddrs, message), relay)[1]
+
+
+def _domain(address):
+    return parseaddr(address)[1].rpartition('@')[2].lower()
+
+
+class Route:
+    """A rule of a `RoutingMailer`.
+
+    It sends the mail to the `IMailer` utility named `mailer` if all the
+    given conditions hold: the recipient's domain is `domain` or one of its
+    subdomains, the sender is `sender` (or in the domain of `sender` if it
+    starts with ``@``) and the routing key of the message is `key`.
+    """
+
+    def __init__(self, mailer, domain=None, sender=None, key=None):
+        self.mailer = mailer
+        self.domain = domain.lower().lstrip('.') if domain else None
+        self.sender = sender.lower() if sender else None
+        self.key = key
+
+    def matches(self, fromaddr, toaddr, key=None):
+        if self.key is not None and key != self.key:
+            return False
+        if self.sender is not None:
+            if self.sender.startswith('@'):
+                if _domain(fromaddr) != self.sender[1:]:
+                    return False
+            elif parseaddr(fromaddr)[1].lower() != self.sender:
+                return False
+        if self.domain is not None:
+            domain = _domain(toaddr)
+            if (domain != self.domain
+                    and not domain.endswith('.' + self.domain)):
+                return False
+        return True
+
+    def __repr__(self):
+        conditions = ['%s=%r' % (name, getattr(self, name))
+                      for name in ('domain', 'sender', 'key')
+                      if getattr(self, name) is not None]
+        return '<Route %s to %r>' % (' '.join(conditions), self.mailer)
+
+
+@implementer(IRoutingMailer)
+class RoutingMailer:
+    """Implementation of :class:`zope.sendmail.interfaces.IRoutingMailer`.
+
+    The mailers are looked up when a message is sent; the connections are
+    those of the mailers, so pooled mailers keep them open for every route.
+    """
+
+    def __init__(self, routes, default=None):
+        self.routes = tuple(routes)
+        self.default = default
+        # the mailers that voted for this thread's message
+        self._local = local()
+
+    def _route(self, fromaddr, toaddrs, key=None):
+        # Returns a list of (mailer name, recipients) pairs.
+        groups = {}
+        for toaddr in toaddrs:
+            for route in self.routes:
+                if route.matches(fromaddr, toaddr, key):
+                    name = route.mailer
+                    break
+            else:
+                name = self.default
+                if name is None:
+                    raise ValueError('No route for %s' % (toaddr,))
+            groups.setdefault(name, []).append(toaddr)
+        return list(groups.items())
+
+    def _mailer(self, name):
+        return getUtility(IMailer, name)
+
+    def vote(self, fromaddr, toaddrs, message):
+        self.abort()
+        voted = self._local.voted = []
+        for name, recipients in self._route(fromaddr, toaddrs):
+            mailer = self._mailer(name)
+            mailer.vote(fromaddr, recipients, message)
+            voted.append(mailer)
+
+    def abort(self):
+        voted = getattr(self._local, 'voted', None)
+        self._local.voted = None
+        for mailer in voted or ():
+            mailer.abort()
+
+    def send(self, fromaddr, toaddrs, message, route=None):
+        self._local.voted = None
+        groups = self._route(fromaddr, toaddrs, route)
+        refused = {}
+        errors = []
+        for name, recipients in groups:
+            try:
+                result = self._mailer(name).send(
+                    fromaddr, recipients, message)
+            except Exception as e:
+                if len(groups) == 1:
+                    raise
+                errors.append(e)
+                if isinstance(e, SMTPResponseException):
+                    code, reply = e.smtp_code, e.smtp_error
+                else:
+                    # not an SMTP reply, so presumably temporary
+                    code, reply = 451, str(e)
+                if isinstance(reply, str):
+                    reply = reply.encode('utf-8')
+                for recipient in recipients:
+                    refused[recipient] = (code, reply)
+                # the replies to single recipients, of all of them for
+                # SMTPRecipientsRefused
+                replies = getattr(e, 'recipients', None)
+                if isinstance(replies, dict):
+                    refused.update(replies)
+            else:
+                if result:
+                    refused.update(result)
+        if len(errors) == len(groups):
+            raise errors[0]
+        return refused
@@ -19,19 +19,32 @@ __docformat__ = 'restructuredtext'
 
 import argparse
 import atexit
+import collections
 import configparser
 import errno
+import hashlib
+import heapq
+import itertools
 import logging
 import os
+import signal
 import smtplib
 import sys
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from email.utils import formataddr
 from email.utils import getaddresses
 from pathlib import Path
 
+from zope.sendmail import digest
+from zope.sendmail import quota
+from zope.sendmail.interfaces import IBatchMailer
+from zope.sendmail.interfaces import IRoutingMailer
 from zope.sendmail.maildir import Maildir
+from zope.sendmail.mailer import LMTPMailer
+from zope.sendmail.mailer import SendmailMailer
+from zope.sendmail.mailer import SendTimeoutError
 from zope.sendmail.mailer import SMTPMailer
 
 
@@ -53,6 +66,55 @@ else:
 # messages sent.
 MAX_SEND_TIME = 60 * 60 * 3
 
+# Envelope lines that may follow ``X-Zope-From`` and ``X-Zope-To`` at the top
+# of a queued message, and the options they hold.
+ENVELOPE_OPTIONS = {
+    # the time (in seconds since the epoch) after which the message is
+    # no longer worth sending
+    b'X-Zope-Expires': 'expires',
+    # the routing key for an IRoutingMailer
+    b'X-Zope-Route': 'route',
+    # the group of the message for fair scheduling
+    b'X-Zope-Tenant': 'tenant',
+    # the key of the digest the message is sent in
+    b'X-Zope-Digest': 'digest',
+    # the number of times the message was deferred
+    b'X-Zope-Attempts': 'attempts',
+}
+
+
+def _isTransient(error):
+    """Tells whether sending may succeed when it is simply tried again.
+
+    This is the case for connection problems (including timeouts) and
+    for 4xx replies of the server.
+    """
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code <= 499
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    # smtplib's other errors are OSErrors as well, but they are caused by
+    # the configuration or the message
+    return (isinstance(error, OSError)
+            and not isinstance(error, smtplib.SMTPException))
+
+
+def _isConnectionFailure(error):
+    """Tells whether `error` means that the mail server cannot be reached.
+
+    Unlike other transient errors these concern every message, not just
+    the one being sent.
+    """
+    if isinstance(error, (smtplib.SMTPServerDisconnected,
+                          smtplib.SMTPConnectError)):
+        return True
+    if isinstance(error, smtplib.SMTPResponseException):
+        # service not available
+        return error.smtp_code == 421
+    return (isinstance(error, OSError)
+            and not isinstance(error, smtplib.SMTPException))
+
+
 # The below diagram depicts the operations performed while sending a message in
 # the ``run`` method of ``QueueProcessorThread``.  This sequence of operations
 # will be performed for each file in the maildir each time the thread "wakes
@@ -107,6 +169,138 @@ MAX_SEND_TIME = 60 * 60 * 3
 #                  ( message delivered )<---------+
 
 
+# `parts` are the claims of the messages merged into this one, if any
+_Claim = collections.namedtuple(
+    '_Claim',
+    'filename tmp_filename fromaddr toaddrs options message size parts',
+    defaults=((),))
+
+
+def _parts(claim):
+    return claim.parts or (claim,)
+
+
+def _isDeferred(reply):
+    """Tells whether a recipient refused with `reply` may be tried again."""
+    return 400 <= reply[0] <= 499
+
+
+def _envelope(fromaddr, toaddrs, options):
+    """Returns the envelope lines that `_parseMessage` reads back."""
+    lines = [b'X-Zope-From: %s\n' % fromaddr.encode(),
+             b'X-Zope-To: %s\n' % ", ".join(toaddrs).encode()]
+    for name, option in ENVELOPE_OPTIONS.items():
+        if option in options:
+            lines.append(b'%s: %s\n' % (name, options[option].encode()))
+    return b''.join(lines)
+
+
+def _digestKey(claim):
+    """Messages with the same key are sent in one digest."""
+    options = {name: value for name, value in claim.options.items()
+               if name not in ('expires', 'attempts')}
+    return claim.fromaddr, claim.toaddrs, tuple(sorted(options.items()))
+
+
+def _mergeKey(claim):
+    """Messages with the same key can be sent in one transaction."""
+    message = claim.message
+    # the delivery puts a Message-Id of its own at the top of every message
+    if message[:11].lower() == b'message-id:':
+        message = message.partition(b'\n')[2]
+    return (claim.fromaddr, claim.options.get('route'),
+            hashlib.sha256(message).digest())
+
+
+class _AdaptiveLimit:
+    """A limit of the sends in flight, found by additive increase and
+    multiplicative decrease (AIMD).
+
+    Every send that went well raises the limit by ``1 / limit``, about one
+    per round of sends.  A send that was throttled (a 4xx reply or a
+    timeout) or slower than `latency_target` seconds cuts it by
+    `decrease`.  The sends that were in flight at that time report the
+    same congestion, so it is cut at most once per round.
+    """
+
+    def __init__(self, floor, ceiling, latency_target=None, decrease=0.5):
+        self.floor = max(floor, 1)
+        self.ceiling = max(ceiling, self.floor)
+        self.latency_target = latency_target
+        self.decrease = decrease
+        self.value = float(self.floor)
+        # observations to go until the limit may be cut again
+        self._holdoff = 0
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self):
+        return int(self.value)
+
+    def observe(self, latency, throttled=False):
+        with self._lock:
+            holding = self._holdoff > 0
+            if holding:
+                self._holdoff -= 1
+            if throttled or (self.latency_target is not None
+                             and latency > self.latency_target):
+                if not holding:
+                    self.value = max(self.value * self.decrease, self.floor)
+                    self._holdoff = self.limit
+            else:
+                self.value = min(self.value + 1 / self.value, self.ceiling)
+
+
+def _isThrottling(error):
+    """Tells whether `error` means that the mail server is overloaded."""
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code <= 499
+    return isinstance(error, TimeoutError)
+
+
+class _ScheduleIndex:
+    """Time-ordered index of the messages scheduled for later delivery.
+
+    The index is only rebuilt when the scheduled messages change, so
+    messages that are not due yet cost nothing on a queue pass.  Directory
+    times are kept on a coarse clock: a message renamed in right after the
+    listing may leave them unchanged, so the folder is listed again on
+    every pass while its time is within a second of the last listing.
+    """
+
+    def __init__(self, maildir):
+        self.maildir = maildir
+        self._version = None
+        self._min_priority = None
+        self._unsettled = False
+        self._heap = []
+
+    def due(self, now, min_priority=None):
+        """Remove the messages that are due from the index.
+
+        Returns a list of their pathnames and the time the next message
+        is due, or ``None``.
+        """
+        version = self.maildir.scheduledVersion()
+        if (self._unsettled or version != self._version
+                or min_priority != self._min_priority):
+            listed = time.time()
+            self._version = version
+            self._min_priority = min_priority
+            self._unsettled = (version is not None
+                               and listed - version / 1e9 < 1.0)
+            # a sorted list is a valid heap
+            self._heap = [
+                (due, filename)
+                for due, priority, filename in self.maildir.scheduled()
+                if min_priority is None or priority >= min_priority]
+        heap = self._heap
+        due = []
+        while heap and heap[0][0] <= now:
+            due.append(heapq.heappop(heap)[1])
+        return due, heap[0][0] if heap else None
+
+
 class QueueProcessorThread(threading.Thread):
     """This thread is started at configuration time from the
     `mail:queuedDelivery` directive handler if processorThread is True.
@@ -115,14 +309,98 @@ class QueueProcessorThread(threading.Thread):
     log = logging.getLogger("QueueProcessorThread")
     _stopped = False
     interval = 3.0   # process queue every X second
+    # when the queue stays empty, scan it less and less often, up to every
+    # max_interval seconds; in between, only check whether messages were
+    # added every interval seconds
+    max_interval = None
+    # the time to wait after the current pass
+    _delay = None
+    # messages taken out of the queue by the current pass
+    _progress = 0
+    # messages that may be sent later (e.g. to recipients refused with a
+    # 4xx reply) are deferred for retry_delay seconds, twice as long after
+    # every attempt, up to retry_max_delay seconds
+    retry_delay = 60.0
+    retry_max_delay = 3600.0
+    # the earliest time a message deferred by the current pass is due
+    _retryDue = None
     maildir = None
     mailer = None
-
-    def __init__(self, interval=3.0):
+    _schedule = None
+    # delete expired messages instead of keeping them as ``.expired-`` files
+    discard_expired = False
+    # only send messages with at least this priority
+    min_priority = None
+    # pause the delivery after this many consecutive failures to reach the
+    # mail server (0 or None disables this), for breaker_backoff seconds at
+    # first and twice as long after every failed probe, up to
+    # breaker_max_backoff seconds
+    breaker_threshold = 5
+    breaker_backoff = 30.0
+    breaker_max_backoff = 600.0
+    _failures = 0
+    # the monotonic time from which on a message may probe the mail server
+    # again, None while it can be reached
+    _open_until = None
+    _failing_since = None
+    _backoff = None
+    # send up to max_concurrency messages (or batches) at the same time,
+    # with a limit found between min_concurrency and max_concurrency by
+    # watching for throttling and for sends slower than latency_target
+    min_concurrency = 1
+    max_concurrency = 1
+    latency_target = None
+    _limiter = None
+    # sends in flight in worker threads
+    _inflight = 0
+    # messages of at least large_message_size bytes are sent by workers of
+    # their own, up to large_concurrency at the same time, so that they do
+    # not hold up the small messages queued behind them
+    large_message_size = None
+    large_concurrency = 1
+    _largeExecutor = None
+    # sends of large messages in flight, part of _inflight
+    _largeInflight = 0
+    # with fair_scheduling, the messages of every priority lane are grouped
+    # by tenant (or envelope sender) and taken in deficit round-robin
+    # order, up to fair_quantum bytes per group and round; a group has at
+    # most tenant_max_in_flight (or tenant_limits[group]) messages in
+    # flight at the same time
+    fair_scheduling = False
+    fair_quantum = 65536
+    tenant_max_in_flight = None
+    tenant_limits = None
+    # messages with the same sender and body among the next merge_window
+    # ones are sent in one transaction to up to merge_max_recipients
+    # recipients; None disables this
+    merge_window = None
+    merge_max_recipients = 100
+    # messages queued with the same digest key, sender and recipients are
+    # put together by digest_combiner (`zope.sendmail.digest.combine` if
+    # None) and sent as one, up to digest_max_messages at a time
+    digest_combiner = None
+    digest_max_messages = 100
+
+    def __init__(self, interval=3.0, min_priority=None, max_interval=None):
         threading.Thread.__init__(
             self, name="zope.sendmail.queue.QueueProcessorThread")
         self.interval = interval
+        self.min_priority = min_priority
+        self.max_interval = max_interval
         self._lock = threading.Lock()
+        # guards _inflight
+        self._slots = threading.Condition(threading.Lock())
+        # serializes the bookkeeping after sends in worker threads
+        self._outcomeLock = threading.Lock()
+        # group -> messages in flight, guarded by _slots
+        self._groupInflight = collections.Counter()
+        # filename -> (group, size) of the messages seen by _fairOrder
+        self._heads = {}
+        self._wakeup = threading.Event()
+        # temporary files of messages we claimed but did not start sending
+        self._claims = set()
+        # set by `drain`, `stop` does not wait past it either
+        self._drainDeadline = None
         self.daemon = True
 
     def setMaildir(self, maildir):
@@ -131,6 +409,10 @@ class QueueProcessorThread(threading.Thread):
         This method is used just to provide a `maildir` stub.
         """
         self.maildir = maildir
+        if getattr(maildir, 'scheduled', None) is not None:
+            self._schedule = _ScheduleIndex(maildir)
+        else:
+            self._schedule = None
 
     def _makeMaildir(self, path):
         return Maildir(path, True)
@@ -148,15 +430,29 @@ class QueueProcessorThread(threading.Thread):
         Returns a fromaddr string, a toaddrs tuple and the message
         string.
         """
+        fromaddr, toaddrs, options, rest = self._parseEnvelope(message)
+        return fromaddr, toaddrs, rest
+
+    def _parseEnvelope(self, message):
+        """Extract the envelope from the first lines of the `message`.
+
+        The envelope consists of the ``X-Zope-From`` and ``X-Zope-To``
+        lines, optionally followed by lines for the options given when the
+        message was queued.
+
+        Returns a fromaddr string, a toaddrs tuple, a dictionary of options
+        and the message string.
+        """
 
         fromaddr = ""
         toaddrs = ()
+        options = {}
         rest = ""
 
         try:
             first, second, rest = message.split(b'\n', 2)
         except ValueError:
-            return fromaddr, toaddrs, message
+            return fromaddr, toaddrs, options, message
 
         if first.startswith(b"X-Zope-From: "):
             i = len(b"X-Zope-From: ")
@@ -171,7 +467,25 @@ class QueueProcessorThread(threading.Thread):
                 if address
             )
 
-        return fromaddr, toaddrs, rest
+        while rest.startswith(b"X-Zope-"):
+            line, sep, remainder = rest.partition(b'\n')
+            name, colon, value = line.partition(b': ')
+            option = ENVELOPE_OPTIONS.get(name)
+            if option is None or not sep:
+                break
+            options[option] = value.decode()
+            rest = remainder
+
+        return fromaddr, toaddrs, options, rest
+
+    def _hasExpired(self, options):
+        expires = options.get('expires')
+        if expires is None:
+            return False
+        try:
+            return float(expires) <= time.time()
+        except ValueError:
+            return False
 
     def _action_if_exists(self, fname, func, default=None):
         # apply the func to the fname, ignoring exceptions that
@@ -188,28 +502,466 @@ class QueueProcessorThread(threading.Thread):
     def _unlink_if_exists(self, fname):
         self._action_if_exists(fname, os.unlink)
 
+    def _messages(self):
+        if self.min_priority is None:
+            messages = iter(self.maildir)
+        else:
+            messages = self.maildir.messages(self.min_priority)
+        if self.fair_scheduling:
+            return self._fairOrder(messages)
+        return messages
+
+    def _group(self, fromaddr, options):
+        return options.get('tenant') or fromaddr
+
+    def _readHead(self, filename):
+        """Returns the group and size of the message in `filename`."""
+        try:
+            with open(filename, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                lines = []
+                for line in f:
+                    lines.append(line)
+                    if not line.startswith(b'X-Zope-'):
+                        break
+        except OSError:
+            # sent by someone else in the meantime
+            return None
+        fromaddr, toaddrs, options, rest = self._parseEnvelope(
+            b''.join(lines))
+        return self._group(fromaddr, options), size
+
+    def _fairOrder(self, messages):
+        """Take `messages` in deficit round-robin order across groups.
+
+        The priority lanes are kept apart, so that a message of a higher
+        priority is still sent first.  The envelopes are only read the
+        first time a message is seen.
+        """
+        heads = {}
+        for lane, filenames in itertools.groupby(
+                messages, lambda f: os.path.dirname(os.path.dirname(f))):
+            pending = {}
+            for filename in filenames:
+                head = self._heads.get(filename) or self._readHead(filename)
+                if head is None:
+                    continue
+                heads[filename] = self._heads[filename] = head
+                group, size = head
+                pending.setdefault(group, collections.deque()).append(
+                    (filename, size))
+            yield from self._roundRobin(pending)
+        # forget the messages that are gone
+        self._heads = heads
+
+    def _roundRobin(self, pending):
+        deficits = dict.fromkeys(pending, 0)
+        while pending:
+            blocked = True
+            for group in list(pending):
+                if self._atTenantLimit(group):
+                    continue
+                blocked = False
+                messages = pending[group]
+                deficits[group] += self.fair_quantum
+                while (messages and messages[0][1] <= deficits[group]
+                       and not self._atTenantLimit(group)):
+                    filename, size = messages.popleft()
+                    deficits[group] -= size
+                    yield filename
+                if not messages:
+                    del pending[group], deficits[group]
+            if blocked:
+                # every group with messages left is at its limit, wait
+                # for one of their sends to finish
+                with self._slots:
+                    self._slots.wait_for(
+                        lambda: self._stopped or not all(
+                            self._atTenantLimit(group) for group in pending))
+                if self._stopped:
+                    return
+
+    def _tenantLimit(self, group):
+        return (self.tenant_limits or {}).get(
+            group, self.tenant_max_in_flight)
+
+    def _atTenantLimit(self, group):
+        limit = self._tenantLimit(group)
+        return (limit is not None
+                and self._groupInflight[group] >= max(limit, 1))
+
+    def _countClaims(self, claims, delta):
+        # with _slots held
+        if self.fair_scheduling:
+            for claim in claims:
+                group = self._group(claim.fromaddr, claim.options)
+                self._groupInflight[group] += delta
+                if not self._groupInflight[group]:
+                    del self._groupInflight[group]
+
+    def _releaseScheduled(self):
+        """Move the scheduled messages that are due into the queue.
+
+        Returns the time the next scheduled message is due, or ``None``.
+        """
+        if self._schedule is None:
+            return None
+        try:
+            due, next_due = self._schedule.due(time.time(), self.min_priority)
+            for filename in due:
+                self.maildir.releaseScheduled(filename)
+        except Exception:
+            self.log.error("Error while releasing scheduled mail",
+                           exc_info=True)
+            return None
+        return next_due
+
     def run(self, forever=True):
         atexit.register(self.stop)
         while not self._stopped:
-            for filename in self.maildir:
-                # if we are asked to stop while sending messages, do so
-                if self._stopped:
-                    break
-                self._process_one_file(filename)
-            else:
-                if forever:
-                    time.sleep(self.interval)
+            next_due = self._releaseScheduled()
+            # taken before the pass, so that messages added while it runs
+            # are noticed
+            version = self._queueVersion()
+            self._progress = 0
+            self._retryDue = None
+            # if we are asked to stop while sending messages, do so
+            if self._processQueue() and forever:
+                timeout = self._nextDelay()
+                if self._retryDue is not None:
+                    next_due = min(next_due or self._retryDue,
+                                   self._retryDue)
+                if next_due is not None:
+                    timeout = max(min(timeout, next_due - time.time()), 0)
+                if self._open_until is not None:
+                    # the mail server cannot be reached, there is no point
+                    # in trying before the next probe is due
+                    timeout = max(timeout,
+                                  self._open_until - time.monotonic())
+                self._idle(timeout, version)
 
             # A testing plug
             if not forever:
                 break
+        self._stopWorkers()
+
+    def _adaptive(self):
+        return (self.max_interval is not None
+                and self.max_interval > self.interval)
+
+    def _queueVersion(self):
+        if not self._adaptive():
+            return None
+        version = getattr(self.maildir, 'version', None)
+        if version is None:
+            return None
+        try:
+            return version()
+        except OSError:
+            return None
+
+    def _nextDelay(self):
+        """Returns how long to wait before the next pass."""
+        if not self._adaptive():
+            return self.interval
+        if self._progress:
+            # there may be more where these came from
+            self._delay = 0
+        else:
+            self._delay = min(max((self._delay or 0) * 2, self.interval),
+                              self.max_interval)
+        return self._delay
+
+    def _idle(self, timeout, version):
+        """Wait `timeout` seconds, or until messages are added."""
+        if version is None:
+            self._wakeup.wait(timeout)
+            return
+        deadline = time.monotonic() + timeout
+        while not self._stopped:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            self._wakeup.wait(min(self.interval, remaining))
+            if self._breakerOpen():
+                # new messages cannot be sent now either
+                continue
+            if self._queueVersion() != version:
+                # poll quickly again
+                self._delay = 0
+                return
+
+    def _batchSize(self):
+        if IBatchMailer.providedBy(self.mailer):
+            return max(self.mailer.batch_size or 1, 1)
+        return 1
+
+    @property
+    def concurrency(self):
+        """The number of sends that may currently be in flight."""
+        if self._limiter is None:
+            return 1
+        return self._limiter.limit
+
+    @property
+    def in_flight(self):
+        """The number of sends in flight in worker threads."""
+        return self._inflight
+
+    @property
+    def large_in_flight(self):
+        """The number of large messages being sent."""
+        return self._largeInflight
+
+    def _makeExecutor(self):
+        if self.max_concurrency <= 1:
+            return None
+        limiter = self._limiter
+        if (limiter is None
+                or (limiter.floor, limiter.ceiling, limiter.latency_target)
+                != (max(self.min_concurrency, 1), self.max_concurrency,
+                    self.latency_target)):
+            # the limit found so far is kept from pass to pass
+            self._limiter = _AdaptiveLimit(
+                self.min_concurrency, self.max_concurrency,
+                self.latency_target)
+        return ThreadPoolExecutor(
+            self.max_concurrency, thread_name_prefix=self.name)
+
+    def _processQueue(self):
+        """Send the messages in the queue.
+
+        Mailers that can send several messages at once get them in
+        batches.  With a `max_concurrency` above 1, messages are sent by
+        worker threads.  The pass ends early when the mail server cannot
+        be reached (see `_recordOutcome`).  Returns ``False`` if this was
+        interrupted by ``stop``.
+        """
+        batch_size = self._batchSize()
+        batch = []
+        window = []
+        digests = {}
+        executor = self._makeExecutor()
+        try:
+            for filename in self._messages():
+                if self._stopped:
+                    return False
+                if self._breakerOpen():
+                    break
+                if self._isLarge(filename):
+                    self._dispatchLarge(filename)
+                    continue
+                claim = self._claim(filename)
+                if claim is None:
+                    continue
+                if claim.options.get('digest'):
+                    key = _digestKey(claim)
+                    parts = digests.setdefault(key, [])
+                    parts.append(claim)
+                    if len(parts) < self.digest_max_messages:
+                        continue
+                    claims = self._combine(digests.pop(key))
+                elif self.merge_window:
+                    window.append(claim)
+                    if len(window) < self.merge_window:
+                        continue
+                    claims, window = self._merge(window), []
+                else:
+                    claims = [claim]
+                batch = self._batch(batch, claims, batch_size, executor)
+        finally:
+            for parts in digests.values():
+                batch = self._batch(batch, self._combine(parts), batch_size,
+                                    executor)
+            if window:
+                batch = self._batch(batch, self._merge(window), batch_size,
+                                    executor)
+            if batch:
+                self._dispatch(batch, executor)
+            if executor is not None:
+                executor.shutdown(wait=True)
+        return True
+
+    def _batch(self, batch, claims, batch_size, executor):
+        """Add `claims` to `batch` and dispatch it when it is full.
+
+        Returns the claims that are not dispatched yet.
+        """
+        for i, claim in enumerate(claims):
+            if self._breakerOpen():
+                self._releaseClaims(claims[i:])
+                break
+            batch.append(claim)
+            # while probing the mail server, send a single message
+            if len(batch) >= batch_size or self._open_until is not None:
+                self._dispatch(batch, executor)
+                batch = []
+        return batch
+
+    def _dispatch(self, claims, executor):
+        """Deliver `claims` now, or by a worker once one may send."""
+        if executor is None:
+            self._deliver(claims)
+            return
+        with self._slots:
+            # while probing the mail server, wait for the probe
+            while (self._inflight - self._largeInflight
+                   >= (1 if self._open_until is not None
+                       else self.concurrency)):
+                self._slots.wait()
+            self._inflight += 1
+            self._countClaims(claims, 1)
+        if self._breakerOpen():
+            # the mail server became unreachable while we were waiting
+            self._workDone(claims)
+            self._releaseClaims(claims)
+            return
+        try:
+            executor.submit(self._work, claims)
+        except BaseException:
+            self._workDone(claims)
+            raise
+
+    def _merge(self, claims):
+        """Merge the `claims` of messages with the same sender and body.
+
+        Returns the claims to send, in the order of the first message of
+        each.
+        """
+        groups = {}
+        for claim in claims:
+            groups.setdefault(_mergeKey(claim), []).append(claim)
+        merged = []
+        for group in groups.values():
+            parts = []
+            count = 0
+            for claim in group:
+                if parts and (count + len(claim.toaddrs)
+                              > self.merge_max_recipients):
+                    merged.append(self._merged(parts))
+                    parts, count = [], 0
+                parts.append(claim)
+                count += len(claim.toaddrs)
+            merged.append(self._merged(parts))
+        return merged
+
+    def _merged(self, parts):
+        if len(parts) == 1:
+            return parts[0]
+        toaddrs = tuple(toaddr for claim in parts
+                        for toaddr in claim.toaddrs)
+        return parts[0]._replace(toaddrs=toaddrs, parts=tuple(parts))
+
+    def _combine(self, parts):
+        """Put the messages of the `parts` of a digest together.
+
+        Returns the claims to send.
+        """
+        if len(parts) == 1:
+            return parts
+        first = parts[0]
+        combiner = self.digest_combiner or digest.combine
+        try:
+            message = combiner(first.fromaddr, first.toaddrs,
+                               [part.message for part in parts])
+        except Exception:
+            # better many messages than none
+            self.log.error(
+                "Error while combining %d messages from %s to %s",
+                len(parts), first.fromaddr, ", ".join(first.toaddrs),
+                exc_info=True)
+            return parts
+        if not isinstance(message, bytes):
+            message = message.encode('utf-8')
+        return [first._replace(message=message, parts=tuple(parts))]
+
+    def _releaseClaims(self, claims):
+        with self._lock:
+            for claim in claims:
+                for part in _parts(claim):
+                    self._claims.discard(part.tmp_filename)
+                    self._release(part)
+
+    def _isLarge(self, filename):
+        if self.large_message_size is None:
+            return False
+        try:
+            return os.path.getsize(filename) >= self.large_message_size
+        except OSError:
+            # gone already, leave that to _claim
+            return False
+
+    def _dispatchLarge(self, filename):
+        """Have a worker of the large lane send the message in `filename`.
+
+        If all of them are busy, the message is left for a later pass.
+        """
+        with self._slots:
+            if self._largeInflight >= max(self.large_concurrency, 1):
+                return
+            self._inflight += 1
+            self._largeInflight += 1
+        submitted = False
+        claims = ()
+        try:
+            claim = self._claim(filename)
+            if claim is not None:
+                claims = [claim]
+                with self._slots:
+                    self._countClaims(claims, 1)
+                if self._largeExecutor is None:
+                    # kept from pass to pass, so that a pass does not wait
+                    # for large messages
+                    self._largeExecutor = ThreadPoolExecutor(
+                        max(self.large_concurrency, 1),
+                        thread_name_prefix=self.name + '-large')
+                self._largeExecutor.submit(self._work, claims, True)
+                submitted = True
+        finally:
+            if not submitted:
+                self._workDone(claims, True)
+
+    def _work(self, claims, large=False):
+        try:
+            self._deliver(claims, concurrent=True, large=large)
+        except Exception:
+            self.log.error("Error while sending mail", exc_info=True)
+        finally:
+            self._workDone(claims, large)
+
+    def _workDone(self, claims=(), large=False):
+        with self._slots:
+            self._inflight -= 1
+            self._countClaims(claims, -1)
+            if large:
+                self._largeInflight -= 1
+            self._slots.notify_all()
+
+    def _stopWorkers(self, timeout=None):
+        """Wait (at most `timeout` seconds) for the sends of worker threads
+        and let the workers go."""
+        with self._slots:
+            self._slots.wait_for(lambda: not self._inflight, timeout)
+        executor, self._largeExecutor = self._largeExecutor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
 
     def _process_one_file(self, filename):
+        claim = self._claim(filename)
+        if claim is not None:
+            self._deliver([claim])
+
+    def _claim(self, filename):
+        """Claim the message in `filename` for sending.
+
+        Returns a `_Claim`, or ``None`` if the message is not to be sent
+        by us now.
+        """
         fromaddr = ''
         toaddrs = ()
         head, tail = os.path.split(filename)
         tmp_filename = os.path.join(head, '.sending-' + tail)
-        rejected_filename = os.path.join(head, '.rejected-' + tail)
+        expired_filename = os.path.join(head, '.expired-' + tail)
         try:
             # perform a series of operations in an attempt to ensure
             # that no two threads/processes send this message
@@ -286,68 +1038,375 @@ class QueueProcessorThread(threading.Thread):
                     return
                 # XXX: Silently ignoring all other causes here.
 
-            # read message file and send contents
-            with open(filename, 'rb') as f:
-                message = f.read()
-
-            fromaddr, toaddrs, message = self._parseMessage(message)
-            # The next block is the only one that is sensitive to
-            # interruptions.  Everywhere else, if this daemon thread
-            # stops, we should be able to correctly handle a restart.
-            # In this block, if we send the message, but we are
-            # stopped before we unlink the file, we will resend the
-            # message when we are restarted.  We limit the likelihood
-            # of this somewhat by using a lock to link the two
-            # operations.  When the process gets an interrupt, it
-            # will call the atexit that we registered (``stop``
-            # below).  This will try to get the same lock before it
-            # lets go.  Because this can cause the daemon thread to
-            # continue (that is, to not act like a daemon thread), we
-            # still use the _stopped flag to communicate.
-            with self._lock:
-                try:
-                    self.mailer.send(fromaddr, toaddrs, message)
-                except smtplib.SMTPResponseException as e:
-                    if 500 <= e.smtp_code <= 599:
-                        # permanent error, ditch the message
-                        self.log.error(
-                            "Discarding email from %s to %s due to"
-                            " a permanent error: %s",
-                            fromaddr, ", ".join(toaddrs), str(e))
-                        _os_link(filename, rejected_filename)
-                    else:
-                        # Log an error and retry later
-                        raise
-                except smtplib.SMTPRecipientsRefused as e:
-                    # All recipients are refused by smtp
-                    # server. Dont try to redeliver the message.
-                    self.log.error("Email recipients refused: %s",
-                                   ', '.join(e.recipients))
-                    _os_link(filename, rejected_filename)
+            self._claims.add(tmp_filename)
+            try:
+                # read message file and send contents
+                with open(filename, 'rb') as f:
+                    message = f.read()
+                size = len(message)
+
+                fromaddr, toaddrs, options, message = self._parseEnvelope(
+                    message)
+            except BaseException:
+                self._claims.discard(tmp_filename)
+                raise
 
+            if self._hasExpired(options):
+                # no point in sending it any more, put it aside without
+                # talking to the mail server
+                self._claims.discard(tmp_filename)
+                self.log.warning("Discarding expired email from %s to %s",
+                                 fromaddr, ", ".join(toaddrs))
+                if not self.discard_expired:
+                    _os_link(filename, expired_filename)
                 self._unlink_if_exists(filename)
+                self._unlink_if_exists(tmp_filename)
+                self._removed(fromaddr, options, size)
+                return
 
-            self._unlink_if_exists(tmp_filename)
-
-            # TODO: maybe log the Message-Id of the message sent
-            self.log.info("Mail from %s to %s sent.",
-                          fromaddr, ", ".join(toaddrs))
+            return _Claim(filename, tmp_filename, fromaddr, toaddrs, options,
+                          message, size)
             # Blanket except because we don't want
             # this thread to ever die
         except Exception:
-            if fromaddr != '' or toaddrs != ():
-                self.log.error(
-                    "Error while sending mail from %s to %s.",
-                    fromaddr, ", ".join(toaddrs), exc_info=True)
+            self._logError(filename, fromaddr, toaddrs)
+        return None
+
+    def _deliver(self, claims, concurrent=False, large=False):
+        """Send the claimed messages and remove them from the queue."""
+        # The next block is the only one that is sensitive to
+        # interruptions.  Everywhere else, if this daemon thread
+        # stops, we should be able to correctly handle a restart.
+        # In this block, if we send the message, but we are
+        # stopped before we unlink the file, we will resend the
+        # message when we are restarted.  We limit the likelihood
+        # of this somewhat by using a lock to link the two
+        # operations.  When the process gets an interrupt, it
+        # will call the atexit that we registered (``stop``
+        # below).  This will try to get the same lock before it
+        # lets go.  Because this can cause the daemon thread to
+        # continue (that is, to not act like a daemon thread), we
+        # still use the _stopped flag to communicate.
+        # Worker threads only hold the lock while they check whether we
+        # are stopped; ``stop`` then waits for the sends in flight.
+        with self._lock:
+            for claim in claims:
+                for part in _parts(claim):
+                    self._claims.discard(part.tmp_filename)
+            if self._stopped:
+                # we are shutting down and have not started sending
+                # these messages yet, leave them for the next run
+                for claim in claims:
+                    for part in _parts(claim):
+                        self._release(part)
+                return
+            if not concurrent:
+                self._sendClaims(claims)
+                return
+        self._sendClaims(claims, large)
+
+    def _sendClaims(self, claims, large=False):
+        start = time.monotonic()
+        refused = {}
+        if len(claims) == 1:
+            claim, = claims
+            try:
+                refused = self._send(claim) or {}
+            except Exception as e:
+                errors = [e]
+            else:
+                errors = [None]
+        else:
+            try:
+                errors = self.mailer.sendMany(
+                    [(claim.fromaddr, claim.toaddrs, claim.message)
+                     for claim in claims])
+            except Exception as e:
+                errors = [e] * len(claims)
+        # large messages take long anyway, they are not a sign of
+        # congestion
+        if self._limiter is not None and not large:
+            self._limiter.observe(
+                time.monotonic() - start,
+                any(_isThrottling(e) for e in errors if e is not None))
+        with self._outcomeLock:
+            for claim, error in zip(claims, errors):
+                # merged messages are one attempt to reach the server
+                reported = self._recordOutcome(error)
+                for part in _parts(claim):
+                    self._finish(part, error, reported, refused)
+
+    def _send(self, claim):
+        if IRoutingMailer.providedBy(self.mailer):
+            return self.mailer.send(claim.fromaddr, claim.toaddrs,
+                                    claim.message,
+                                    route=claim.options.get('route'))
+        return self.mailer.send(claim.fromaddr, claim.toaddrs, claim.message)
+
+    def _release(self, claim):
+        # give up the claim, so that the message is sent by the next pass
+        try:
+            self._unlink_if_exists(claim.tmp_filename)
+        except Exception:
+            self._logError(claim.filename, claim.fromaddr, claim.toaddrs)
+
+    def _breakerOpen(self):
+        return (self._open_until is not None
+                and time.monotonic() < self._open_until)
+
+    def _recordOutcome(self, error):
+        """Keep track of the failures to reach the mail server.
+
+        After `breaker_threshold` of them in a row, the rest of the queue
+        pass is skipped, and the next message is sent after a pause, to
+        probe the server.  Until it can be reached again, a single message
+        is logged for every probe instead of an error for every message.
+
+        Returns whether the failure was logged that way.
+        """
+        if not self.breaker_threshold:
+            return False
+        if error is None or not _isConnectionFailure(error):
+            if self._open_until is not None:
+                self.log.info(
+                    "The mail server can be reached again after %d failed"
+                    " attempts in %d seconds.", self._failures,
+                    time.monotonic() - self._failing_since)
+            self._failures = 0
+            self._open_until = None
+            self._failing_since = None
+            return False
+        now = time.monotonic()
+        if self._failures == 0:
+            self._failing_since = now
+        self._failures += 1
+        if self._open_until is None:
+            if self._failures < self.breaker_threshold:
+                return False
+            self._backoff = self.breaker_backoff
+        elif now < self._open_until:
+            # a message of the same batch
+            return True
+        else:
+            # the probe failed
+            self._backoff = min(self._backoff * 2, self.breaker_max_backoff)
+        self._open_until = now + self._backoff
+        self.log.error(
+            "Cannot reach the mail server after %d attempts in %d seconds"
+            " (%s), pausing delivery for %d seconds.", self._failures,
+            now - self._failing_since, error, self._backoff)
+        return True
+
+    def _finish(self, claim, error, reported, refused=None):
+        """Remove a message from the queue after trying to send it.
+
+        `error` is the exception raised while sending, if any, and
+        `reported` tells whether `_recordOutcome` logged it already.
+        `refused` maps the recipients the mailer could not send to to the
+        reply of the server; the message stays queued for those that may
+        be tried again and is set aside for the others.
+        """
+        try:
+            if (isinstance(error, smtplib.SMTPRecipientsRefused)
+                    and isinstance(error.recipients, dict)
+                    and any(map(_isDeferred, error.recipients.values()))):
+                # nobody got the message, but some recipients may be
+                # tried again
+                refused = error.recipients
+            elif error is not None:
+                if self._sendFailed(claim, error):
+                    if not reported:
+                        self.log.warning(
+                            "Mail from %s to %s deferred: %s",
+                            claim.fromaddr, ", ".join(claim.toaddrs), error)
+                    return
+
+            refused = {addr: reply for addr, reply in (refused or {}).items()
+                       if addr in claim.toaddrs}
+            pending = [addr for addr in claim.toaddrs
+                       if addr in refused and _isDeferred(refused[addr])]
+            failed = [addr for addr in claim.toaddrs
+                      if addr in refused and addr not in pending]
+            sent = [addr for addr in claim.toaddrs if addr not in refused]
+            if failed:
+                self.log.error("Email recipients refused: %s",
+                               ', '.join(failed))
+                head, tail = os.path.split(claim.filename)
+                self._rewrite(claim, failed,
+                              os.path.join(head, '.rejected-' + tail))
+            if pending:
+                # not progress: the message is still to be sent
+                self._defer(claim, pending)
             else:
-                self.log.error(
-                    "Error while sending mail : %s ",
-                    filename, exc_info=True)
+                self._unlink_if_exists(claim.filename)
+                self._unlink_if_exists(claim.tmp_filename)
+                self._removed(claim.fromaddr, claim.options, claim.size)
+                self._progress += 1
+
+            # TODO: maybe log the Message-Id of the message sent
+            if sent or not pending:
+                self.log.info("Mail from %s to %s sent.",
+                              claim.fromaddr, ", ".join(sent))
+            if pending:
+                self.log.warning(
+                    "Mail from %s to %s deferred: %s", claim.fromaddr,
+                    ", ".join(pending), refused[pending[0]][1])
+            # Blanket except because we don't want
+            # this thread to ever die
+        except Exception as e:
+            if not (reported and e is error):
+                self._logError(claim.filename, claim.fromaddr,
+                               claim.toaddrs)
+
+    def _defer(self, claim, toaddrs):
+        """Keep the message in the queue for `toaddrs` only, to be tried
+        again after a delay that doubles with every attempt."""
+        # our claim keeps others from sending the message while it is
+        # rewritten; it is a little smaller then, the quota notices that
+        # when it counts the queue again
+        defer = getattr(self.maildir, 'defer', None)
+        if defer is None or not self.retry_delay:
+            # tried again by the next pass
+            if tuple(toaddrs) != claim.toaddrs:
+                self._rewrite(claim, toaddrs, claim.filename)
+            self._unlink_if_exists(claim.tmp_filename)
+            return
+        attempts = int(claim.options.get('attempts', 0)) + 1
+        self._rewrite(claim, toaddrs, claim.filename,
+                      dict(claim.options, attempts=str(attempts)))
+        due = time.time() + min(self.retry_delay * 2 ** (attempts - 1),
+                                self.retry_max_delay)
+        defer(claim.filename, due)
+        if self._retryDue is None or due < self._retryDue:
+            self._retryDue = due
+        self._unlink_if_exists(claim.tmp_filename)
+
+    def _rewrite(self, claim, toaddrs, filename, options=None):
+        """Write the message of `claim` for `toaddrs` to `filename`."""
+        # written in the tmp folder of the lane and moved into place, so
+        # that nobody reads half of it
+        lane = os.path.dirname(os.path.dirname(claim.filename))
+        tmp_filename = os.path.join(
+            lane, 'tmp', '.rewritten-' + os.path.basename(filename))
+        if options is None:
+            options = claim.options
+        with open(tmp_filename, 'wb') as f:
+            f.write(_envelope(claim.fromaddr, toaddrs, options))
+            f.write(claim.message)
+        os.replace(tmp_filename, filename)
+
+    def _removed(self, fromaddr, options, size):
+        # keep the usage of the queue up to date for its quota
+        quota.removed(getattr(self.maildir, 'path', None),
+                      self._group(fromaddr, options), size)
+
+    def _sendFailed(self, claim, error):
+        # Sets a message that cannot be sent aside, returns True if it was
+        # deferred, or re-raises `error` if it is to be tried again.
+        head, tail = os.path.split(claim.filename)
+        rejected_filename = os.path.join(head, '.rejected-' + tail)
+        if (isinstance(error, smtplib.SMTPResponseException)
+                and 500 <= error.smtp_code <= 599):
+            # permanent error, ditch the message
+            self.log.error(
+                "Discarding email from %s to %s due to"
+                " a permanent error: %s",
+                claim.fromaddr, ", ".join(claim.toaddrs), str(error))
+            _os_link(claim.filename, rejected_filename)
+        elif isinstance(error, smtplib.SMTPRecipientsRefused):
+            # All recipients are refused by smtp
+            # server. Dont try to redeliver the message.
+            self.log.error("Email recipients refused: %s",
+                           ', '.join(error.recipients))
+            _os_link(claim.filename, rejected_filename)
+        elif (isinstance(error, SendTimeoutError)
+              or not _isConnectionFailure(error)
+              and (_isTransient(error)
+                   or isinstance(error, smtplib.SMTPResponseException))):
+            # the server asked us to try this message again later, or
+            # timed out when it may have got it already; don't try it
+            # again right away
+            self._defer(claim, claim.toaddrs)
+            return True
+        else:
+            if _isConnectionFailure(error):
+                # the server could not be reached; release the message so
+                # that the next pass (or the next probe of the circuit
+                # breaker) retries it instead of waiting for MAX_SEND_TIME
+                self._unlink_if_exists(claim.tmp_filename)
+            # Log an error and retry later
+            raise error
+        return False
+
+    def _logError(self, filename, fromaddr, toaddrs):
+        if fromaddr != '' or toaddrs != ():
+            self.log.error(
+                "Error while sending mail from %s to %s.",
+                fromaddr, ", ".join(toaddrs), exc_info=True)
+        else:
+            self.log.error(
+                "Error while sending mail : %s ",
+                filename, exc_info=True)
 
     def stop(self):
         self._stopped = True
-        self._lock.acquire()
-        self._lock.release()
+        self._wakeup.set()
+        # after `drain` (e.g. when called at exit) a send that hangs must
+        # not keep the process alive past the drain deadline
+        timeout = None
+        if self._drainDeadline is not None:
+            timeout = max(self._drainDeadline - time.monotonic(), 0)
+        if self._lock.acquire(timeout=-1 if timeout is None else timeout):
+            self._lock.release()
+        if self._drainDeadline is not None:
+            timeout = max(self._drainDeadline - time.monotonic(), 0)
+        self._stopWorkers(timeout)
+
+    def drain(self, timeout=None):
+        """Stop processing the queue in an orderly way.
+
+        No new messages are claimed.  A message that is being sent is
+        given until `timeout` seconds have passed to finish, messages
+        that were claimed but not started are released so that the next
+        run (of this or another process) sends them, and the mailer's
+        connections are closed if it supports that.
+
+        Returns ``True`` if no message was being sent any more when this
+        method returned.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._drainDeadline = deadline
+        self._stopped = True
+        self._wakeup.set()
+        drained = self._lock.acquire(
+            timeout=-1 if deadline is None else max(timeout, 0))
+        try:
+            for tmp_filename in list(self._claims):
+                self._claims.discard(tmp_filename)
+                self._unlink_if_exists(tmp_filename)
+        finally:
+            if drained:
+                self._lock.release()
+        if drained:
+            # wait for the sends of worker threads, too
+            with self._slots:
+                drained = self._slots.wait_for(
+                    lambda: not self._inflight,
+                    None if deadline is None
+                    else max(deadline - time.monotonic(), 0))
+        if self.is_alive() and self is not threading.current_thread():
+            self.join(None if deadline is None
+                      else max(deadline - time.monotonic(), 0))
+        # mailers that keep connections open (e.g. pooled ones) can
+        # close them here
+        close = getattr(self.mailer, 'close', None)
+        if close is not None:
+            try:
+                close()
+            except Exception:
+                self.log.error("Error while closing the mailer",
+                               exc_info=True)
+        return drained
 
 
 def boolean(s):
@@ -383,6 +1442,7 @@ class ConsoleApp:
     INI_SECTION = "app:zope-sendmail"
     INI_NAMES = [
         "interval",
+        "max_interval",
         "hostname",
         "port",
         "username",
@@ -390,6 +1450,32 @@ class ConsoleApp:
         "force_tls",
         "no_tls",
         "queue_path",
+        "drain_timeout",
+        "min_priority",
+        "connect_timeout",
+        "command_timeout",
+        "send_timeout",
+        "tls_ca_file",
+        "tls_verify",
+        "tls_minimum_version",
+        "dns_cache_ttl",
+        "max_recipients",
+        "socket",
+        "socket_protocol",
+        "sendmail",
+        "breaker_threshold",
+        "breaker_backoff",
+        "min_concurrency",
+        "max_concurrency",
+        "latency_target",
+        "large_message_size",
+        "large_concurrency",
+        "fair_scheduling",
+        "fair_quantum",
+        "tenant_max_in_flight",
+        "merge_window",
+        "merge_max_recipients",
+        "digest_max_messages",
     ]
 
     parser = argparse.ArgumentParser()
@@ -402,6 +1488,85 @@ class ConsoleApp:
         '--interval', metavar='<#secs>', type=float, default=3,
         help=("How often to check queue when in daemon mode. "
               "Default is %(default)s seconds."))
+    parser.add_argument(
+        '--max-interval', metavar='<#secs>', type=float,
+        help=("When the queue stays empty, check it less and less often, "
+              "up to this many seconds, and only look for new messages "
+              "every --interval seconds in between.  Default is to check "
+              "the queue every --interval seconds."))
+    parser.add_argument(
+        '--drain-timeout', metavar='<#secs>', type=float, default=30,
+        help=("How long to wait for a message being sent to finish "
+              "when the daemon receives SIGTERM. "
+              "Default is %(default)s seconds."))
+    parser.add_argument(
+        '--min-priority', metavar='<priority>', type=int,
+        help=("Only send messages with at least this priority, e.g. to "
+              "run a processor reserved for urgent mail next to one "
+              "handling everything.  Default is to send all messages."))
+    parser.add_argument(
+        '--breaker-threshold', metavar='<#failures>', type=int, default=5,
+        help=("Pause the delivery after this many consecutive failures "
+              "to reach the mail server; 0 disables this. "
+              "Default is %(default)s."))
+    parser.add_argument(
+        '--breaker-backoff', metavar='<#secs>', type=float, default=30,
+        help=("How long to pause before trying to reach the mail server "
+              "again; the pause doubles after every failed attempt, up to "
+              "ten minutes.  Default is %(default)s seconds."))
+    parser.add_argument(
+        '--min-concurrency', metavar='<#sends>', type=int, default=1,
+        help=("The lowest number of messages sent at the same time. "
+              "Default is %(default)s."))
+    parser.add_argument(
+        '--max-concurrency', metavar='<#sends>', type=int, default=1,
+        help=("Send up to this many messages at the same time.  The "
+              "number is raised step by step while the mail server keeps "
+              "up and halved when it throttles us.  Default is "
+              "%(default)s."))
+    parser.add_argument(
+        '--latency-target', metavar='<#secs>', type=float,
+        help=("Also send fewer messages at the same time when sending one "
+              "takes longer than this.  Default is to only watch for "
+              "throttling."))
+    parser.add_argument(
+        '--large-message-size', metavar='<#bytes>', type=int,
+        help=("Send messages of at least this size in their own worker "
+              "threads, so that they do not hold up small messages.  "
+              "Default is to send all messages alike."))
+    parser.add_argument(
+        '--large-concurrency', metavar='<#sends>', type=int, default=1,
+        help=("The number of large messages sent at the same time. "
+              "Default is %(default)s."))
+    parser.add_argument(
+        '--fair-scheduling', action='store_true',
+        help=("Take turns between the tenants (or senders) of the queued "
+              "messages, so that one of them cannot hold up the others.  "
+              "Default is to send messages in the order they were "
+              "queued."))
+    parser.add_argument(
+        '--fair-quantum', metavar='<#bytes>', type=int, default=65536,
+        help=("With --fair-scheduling, the number of bytes a tenant may "
+              "send per turn.  Default is %(default)s."))
+    parser.add_argument(
+        '--tenant-max-in-flight', metavar='<#sends>', type=int,
+        help=("With --fair-scheduling, the number of messages of one "
+              "tenant sent at the same time.  Default is no limit."))
+    parser.add_argument(
+        '--merge-window', metavar='<#messages>', type=int,
+        help=("Look for messages with the same sender and body among this "
+              "many queued messages, and send them in one transaction.  "
+              "Default is to send every message on its own."))
+    parser.add_argument(
+        '--merge-max-recipients', metavar='<#recipients>', type=int,
+        default=100,
+        help=("The number of recipients of merged messages sent in one "
+              "transaction.  Default is %(default)s."))
+    parser.add_argument(
+        '--digest-max-messages', metavar='<#messages>', type=int,
+        default=100,
+        help=("The number of messages queued with the same digest key "
+              "that are put together into one.  Default is %(default)s."))
     smtp_group = parser.add_argument_group(
         "SMTP Server",
         "Connection information for the SMTP server")
@@ -413,6 +1578,29 @@ class ConsoleApp:
         '--port', type=int, default=25,
         help=("Which port on SMTP server to deliver mail to. "
               "Default is %(default)s."))
+    smtp_group.add_argument(
+        '--connect-timeout', metavar='<#secs>', type=float,
+        help=("How long to wait for the connection to the SMTP server. "
+              "Default is to wait as long as the operating system does."))
+    smtp_group.add_argument(
+        '--command-timeout', metavar='<#secs>', type=float,
+        help=("How long to wait for the SMTP server to answer a "
+              "command.  Default is to wait forever."))
+    smtp_group.add_argument(
+        '--send-timeout', metavar='<#secs>', type=float,
+        help=("How long sending a single message may take in total. "
+              "Default is no limit."))
+    smtp_group.add_argument(
+        '--dns-cache-ttl', metavar='<#secs>', type=float,
+        help=("Remember the addresses of the SMTP server for this long, "
+              "use them in turn and fail over to the next one when a "
+              "connection fails.  Default is to look the host name up "
+              "for every connection."))
+    smtp_group.add_argument(
+        '--max-recipients', metavar='<#recipients>', type=int,
+        help=("Send a message to at most this many recipients per SMTP "
+              "transaction, in several transactions over the same "
+              "connection.  Default is no limit."))
 
     auth_group = parser.add_argument_group(
         "Authentication",
@@ -438,7 +1626,37 @@ class ConsoleApp:
         help=("Do not use TLS even if is available.  Not enabled "
               "by default."))
     del tls_group
+    smtp_group.add_argument(
+        '--tls-verify', action='store_true',
+        help=("Check the certificate and host name of the SMTP server.  "
+              "Not enabled by default."))
+    smtp_group.add_argument(
+        '--tls-ca-file', metavar='<file>',
+        help=("File with the certificates of the authorities that may "
+              "sign the certificate of the SMTP server.  Default is the "
+              "system's trusted authorities."))
+    smtp_group.add_argument(
+        '--tls-minimum-version',
+        choices=('TLSv1', 'TLSv1_1', 'TLSv1_2', 'TLSv1_3'),
+        help=("The oldest TLS version to accept.  Default is the "
+              "one of the ssl module."))
     del smtp_group
+    socket_group = parser.add_argument_group(
+        "Local MTA",
+        "Hand the mail to a local MTA over a UNIX domain socket instead "
+        "of connecting to an SMTP server.")
+    socket_group.add_argument(
+        '--socket', metavar='<path>',
+        help=("Path of the UNIX domain socket of the MTA.  The SMTP "
+              "server options are ignored if this is given."))
+    socket_group.add_argument(
+        '--socket-protocol', choices=('lmtp', 'smtp'), default='lmtp',
+        help="Protocol spoken on the socket.  Default is %(default)s.")
+    socket_group.add_argument(
+        '--sendmail', metavar='<path>',
+        help=("Path of a sendmail program to hand the mail to.  It is "
+              "started once with -bs and spoken to with SMTP."))
+    del socket_group
     parser.add_argument(
         '--config', metavar='<inifile>',
         type=_config_str,
@@ -457,6 +1675,7 @@ class ConsoleApp:
 
     daemon = False
     interval = 3
+    max_interval = None
     hostname = 'localhost'
     port = 25
     username = None
@@ -464,35 +1683,144 @@ class ConsoleApp:
     force_tls = False
     no_tls = False
     queue_path = None
+    drain_timeout = 30
+    min_priority = None
+    connect_timeout = None
+    command_timeout = None
+    send_timeout = None
+    tls_ca_file = None
+    tls_verify = False
+    tls_minimum_version = None
+    dns_cache_ttl = None
+    max_recipients = None
+    socket = None
+    socket_protocol = 'lmtp'
+    sendmail = None
+    breaker_threshold = 5
+    breaker_backoff = 30
+    min_concurrency = 1
+    max_concurrency = 1
+    latency_target = None
+    large_message_size = None
+    large_concurrency = 1
+    fair_scheduling = False
+    fair_quantum = 65536
+    tenant_max_in_flight = None
+    merge_window = None
+    merge_max_recipients = 100
+    digest_max_messages = 100
 
     QueueProcessorKind = QueueProcessorThread
     MailerKind = SMTPMailer
+    LMTPMailerKind = LMTPMailer
+    SendmailMailerKind = SendmailMailer
 
     def __init__(self, argv=None, verbose=True):
         argv = sys.argv if argv is None else argv
         self.script_name = argv[0]
         self.verbose = verbose
         self._process_args(argv[1:])
+        if self.sendmail:
+            self.mailer = self.SendmailMailerKind(
+                self.sendmail, send_timeout=self.send_timeout)
+            return
+        if self.socket:
+            self.mailer = self.LMTPMailerKind(
+                self.socket, self.socket_protocol == 'lmtp',
+                self.username, self.password,
+                command_timeout=self.command_timeout,
+                send_timeout=self.send_timeout)
+            return
         self.mailer = self.MailerKind(
             self.hostname, self.port, self.username, self.password,
-            self.no_tls, self.force_tls)
+            self.no_tls, self.force_tls,
+            connect_timeout=self.connect_timeout,
+            command_timeout=self.command_timeout,
+            send_timeout=self.send_timeout,
+            tls_ca_file=self.tls_ca_file,
+            tls_verify=self.tls_verify,
+            tls_minimum_version=self.tls_minimum_version,
+            dns_cache_ttl=self.dns_cache_ttl,
+            max_recipients=self.max_recipients)
 
     def main(self):
-        queue = self.QueueProcessorKind(self.interval)
+        queue = self.QueueProcessorKind(self.interval, self.min_priority)
+        queue.max_interval = self.max_interval
+        queue.breaker_threshold = self.breaker_threshold
+        queue.breaker_backoff = self.breaker_backoff
+        queue.min_concurrency = self.min_concurrency
+        queue.max_concurrency = self.max_concurrency
+        queue.latency_target = self.latency_target
+        queue.large_message_size = self.large_message_size
+        queue.large_concurrency = self.large_concurrency
+        queue.fair_scheduling = self.fair_scheduling
+        queue.fair_quantum = self.fair_quantum
+        queue.tenant_max_in_flight = self.tenant_max_in_flight
+        queue.merge_window = self.merge_window
+        queue.merge_max_recipients = self.merge_max_recipients
+        queue.digest_max_messages = self.digest_max_messages
         queue.setMailer(self.mailer)
         queue.setQueuePath(self.queue_path)
-        queue.run(forever=self.daemon)
+        if self.daemon:
+            self._run_daemon(queue)
+        else:
+            queue.run(forever=False)
+
+    def _run_daemon(self, queue):
+        # Run the queue in its own thread so that we can drain it in an
+        # orderly way when we are asked to terminate.
+        terminate = threading.Event()
+
+        def handle_sigterm(signum, frame):
+            terminate.set()
+
+        previous = signal.signal(signal.SIGTERM, handle_sigterm)
+        try:
+            queue.start()
+            while queue.is_alive():
+                if terminate.wait(self.interval):
+                    queue.drain(self.drain_timeout)
+                    break
+        finally:
+            signal.signal(signal.SIGTERM, previous)
 
     def _process_args(self, args):
         opts = self.parser.parse_args(args)
         self.daemon = opts.daemon
         self.interval = opts.interval
+        self.max_interval = opts.max_interval
         self.hostname = opts.hostname
         self.port = opts.port
         self.username = opts.username
         self.password = opts.password
         self.force_tls = opts.force_tls
         self.no_tls = opts.no_tls
+        self.drain_timeout = opts.drain_timeout
+        self.min_priority = opts.min_priority
+        self.connect_timeout = opts.connect_timeout
+        self.command_timeout = opts.command_timeout
+        self.send_timeout = opts.send_timeout
+        self.tls_ca_file = opts.tls_ca_file
+        self.tls_verify = opts.tls_verify
+        self.tls_minimum_version = opts.tls_minimum_version
+        self.dns_cache_ttl = opts.dns_cache_ttl
+        self.max_recipients = opts.max_recipients
+        self.socket = opts.socket
+        self.socket_protocol = opts.socket_protocol
+        self.sendmail = opts.sendmail
+        self.breaker_threshold = opts.breaker_threshold
+        self.breaker_backoff = opts.breaker_backoff
+        self.min_concurrency = opts.min_concurrency
+        self.max_concurrency = opts.max_concurrency
+        self.latency_target = opts.latency_target
+        self.large_message_size = opts.large_message_size
+        self.large_concurrency = opts.large_concurrency
+        self.fair_scheduling = opts.fair_scheduling
+        self.fair_quantum = opts.fair_quantum
+        self.tenant_max_in_flight = opts.tenant_max_in_flight
+        self.merge_window = opts.merge_window
+        self.merge_max_recipients = opts.merge_max_recipients
+        self.digest_max_messages = opts.digest_max_messages
 
         if opts.config:
             self._load_config(opts.config)
@@ -524,6 +1852,50 @@ class ConsoleApp:
         self.force_tls = boolean(config.get(section, "force_tls"))
         self.no_tls = boolean(config.get(section, "no_tls"))
         self.queue_path = string_or_none(config.get(section, "queue_path"))
+        self.drain_timeout = float(config.get(section, "drain_timeout"))
+        min_priority = string_or_none(config.get(section, "min_priority"))
+        if min_priority is not None:
+            self.min_priority = int(min_priority)
+        for name in ("max_interval", "connect_timeout", "command_timeout",
+                     "send_timeout", "dns_cache_ttl", "latency_target"):
+            timeout = string_or_none(config.get(section, name))
+            if timeout is not None:
+                setattr(self, name, float(timeout))
+        self.tls_ca_file = string_or_none(config.get(section, "tls_ca_file"))
+        self.tls_verify = boolean(config.get(section, "tls_verify"))
+        self.tls_minimum_version = string_or_none(
+            config.get(section, "tls_minimum_version"))
+        max_recipients = string_or_none(config.get(section, "max_recipients"))
+        if max_recipients is not None:
+            self.max_recipients = int(max_recipients)
+        self.socket = string_or_none(config.get(section, "socket"))
+        self.socket_protocol = config.get(section, "socket_protocol")
+        if self.socket_protocol not in ('lmtp', 'smtp'):
+            self.parser.error('socket_protocol must be lmtp or smtp')
+        self.sendmail = string_or_none(config.get(section, "sendmail"))
+        self.breaker_threshold = int(
+            config.get(section, "breaker_threshold"))
+        self.breaker_backoff = float(config.get(section, "breaker_backoff"))
+        self.min_concurrency = int(config.get(section, "min_concurrency"))
+        self.max_concurrency = int(config.get(section, "max_concurrency"))
+        large_message_size = string_or_none(
+            config.get(section, "large_message_size"))
+        if large_message_size is not None:
+            self.large_message_size = int(large_message_size)
+        self.large_concurrency = int(config.get(section, "large_concurrency"))
+        self.fair_scheduling = boolean(config.get(section, "fair_scheduling"))
+        self.fair_quantum = int(config.get(section, "fair_quantum"))
+        tenant_max_in_flight = string_or_none(
+            config.get(section, "tenant_max_in_flight"))
+        if tenant_max_in_flight is not None:
+            self.tenant_max_in_flight = int(tenant_max_in_flight)
+        merge_window = string_or_none(config.get(section, "merge_window"))
+        if merge_window is not None:
+            self.merge_window = int(merge_window)
+        self.merge_max_recipients = int(
+            config.get(section, "merge_max_recipients"))
+        self.digest_max_messages = int(
+            config.get(section, "digest_max_messages"))
 
 
 def run(argv=None):
@@ -0,0 +1,316 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Quotas for mail queues.
+
+The usage of a queue is counted once by going over the queue, and then
+kept up to date by the deliveries adding messages and the queue processors
+removing them in the same process.  Messages removed by other processes
+are only noticed when the queue is counted again, which happens when a
+quota seems to be exceeded, at most every ``rescan_interval`` seconds.
+
+The queue is counted in a thread of its own, so that the deliveries only
+wait for the count as long as they would wait for room in the queue.
+"""
+__docformat__ = 'restructuredtext'
+
+import collections
+import os
+import shutil
+import threading
+import time
+
+from zope.interface import implementer
+
+from zope.sendmail.interfaces import IQueueQuota
+from zope.sendmail.maildir import Maildir
+
+
+class QueueFullError(Exception):
+    """Raised when a message cannot be queued because of a quota.
+
+    `reason` tells which quota is exceeded.
+    """
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def _head(filename):
+    """Returns the envelope sender and tenant of a queued message."""
+    fromaddr = tenant = ''
+    with open(filename, 'rb') as f:
+        for line in f:
+            if not line.startswith(b'X-Zope-'):
+                break
+            name, colon, value = line.rstrip(b'\r\n').partition(b': ')
+            if name == b'X-Zope-From':
+                fromaddr = value.decode()
+            elif name == b'X-Zope-Tenant':
+                tenant = value.decode()
+    return tenant or fromaddr
+
+
+class _Counts:
+    """Messages and bytes, in total and by group."""
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.group_messages = collections.Counter()
+        self.group_bytes = collections.Counter()
+
+    def add(self, group, size, count=1):
+        self.messages += count
+        self.bytes += size * count
+        self.group_messages[group] += count
+        self.group_bytes[group] += size * count
+        if count < 0:
+            # keep the counts sane if another process sent the message
+            self.messages = max(self.messages, 0)
+            self.bytes = max(self.bytes, 0)
+            if self.group_messages[group] <= 0:
+                del self.group_messages[group]
+                self.group_bytes.pop(group, None)
+            else:
+                self.group_bytes[group] = max(self.group_bytes[group], 0)
+
+    def update(self, other):
+        self.messages += other.messages
+        self.bytes += other.bytes
+        self.group_messages.update(other.group_messages)
+        self.group_bytes.update(other.group_bytes)
+
+
+class _Usage(_Counts):
+    """The usage of a queue: the messages in it and the ones that have
+    room reserved.
+
+    The reservations are also kept apart, as their messages are not in
+    the queue (but in its ``tmp`` folder) until they are committed, and
+    must not get lost when the queue is counted again.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.condition = threading.Condition()
+        self.scanned = None
+        self.scanning = False
+        self.error = None
+        self.thread = None
+        self.reserved = _Counts()
+        # messages committed while the queue is counted
+        self._committed = None
+
+    def _files(self):
+        maildir = Maildir(self.path, True)
+        yield from maildir
+        for due, priority, filename in maildir.scheduled():
+            yield filename
+
+    def _count(self):
+        counts = _Counts()
+        for filename in self._files():
+            try:
+                group = _head(filename)
+                length = os.path.getsize(filename)
+            except OSError:
+                # sent in the meantime
+                continue
+            counts.add(group, length)
+        return counts
+
+    def scan(self):
+        """Start counting the messages in the queue in the background.
+
+        Called with `condition` held, which is notified when the count is
+        done; does nothing if the queue is being counted already.
+        Messages committed in the meantime may or may not have been seen
+        and are counted again, messages removed may still be counted;
+        either way the queue seems fuller than it is until the next count.
+        """
+        if self.scanning:
+            return
+        self.scanning = True
+        self.error = None
+        self._committed = _Counts()
+        thread = threading.Thread(
+            target=self._scan, name='zope.sendmail.quota %s' % self.path)
+        thread.daemon = True
+        thread.start()
+        self.thread = thread
+
+    def _scan(self):
+        counts = error = None
+        try:
+            counts = self._count()
+        except Exception as e:
+            error = e
+        with self.condition:
+            self.scanning = False
+            committed, self._committed = self._committed, None
+            self.condition.notify_all()
+            if counts is None:
+                # raised by the delivery waiting for the first count
+                self.error = error
+                return
+            counts.update(committed)
+            counts.update(self.reserved)
+            self.messages, self.bytes = counts.messages, counts.bytes
+            self.group_messages = counts.group_messages
+            self.group_bytes = counts.group_bytes
+            self.scanned = time.monotonic()
+
+    def add(self, group, size, count=1):
+        # with `condition` held
+        super().add(group, size, count)
+        if count < 0:
+            self.condition.notify_all()
+
+    def reserve(self, group, size):
+        # with `condition` held
+        self.add(group, size)
+        self.reserved.add(group, size)
+
+    def commit(self, group, size):
+        # with `condition` held; the message is in the queue now
+        self.reserved.add(group, size, -1)
+        if self._committed is not None:
+            self._committed.add(group, size)
+
+    def release(self, group, size):
+        # with `condition` held
+        self.reserved.add(group, size, -1)
+        self.add(group, size, -1)
+
+
+_usages = {}
+_usages_lock = threading.Lock()
+
+
+def _usage(path, create=True):
+    key = os.path.realpath(path)
+    with _usages_lock:
+        usage = _usages.get(key)
+        if usage is None and create:
+            usage = _usages[key] = _Usage(path)
+        return usage
+
+
+def removed(path, group, size):
+    """Note that a message of `group` with `size` bytes left the queue in
+    `path`, if the usage of that queue is being counted."""
+    if path is None:
+        return
+    usage = _usage(path, create=False)
+    if usage is not None:
+        with usage.condition:
+            usage.add(group, size, -1)
+
+
+@implementer(IQueueQuota)
+class QueueQuota:
+    __doc__ = IQueueQuota.__doc__
+
+    def __init__(self, max_messages=None, max_bytes=None,
+                 max_tenant_messages=None, max_tenant_bytes=None,
+                 min_free_bytes=None, timeout=None, rescan_interval=60.0):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_tenant_messages = max_tenant_messages
+        self.max_tenant_bytes = max_tenant_bytes
+        self.min_free_bytes = min_free_bytes
+        self.timeout = timeout
+        self.rescan_interval = rescan_interval
+
+    def _exceeded(self, usage, group, size):
+        """Returns why a message does not fit into the queue, or None."""
+        if (self.max_messages is not None
+                and usage.messages + 1 > self.max_messages):
+            return 'The queue holds %d messages' % usage.messages
+        if (self.max_bytes is not None
+                and usage.bytes + size > self.max_bytes):
+            return 'The queue holds %d bytes' % usage.bytes
+        if (self.max_tenant_messages is not None
+                and usage.group_messages[group] + 1
+                > self.max_tenant_messages):
+            return 'The queue holds %d messages of %s' % (
+                usage.group_messages[group], group)
+        if (self.max_tenant_bytes is not None
+                and usage.group_bytes[group] + size > self.max_tenant_bytes):
+            return 'The queue holds %d bytes of %s' % (
+                usage.group_bytes[group], group)
+        if self.min_free_bytes is not None:
+            free = shutil.disk_usage(usage.path).free
+            if free - size < self.min_free_bytes:
+                return 'Only %d bytes are free on disk' % free
+        return None
+
+    def prepare(self, path):
+        "See :class:`zope.sendmail.interfaces.IQueueQuota`"
+        usage = _usage(path)
+        with usage.condition:
+            if usage.scanned is None:
+                usage.scan()
+
+    def reserve(self, path, group, size):
+        "See :class:`zope.sendmail.interfaces.IQueueQuota`"
+        usage = _usage(path)
+        start = time.monotonic()
+        deadline = None
+        if self.timeout:
+            deadline = start + self.timeout
+        with usage.condition:
+            while True:
+                if usage.scanned is None:
+                    reason = 'The queue is being counted'
+                    if usage.error is not None:
+                        error, usage.error = usage.error, None
+                        raise error
+                    usage.scan()
+                else:
+                    reason = self._exceeded(usage, group, size)
+                    if reason is None:
+                        usage.reserve(group, size)
+                        return
+                    if (usage.scanned < start
+                            and start - usage.scanned >= self.rescan_interval):
+                        # messages may have been sent by another process;
+                        # counted once per call at most
+                        usage.scan()
+                remaining = (None if deadline is None
+                             else deadline - time.monotonic())
+                if usage.scanning and remaining is None:
+                    # without a timeout, the count decides
+                    usage.condition.wait()
+                    continue
+                if remaining is None or remaining <= 0:
+                    raise QueueFullError(reason)
+                # woken up when a queue processor removes a message or the
+                # queue was counted, and every second to notice other
+                # processes or a disk that has more space again
+                usage.condition.wait(min(remaining, 1.0))
+
+    def commit(self, path, group, size):
+        "See :class:`zope.sendmail.interfaces.IQueueQuota`"
+        usage = _usage(path)
+        with usage.condition:
+            usage.commit(group, size)
+
+    def release(self, path, group, size):
+        "See :class:`zope.sendmail.interfaces.IQueueQuota`"
+        usage = _usage(path)
+        with usage.condition:
+            usage.release(group, size)
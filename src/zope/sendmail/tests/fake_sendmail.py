@@ -0,0 +1,74 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""A stand-in for ``sendmail -bs`` used by the tests.
+
+It speaks just enough SMTP on stdin and stdout, and insists on being
+called with ``-bs`` as last argument.  Every message is written to a file
+named ``<pid>-<number>`` in the directory given as first argument.  If a
+second argument is given, the process exits without a word after accepting
+that many messages.
+"""
+import os
+import sys
+
+
+def main(directory, exit_after=None):
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+
+    def reply(line):
+        stdout.write(line + b'\r\n')
+        stdout.flush()
+
+    reply(b'220 localhost ESMTP fake sendmail')
+    count = 0
+    while True:
+        line = stdin.readline()
+        if not line:
+            break
+        verb = line[:4].upper()
+        if verb == b'EHLO':
+            reply(b'250-localhost')
+            reply(b'250 8BITMIME')
+        elif verb == b'HELO':
+            reply(b'250 localhost')
+        elif verb in (b'MAIL', b'RCPT', b'RSET', b'NOOP'):
+            reply(b'250 OK')
+        elif verb == b'DATA':
+            reply(b'354 go ahead')
+            data = []
+            while True:
+                line = stdin.readline()
+                if line in (b'.\r\n', b''):
+                    break
+                data.append(line)
+            count += 1
+            name = os.path.join(directory, '%d-%d' % (os.getpid(), count))
+            with open(name, 'wb') as f:
+                f.write(b''.join(data))
+            reply(b'250 queued')
+            if exit_after is not None and count >= exit_after:
+                break
+        elif verb == b'QUIT':
+            reply(b'221 bye')
+            break
+        else:
+            reply(b'502 unknown command')
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args[-1:] != ['-bs']:
+        sys.exit('usage: fake_sendmail.py <directory> [<exit after>] -bs')
+    main(args[0], int(args[1]) if len(args) > 2 else None)
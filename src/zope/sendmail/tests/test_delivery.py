@@ -21,6 +21,7 @@ import smtplib
 import sys
 import tempfile
 import unittest
+from contextlib import contextmanager
 
 import transaction
 from zope.interface import implementer
@@ -334,8 +335,10 @@ class MaildirStub:
     def __iter__(self):
         return iter(self.files)
 
-    def newMessage(self):
+    def newMessage(self, priority=0, send_after=None):
         m = MaildirWriterStub()
+        m.priority = priority
+        m.send_after = send_after
         self.msgs.append(m)
         return m
 
@@ -405,6 +408,7 @@ class LoggerStub:
     def __init__(self):
         self.infos = []
         self.errors = []
+        self.warnings = []
 
     def getLogger(self, name):
         raise NotImplementedError()
@@ -418,6 +422,9 @@ class LoggerStub:
     def info(self, msg, *args, **kwargs):
         self.infos.append((msg, args, kwargs))
 
+    def warning(self, msg, *args, **kwargs):
+        self.warnings.append((msg, args, kwargs))
+
 
 class BizzarreMailError(IOError):
     pass
@@ -530,3 +537,149 @@ class TestQueuedMailDelivery(unittest.TestCase):
         transaction.abort()
         self.assertEqual(MaildirWriterStub.commited_messages, [])
         self.assertEqual(len(MaildirWriterStub.aborted_messages), 1)
+
+    def testSendPriority(self):
+        from zope.sendmail.delivery import QueuedMailDelivery
+        delivery = QueuedMailDelivery('/path/to/mailbox')
+        maildirs = []
+
+        def Maildir(path, create=False):
+            maildir = MaildirStub(path, create)
+            maildirs.append(maildir)
+            return maildir
+
+        self.mail_delivery_module.Maildir = Maildir
+        delivery.send('jim@example.com', ('guido@example.com',),
+                      b'Subject: urgent\n\nReset your password\n',
+                      priority=10)
+        delivery.send('jim@example.com', ('guido@example.com',),
+                      b'Subject: news\n\nSomething happened\n')
+        transaction.commit()
+        self.assertEqual([md.msgs[0].priority for md in maildirs], [10, 0])
+        self.assertEqual(len(MaildirWriterStub.commited_messages), 2)
+
+    def testSendAfter(self):
+        import datetime
+        import time
+
+        from zope.sendmail.delivery import QueuedMailDelivery
+        delivery = QueuedMailDelivery('/path/to/mailbox')
+        maildirs = []
+
+        def Maildir(path, create=False):
+            maildir = MaildirStub(path, create)
+            maildirs.append(maildir)
+            return maildir
+
+        self.mail_delivery_module.Maildir = Maildir
+        message = b'Subject: later\n\nSee you later\n'
+        when = datetime.datetime(2100, 1, 1, tzinfo=datetime.timezone.utc)
+        delivery.send('jim@example.com', ('guido@example.com',), message,
+                      send_after=when)
+        delivery.send('jim@example.com', ('guido@example.com',), message,
+                      send_after=4102444800, priority=1)
+        # in the past: send right away
+        delivery.send('jim@example.com', ('guido@example.com',), message,
+                      send_after=time.time() - 10)
+        transaction.commit()
+        self.assertEqual(
+            [(md.msgs[0].priority, md.msgs[0].send_after)
+             for md in maildirs],
+            [(0, 4102444800.0), (1, 4102444800), (0, None)])
+
+    def testSendTTL(self):
+        from zope.sendmail.delivery import QueuedMailDelivery
+        delivery = QueuedMailDelivery('/path/to/mailbox', ttl=600)
+        message = b'Subject: code\n\nYour code is 1234\n'
+        with patched_time(self.mail_delivery_module, 1000000000):
+            delivery.send('jim@example.com', ('guido@example.com',), message)
+            delivery.send('jim@example.com', ('guido@example.com',), message,
+                          ttl=60)
+            delivery.send('jim@example.com', ('guido@example.com',), message,
+                          ttl=60, send_after=1000003600)
+        transaction.commit()
+        # the order of commits is not defined
+        envelopes = sorted(m.split(b'\n')[2]
+                           for m in MaildirWriterStub.commited_messages)
+        self.assertEqual(envelopes,
+                         [b'X-Zope-Expires: 1000000060',
+                          b'X-Zope-Expires: 1000000600',
+                          b'X-Zope-Expires: 1000003660'])
+        self.assertIsNone(QueuedMailDelivery('/path/to/mailbox').ttl)
+
+    def testSendRoute(self):
+        from zope.sendmail.delivery import QueuedMailDelivery
+        delivery = QueuedMailDelivery('/path/to/mailbox')
+        message = b'Subject: news\n\nWhat is new\n'
+        delivery.send('jim@example.com', ('guido@example.com',), message,
+                      route='bulk')
+        transaction.commit()
+        msg, = MaildirWriterStub.commited_messages
+        self.assertEqual(msg.split(b'\n')[2], b'X-Zope-Route: bulk')
+        with self.assertRaises(ValueError):
+            delivery.send('jim@example.com', ('guido@example.com',), message,
+                          route='bulk\nX-Zope-To: spam@example.com')
+
+    def testSendTenant(self):
+        from zope.sendmail.delivery import QueuedMailDelivery
+        delivery = QueuedMailDelivery('/path/to/mailbox')
+        message = b'Subject: news\n\nWhat is new\n'
+        delivery.send('jim@example.com', ('guido@example.com',), message,
+                      route='bulk', tenant='acme')
+        transaction.commit()
+        msg, = MaildirWriterStub.commited_messages
+        self.assertEqual(msg.split(b'\n')[2:4],
+                         [b'X-Zope-Route: bulk', b'X-Zope-Tenant: acme'])
+        with self.assertRaises(ValueError):
+            delivery.send('jim@example.com', ('guido@example.com',), message,
+                          tenant='acme\r\nX-Zope-To: spam@example.com')
+
+    def testSendDigest(self):
+        from zope.sendmail import digest
+        from zope.sendmail.delivery import QueuedMailDelivery
+        self.addCleanup(digest._dues.clear)
+        delivery = QueuedMailDelivery('/path/to/mailbox', digest_window=300)
+        maildirs = []
+
+        def Maildir(path, create=False):
+            maildir = MaildirStub(path, create)
+            maildirs.append(maildir)
+            return maildir
+
+        self.mail_delivery_module.Maildir = Maildir
+        message = b'Subject: New comment\n\nHi\n'
+        with patched_time(self.mail_delivery_module, 1000000000):
+            delivery.send('jim@example.com', ('guido@example.com',), message,
+                          digest='comments')
+        with patched_time(self.mail_delivery_module, 1000000100):
+            # held back until the digest opened by the first one is sent
+            delivery.send('jim@example.com', ('guido@example.com',), message,
+                          digest='comments')
+            # another digest
+            delivery.send('jim@example.com', ('tim@example.com',), message,
+                          digest='comments')
+            # an explicit time wins
+            delivery.send('jim@example.com', ('guido@example.com',), message,
+                          digest='comments', send_after=1000000200)
+            # not part of a digest
+            delivery.send('jim@example.com', ('guido@example.com',), message)
+        transaction.commit()
+        self.assertEqual(
+            [md.msgs[0].send_after for md in maildirs],
+            [1000000300, 1000000300, 1000000400, 1000000200, None])
+        envelopes = [m.split(b'\n')[2]
+                     for m in MaildirWriterStub.commited_messages]
+        self.assertEqual(envelopes.count(b'X-Zope-Digest: comments'), 4)
+        with self.assertRaises(ValueError):
+            delivery.send('jim@example.com', ('guido@example.com',), message,
+                          digest='comments\nX-Zope-To: spam@example.com')
+
+
+@contextmanager
+def patched_time(module, now):
+    orig = module.time
+    module.time = lambda: now
+    try:
+        yield
+    finally:
+        module.time = orig
@@ -0,0 +1,77 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Digest tests
+"""
+import email
+import unittest
+
+from zope.sendmail import digest
+
+
+class TestDue(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(digest._dues.clear)
+
+    def test_window(self):
+        key = ('comments', 'foo@example.com', ('bar@example.com',))
+        self.assertEqual(digest.due('/queue', key, 60, 1000), 1060)
+        # the digest is open
+        self.assertEqual(digest.due('/queue', key, 60, 1059), 1060)
+        # other digests and queues have their own
+        self.assertEqual(
+            digest.due('/queue', ('likes',) + key[1:], 60, 1030), 1090)
+        self.assertEqual(digest.due('/other', key, 60, 1030), 1090)
+        # the next message after the digest was sent opens another one
+        self.assertEqual(digest.due('/queue', key, 60, 1060), 1120)
+        # closed digests are forgotten
+        self.assertEqual(len(digest._dues), 3)
+        digest.due('/queue', key, 60, 2000)
+        self.assertEqual(len(digest._dues), 1)
+
+
+class TestCombine(unittest.TestCase):
+
+    def test_combine(self):
+        messages = [
+            b'Message-Id: <1@example.com>\n'
+            b'From: Foo <foo@example.com>\n'
+            b'To: bar@example.com\n'
+            b'Subject: New comment\n\nFirst\n',
+            b'Message-Id: <2@example.com>\n'
+            b'From: Foo <foo@example.com>\n'
+            b'To: bar@example.com\n'
+            b'Subject: New comment\n\nSecond\n',
+        ]
+        combined = digest.combine('foo@example.com', ('bar@example.com',),
+                                  messages)
+        message = email.message_from_bytes(combined)
+        self.assertEqual(message.get_content_type(), 'multipart/digest')
+        self.assertEqual(message['From'], 'Foo <foo@example.com>')
+        self.assertEqual(message['To'], 'bar@example.com')
+        self.assertEqual(message['Subject'], 'New comment (2 messages)')
+        self.assertIsNotNone(message['Date'])
+        self.assertNotIn(message['Message-Id'],
+                         ('<1@example.com>', '<2@example.com>'))
+        parts = message.get_payload()
+        self.assertEqual(
+            [part.get_payload(0).get_payload() for part in parts],
+            ['First\n', 'Second\n'])
+
+    def test_no_subject(self):
+        combined = digest.combine('foo@example.com', ('bar@example.com',),
+                                  [b'\nFirst\n', b'\nSecond\n'])
+        message = email.message_from_bytes(combined)
+        self.assertEqual(message['Subject'], '2 messages')
+        self.assertIsNone(message['From'])
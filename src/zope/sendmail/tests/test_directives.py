@@ -15,6 +15,7 @@
 """
 import os
 import shutil
+import ssl
 import tempfile
 import unittest
 
@@ -25,9 +26,17 @@ from zope.interface import implementer
 
 import zope.sendmail.tests
 from zope.sendmail import delivery
+from zope.sendmail import digest
+from zope.sendmail import quota
 from zope.sendmail import zcml
+from zope.sendmail.interfaces import IBalancingMailer
+from zope.sendmail.interfaces import IHTTPMailer
+from zope.sendmail.interfaces import ILMTPMailer
 from zope.sendmail.interfaces import IMailDelivery
 from zope.sendmail.interfaces import IMailer
+from zope.sendmail.interfaces import IPickupDirectoryMailer
+from zope.sendmail.interfaces import IRoutingMailer
+from zope.sendmail.interfaces import ISendmailMailer
 from zope.sendmail.interfaces import ISMTPMailer
 
 
@@ -42,13 +51,20 @@ class Mailer:
 
 class MockQueueProcessorThread:
 
+    started = []
+
+    def __init__(self, interval=3.0, min_priority=None, max_interval=None):
+        self.interval = interval
+        self.min_priority = min_priority
+        self.max_interval = max_interval
+
     def setMailer(self, mailer):
         pass
 
     setQueuePath = setMailer
 
     def start(self):
-        pass
+        self.started.append(self)
 
 
 class DirectivesTest(PlacelessSetup, unittest.TestCase):
@@ -80,6 +96,7 @@ class DirectivesTest(PlacelessSetup, unittest.TestCase):
     def tearDown(self):
         delivery.Maildir = self.orig_maildir
         zcml.QueueProcessorThread = self.orig_quethread
+        del MockQueueProcessorThread.started[:]
 
         super().tearDown()
 
@@ -88,6 +105,78 @@ class DirectivesTest(PlacelessSetup, unittest.TestCase):
         self.assertEqual('QueuedMailDelivery', delivery.__class__.__name__)
         self.assertEqual(self.mailbox, delivery.queuePath)
 
+    def testQueuedDeliveryReservedPriority(self):
+        self.assertEqual(
+            [(t.min_priority, t.interval, t.max_interval)
+             for t in MockQueueProcessorThread.started],
+            [(None, 3, None)])
+        del MockQueueProcessorThread.started[:]
+        xmlconfig.string("""
+            <configure xmlns="http://namespaces.zope.org/zope"
+                       xmlns:mail="http://namespaces.zope.org/mail">
+              <include package="zope.sendmail" file="meta.zcml"/>
+              <mail:queuedDelivery
+                  name="Mail3"
+                  queuePath="%s"
+                  mailer="test.smtp"
+                  ttl="300"
+                  maxMessages="10000"
+                  maxTenantBytes="1000000"
+                  quotaTimeout="5"
+                  interval="1"
+                  maxInterval="60"
+                  maxConcurrency="4"
+                  latencyTarget="2.5"
+                  largeMessageSize="1000000"
+                  fairScheduling="true"
+                  tenantMaxInFlight="2"
+                  mergeWindow="1000"
+                  digestWindow="300"
+                  digestCombiner="zope.sendmail.digest.combine"
+                  digestMaxMessages="20"
+                  reservedPriority="10" />
+            </configure>
+            """ % self.mailbox)
+        self.assertEqual(
+            [(t.min_priority, t.interval, t.max_interval)
+             for t in MockQueueProcessorThread.started],
+            [(None, 1, 60), (10, 1, 60)])
+        self.assertEqual(
+            [(t.min_concurrency, t.max_concurrency, t.latency_target)
+             for t in MockQueueProcessorThread.started],
+            [(1, 4, 2.5), (1, 4, 2.5)])
+        self.assertEqual(
+            [(t.large_message_size, t.large_concurrency)
+             for t in MockQueueProcessorThread.started],
+            [(1000000, 1), (1000000, 1)])
+        self.assertEqual(
+            [(t.fair_scheduling, t.fair_quantum, t.tenant_max_in_flight)
+             for t in MockQueueProcessorThread.started],
+            [(True, 65536, 2), (True, 65536, 2)])
+        self.assertEqual(
+            [(t.merge_window, t.merge_max_recipients)
+             for t in MockQueueProcessorThread.started],
+            [(1000, 100), (1000, 100)])
+        self.assertEqual(
+            [(t.digest_combiner, t.digest_max_messages)
+             for t in MockQueueProcessorThread.started],
+            [(digest.combine, 20), (digest.combine, 20)])
+        delivery = zope.component.getUtility(IMailDelivery, "Mail3")
+        self.assertEqual(delivery.ttl, 300)
+        self.assertEqual(delivery.digest_window, 300)
+        self.assertEqual(delivery.quota.max_messages, 10000)
+        self.assertIsNone(delivery.quota.max_bytes)
+        self.assertEqual(delivery.quota.max_tenant_bytes, 1000000)
+        self.assertEqual(delivery.quota.timeout, 5)
+        # the queue is counted in the background right away
+        self.addCleanup(quota._usages.pop, os.path.realpath(self.mailbox))
+        usage = quota._usage(self.mailbox)
+        usage.thread.join(5)
+        self.assertEqual(usage.messages, 0)
+        self.assertIsNotNone(usage.scanned)
+        delivery = zope.component.getUtility(IMailDelivery, "Mail")
+        self.assertIsNone(delivery.quota)
+
     def testDirectDelivery(self):
         delivery = zope.component.getUtility(IMailDelivery, "Mail2")
         self.assertEqual('DirectMailDelivery', delivery.__class__.__name__)
@@ -97,6 +186,88 @@ class DirectivesTest(PlacelessSetup, unittest.TestCase):
         mailer = zope.component.getUtility(IMailer, "smtp")
         self.assertTrue(ISMTPMailer.providedBy(mailer))
 
+    def testSMTPMailerOptions(self):
+        mailer = zope.component.getUtility(IMailer, "smtp")
+        self.assertIsNone(mailer.pool)
+        self.assertIsNone(mailer.send_timeout)
+        self.assertFalse(mailer.implicit_tls)
+        mailer = zope.component.getUtility(IMailer, "smtp2")
+        self.assertTrue(mailer.implicit_tls)
+        self.assertFalse(mailer.no_tls)
+        self.assertEqual(mailer.pool.size, 4)
+        self.assertEqual(mailer.pool.idle_timeout, 30)
+        self.assertEqual(mailer.pool.max_messages, 100)
+        self.assertEqual(mailer.pool.timeout, 15)
+        self.assertEqual(mailer.connect_timeout, 10)
+        self.assertEqual(mailer.command_timeout, 30)
+        self.assertEqual(mailer.send_timeout, 120)
+        self.assertTrue(mailer.tls_verify)
+        self.assertEqual(mailer.ssl_context.minimum_version,
+                         ssl.TLSVersion.TLSv1_2)
+        self.assertEqual(mailer.address_cache.ttl, 300)
+        self.assertEqual(mailer.max_recipients, 100)
+
+    def testLMTPMailer(self):
+        mailer = zope.component.getUtility(IMailer, "lmtp")
+        self.assertTrue(ILMTPMailer.providedBy(mailer))
+        self.assertEqual(mailer.path, "/var/run/dovecot/lmtp")
+        self.assertTrue(mailer.lmtp)
+        self.assertEqual(mailer.pool.size, 2)
+        self.assertEqual(mailer.pool.timeout, 5)
+        self.assertEqual(mailer.command_timeout, 30)
+        mailer = zope.component.getUtility(IMailer, "postfix")
+        self.assertFalse(mailer.lmtp)
+        self.assertEqual(mailer.pool.size, 1)
+
+    def testSendmailMailer(self):
+        mailer = zope.component.getUtility(IMailer, "sendmail")
+        self.assertTrue(ISendmailMailer.providedBy(mailer))
+        self.assertEqual(mailer.command, "/usr/sbin/sendmail")
+        self.assertEqual(mailer.pool.size, 1)
+        self.assertEqual(mailer.pool.max_messages, 1000)
+        self.assertEqual(mailer.pool.timeout, 90)
+        self.assertEqual(mailer.send_timeout, 60)
+
+    def testPickupDirectoryMailer(self):
+        mailer = zope.component.getUtility(IMailer, "pickup")
+        self.assertTrue(IPickupDirectoryMailer.providedBy(mailer))
+        self.assertEqual(mailer.path, "/var/spool/pickup")
+        self.assertEqual(mailer.envelope, "x-sender")
+        self.assertEqual(mailer.batch_size, 50)
+        self.assertTrue(mailer.fsync)
+
+    def testHTTPMailer(self):
+        mailer = zope.component.getUtility(IMailer, "api")
+        self.assertTrue(IHTTPMailer.providedBy(mailer))
+        self.assertEqual(mailer.url, "https://api.example.com/v1/send")
+        self.assertEqual(mailer.batch_url, "https://api.example.com/v1/batch")
+        self.assertEqual(mailer.headers['Authorization'], "Bearer secret")
+        self.assertEqual(mailer.timeout, 30)
+        self.assertEqual(mailer.batch_size, 100)
+        self.assertEqual(mailer.pool_size, 2)
+        self.assertEqual(mailer.pool_idle_timeout, 60)
+
+    def testBalancingMailer(self):
+        mailer = zope.component.getUtility(IMailer, "balanced")
+        self.assertTrue(IBalancingMailer.providedBy(mailer))
+        self.assertEqual(mailer.mailers,
+                         (zope.component.getUtility(IMailer, "smtp"),
+                          zope.component.getUtility(IMailer, "smtp2")))
+        self.assertEqual(mailer.weights, (3, 1))
+        self.assertEqual(mailer.strategy, "least-outstanding")
+        self.assertEqual(mailer.max_failures, 3)
+        self.assertEqual(mailer.slow_threshold, 5)
+        self.assertEqual(mailer.retry_after, 30)
+
+    def testRoutingMailer(self):
+        mailer = zope.component.getUtility(IMailer, "routed")
+        self.assertTrue(IRoutingMailer.providedBy(mailer))
+        self.assertEqual(mailer.default, "smtp")
+        first, second = mailer.routes
+        self.assertEqual((first.mailer, first.domain), ("lmtp", "example.com"))
+        self.assertEqual((second.mailer, second.key, second.sender),
+                         ("api", "bulk", "@example.org"))
+
     def _check_zcml_without_registration(self, utility, name):
         gsm = zope.component.getGlobalSiteManager()
         gsm.unregisterUtility(utility, IMailer, name)
@@ -307,3 +307,136 @@ class TestMaildir(unittest.TestCase):
                          b'fe\xc3\xa8 fi\xc3\xa8 fo\xc3\xa8 fo\xc3\xb2')
         writer.close()
         self.assertTrue(writer._fd._closed)
+
+
+class TestMaildirPriorities(unittest.TestCase):
+
+    def setUp(self):
+        import shutil
+        import tempfile
+        self.path = os.path.join(tempfile.mkdtemp(), 'maildir')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.path))
+        self.maildir = Maildir(self.path, True)
+
+    def _add(self, priority, mtime):
+        writer = self.maildir.newMessage(priority)
+        writer.write(b'priority %d' % priority)
+        writer.commit()
+        os.utime(writer._new_filename, (mtime, mtime))
+        return writer._new_filename
+
+    def test_default_priority_in_maildir(self):
+        filename = self._add(0, 1000)
+        self.assertEqual(os.path.dirname(filename),
+                         os.path.join(self.path, 'new'))
+        self.assertEqual(self.maildir.priorities(), [0])
+        self.assertEqual(list(self.maildir), [filename])
+
+    def test_higher_priorities_first(self):
+        low = self._add(-5, 1000)
+        normal_new = self._add(0, 3000)
+        normal_old = self._add(0, 2000)
+        high = self._add(10, 4000)
+        self.assertEqual(self.maildir.priorities(), [10, 0, -5])
+        self.assertEqual(list(self.maildir),
+                         [high, normal_old, normal_new, low])
+        self.assertEqual(os.path.dirname(os.path.dirname(high)),
+                         os.path.join(self.path, '.priority+10'))
+
+    def test_messages_min_priority(self):
+        self._add(-5, 1000)
+        normal = self._add(0, 3000)
+        high = self._add(10, 4000)
+        self.assertEqual(list(self.maildir.messages(0)), [high, normal])
+        self.assertEqual(list(self.maildir.messages(1)), [high])
+        self.assertEqual(list(self.maildir.messages(11)), [])
+
+    def test_priorities_ignores_other_folders(self):
+        os.mkdir(os.path.join(self.path, '.priorityfoo'))
+        os.mkdir(os.path.join(self.path, '.priority+3'))
+        os.mkdir(os.path.join(self.path, '.Drafts'))
+        self.assertEqual(self.maildir.priorities(), [0])
+
+    def _age(self):
+        # make the folders look old, directory times are coarse
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            os.utime(dirpath, (1000, 1000))
+
+    def test_version(self):
+        self._age()
+        version = self.maildir.version()
+        self.assertEqual(self.maildir.version(), version)
+        self._add(0, 1000)
+        self.assertNotEqual(self.maildir.version(), version)
+        self._age()
+        version = self.maildir.version()
+        self._add(5, 1000)
+        self.assertNotEqual(self.maildir.version(), version)
+        self._age()
+        version = self.maildir.version()
+        self._add(5, 1000)
+        self.assertNotEqual(self.maildir.version(), version)
+
+
+class TestMaildirScheduled(unittest.TestCase):
+
+    def setUp(self):
+        import shutil
+        import tempfile
+        self.path = os.path.join(tempfile.mkdtemp(), 'maildir')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.path))
+        self.maildir = Maildir(self.path, True)
+
+    def _schedule(self, send_after, priority=0):
+        writer = self.maildir.newMessage(priority, send_after)
+        writer.write(b'scheduled')
+        writer.commit()
+        return writer._new_filename
+
+    def test_nothing_scheduled(self):
+        self.assertIsNone(self.maildir.scheduledVersion())
+        self.assertEqual(self.maildir.scheduled(), [])
+
+    def test_scheduled_not_listed(self):
+        later = self._schedule(2000000000, 5)
+        sooner = self._schedule(1900000000)
+        self.assertEqual(list(self.maildir), [])
+        self.assertEqual(self.maildir.scheduled(),
+                         [(1900000000, 0, sooner), (2000000000, 5, later)])
+        self.assertIsNotNone(self.maildir.scheduledVersion())
+
+    def test_release(self):
+        filename = self._schedule(1900000000, 5)
+        self.assertTrue(self.maildir.releaseScheduled(filename))
+        self.assertEqual(self.maildir.scheduled(), [])
+        messages = list(self.maildir)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(self.maildir.priorities(), [5, 0])
+        self.assertEqual(list(self.maildir.messages(5)), messages)
+        with open(messages[0], 'rb') as f:
+            self.assertEqual(f.read(), b'scheduled')
+        # it is gone now
+        self.assertFalse(self.maildir.releaseScheduled(filename))
+
+    def test_defer(self):
+        writer = self.maildir.newMessage(-5)
+        writer.write(b'deferred')
+        writer.commit()
+        filename, = self.maildir
+        scheduled = self.maildir.defer(filename, 1900000000)
+        self.assertEqual(list(self.maildir), [])
+        self.assertEqual(self.maildir.scheduled(),
+                         [(1900000000, -5, scheduled)])
+        # released into its lane under its old name
+        self.assertTrue(self.maildir.releaseScheduled(scheduled))
+        self.assertEqual(list(self.maildir), [filename])
+
+    def test_foreign_file(self):
+        filename = os.path.join(self.path, '.scheduled', 'new', 'foreign')
+        self._schedule(1900000000)
+        with open(filename, 'wb'):
+            pass
+        self.assertEqual(self.maildir.scheduled()[0], (0, 0, filename))
+        self.assertTrue(self.maildir.releaseScheduled(filename))
+        self.assertEqual(list(self.maildir),
+                         [os.path.join(self.path, 'new', 'foreign')])
@@ -14,14 +14,45 @@
 """Tests for mailers.
 """
 
+import base64
+import http.server
+import json
+import os
+import shutil
 import smtplib
+import socket
+import socketserver
+import ssl
+import stat
+import sys
+import tempfile
+import threading
+import time
 import unittest
 from functools import partial
 from ssl import SSLError
 
+import zope.component
+from zope.component.testing import PlacelessSetup
 from zope.interface.verify import verifyObject
 
+from zope.sendmail.interfaces import IBalancingMailer
+from zope.sendmail.interfaces import IHTTPMailer
+from zope.sendmail.interfaces import ILMTPMailer
+from zope.sendmail.interfaces import IMailer
+from zope.sendmail.interfaces import IPickupDirectoryMailer
+from zope.sendmail.interfaces import IRoutingMailer
+from zope.sendmail.interfaces import ISendmailMailer
 from zope.sendmail.interfaces import ISMTPMailer
+from zope.sendmail.mailer import BalancingMailer
+from zope.sendmail.mailer import HTTPMailer
+from zope.sendmail.mailer import HTTPMailerError
+from zope.sendmail.mailer import LMTPMailer
+from zope.sendmail.mailer import PickupDirectoryMailer
+from zope.sendmail.mailer import Route
+from zope.sendmail.mailer import RoutingMailer
+from zope.sendmail.mailer import SendmailMailer
+from zope.sendmail.mailer import SendTimeoutError
 from zope.sendmail.mailer import SMTPMailer
 
 
@@ -66,8 +97,14 @@ class SMTP:
         self.does_esmtp = True
         return (self.ehlo_code, self.ehlo_msg)
 
-    def starttls(self):
-        pass
+    def starttls(self, context=None):
+        self.tls_context = context
+
+    noop_code = 250
+
+    def noop(self):
+        assert not self.closed
+        return (self.noop_code, 'OK')
 
 
 class SMTPWithNoEHLO(SMTP):
@@ -259,30 +296,43 @@ class TestSMTPMailer(unittest.TestCase):
 
     def test_send_no_tls_forced(self):
         class Conn:
+            closed = False
+
             def has_extn(self, name):
                 assert name == 'starttls'
                 return False
 
+            def close(self):
+                self.closed = True
+
         self.mailer.force_tls = True
-        self.mailer.connection = Conn()
+        conn = self.mailer.connection = Conn()
 
         with self.assertRaisesRegex(RuntimeError,
                                     'TLS is not available'):
             self.mailer.send(None, None, None)
+        # the connection is not used again
+        self.assertTrue(conn.closed)
+        self.assertIsNone(self.mailer.connection)
 
     def test_send_no_esmtp_with_username(self):
         class Conn:
             does_esmtp = False
+            closed = False
 
             def has_extn(self, *args):
                 return False
 
-        self.mailer.connection = Conn()
+            def close(self):
+                self.closed = True
+
+        conn = self.mailer.connection = Conn()
         self.mailer.username = 'user'
         with self.assertRaisesRegex(
                 RuntimeError,
                 "Mailhost does not support ESMTP but a username"):
             self.mailer.send(None, None, None)
+        self.assertTrue(conn.closed)
 
     def test_mailer_implicit_tls(self):
         mailer = SMTPMailer(implicit_tls=True)
@@ -299,6 +349,1438 @@ class TestSMTPMailer(unittest.TestCase):
         SMTPMailer.smtp = None
 
 
+class TestSMTPMailerPooled(unittest.TestCase):
+
+    fromaddr = 'me@example.com'
+    toaddrs = ('you@example.com', 'him@example.com')
+    msgtext = 'Headers: headers\n\nbodybodybody\n-- \nsig\n'
+
+    def _makeMailer(self, **kw):
+        self.smtps = []
+        mailer = SMTPMailer(pool_size=kw.pop('pool_size', 2), **kw)
+
+        def _make_smtp(host, port):
+            smtp = SMTP(host, port)
+            self.smtps.append(smtp)
+            return smtp
+
+        mailer.smtp = _make_smtp
+        return mailer
+
+    def _send(self, mailer):
+        mailer.send(self.fromaddr, self.toaddrs, self.msgtext)
+
+    def test_interface(self):
+        verifyObject(ISMTPMailer, self._makeMailer())
+
+    def test_not_pooled_by_default(self):
+        self.assertIsNone(SMTPMailer().pool)
+
+    def test_reuse(self):
+        mailer = self._makeMailer(username='foo', password='evil')
+        self._send(mailer)
+        self._send(mailer)
+        self.assertEqual(len(self.smtps), 1)
+        smtp = self.smtps[0]
+        self.assertFalse(smtp.quitted)
+        self.assertEqual(smtp.username, 'foo')
+        self.assertIsNone(mailer.connection)
+
+        mailer.close()
+        self.assertTrue(smtp.quitted)
+
+    def test_max_messages(self):
+        mailer = self._makeMailer(pool_max_messages=2)
+        for _ in range(3):
+            self._send(mailer)
+        self.assertEqual(len(self.smtps), 2)
+        self.assertTrue(self.smtps[0].quitted)
+        self.assertFalse(self.smtps[1].quitted)
+
+    def test_idle_timeout(self):
+        mailer = self._makeMailer(pool_idle_timeout=-1)
+        self._send(mailer)
+        self._send(mailer)
+        self.assertEqual(len(self.smtps), 2)
+        self.assertTrue(self.smtps[0].quitted)
+
+    def test_noop_fails(self):
+        mailer = self._makeMailer()
+        self._send(mailer)
+        self.smtps[0].noop_code = 421
+        self._send(mailer)
+        self.assertEqual(len(self.smtps), 2)
+        self.assertTrue(self.smtps[0].closed)
+
+        def noop():
+            raise smtplib.SMTPServerDisconnected()
+
+        self.smtps[1].noop = noop
+        self._send(mailer)
+        self.assertEqual(len(self.smtps), 3)
+
+    def test_broken_connection_discarded(self):
+        mailer = self._makeMailer()
+        self._send(mailer)
+
+        def sendmail(*args):
+            raise smtplib.SMTPServerDisconnected()
+
+        self.smtps[0].sendmail = sendmail
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            self._send(mailer)
+        self.assertTrue(self.smtps[0].closed)
+        self._send(mailer)
+        self.assertEqual(len(self.smtps), 2)
+
+    def test_prepare_fails_unpooled(self):
+        mailer = self._makeMailer(pool_size=None, username='foo',
+                                  password='evil', force_tls=True)
+        make_smtp = mailer.smtp
+
+        def smtp(host, port):
+            connection = make_smtp(host, port)
+            if len(self.smtps) == 1:
+                def login(username, password):
+                    raise smtplib.SMTPAuthenticationError(
+                        454, b'Try again later')
+                connection.login = login
+            return connection
+
+        mailer.smtp = smtp
+        with self.assertRaises(smtplib.SMTPAuthenticationError):
+            self._send(mailer)
+        # the half prepared session is not used again
+        self.assertIsNone(mailer.connection)
+        self.assertTrue(self.smtps[0].closed)
+        self._send(mailer)
+        self.assertEqual(len(self.smtps), 2)
+        self.assertEqual(self.smtps[1].msgtext, self.msgtext)
+
+    def test_refused_message_keeps_connection(self):
+        mailer = self._makeMailer()
+        self._send(mailer)
+
+        def sendmail(*args):
+            raise smtplib.SMTPDataError(554, 'No thanks')
+
+        self.smtps[0].sendmail = sendmail
+        with self.assertRaises(smtplib.SMTPDataError):
+            self._send(mailer)
+        self.assertFalse(self.smtps[0].closed)
+        self.assertEqual(mailer.pool._messages, {self.smtps[0]: 1})
+
+    def _chunkedMailer(self, fail=None):
+        mailer = self._makeMailer(max_recipients=2)
+        self._send(mailer)
+        calls = []
+
+        def sendmail(fromaddr, toaddrs, message):
+            calls.append(toaddrs)
+            if fail is not None and len(calls) in fail:
+                raise fail[len(calls)]
+            return {}
+
+        self.smtps[0].sendmail = sendmail
+        return mailer, calls
+
+    def test_max_recipients(self):
+        mailer, calls = self._chunkedMailer()
+        toaddrs = ['%d@example.com' % i for i in range(5)]
+        refused = mailer.send(self.fromaddr, toaddrs, self.msgtext)
+        self.assertEqual(refused, {})
+        self.assertEqual(calls, [toaddrs[:2], toaddrs[2:4], toaddrs[4:]])
+        self.assertEqual(len(self.smtps), 1)
+        # fewer recipients are sent as they are
+        mailer.send(self.fromaddr, self.toaddrs, self.msgtext)
+        self.assertEqual(calls[-1], self.toaddrs)
+
+    def test_max_recipients_failed_chunk(self):
+        mailer, calls = self._chunkedMailer(fail={
+            2: smtplib.SMTPDataError(452, b'Too many recipients')})
+        toaddrs = ['%d@example.com' % i for i in range(5)]
+        refused = mailer.send(self.fromaddr, toaddrs, self.msgtext)
+        self.assertEqual(refused, {
+            '2@example.com': (452, b'Too many recipients'),
+            '3@example.com': (452, b'Too many recipients')})
+        self.assertEqual(len(calls), 3)
+        self.assertFalse(self.smtps[0].closed)
+
+    def test_max_recipients_refused_recipients(self):
+        mailer, calls = self._chunkedMailer(fail={
+            1: smtplib.SMTPRecipientsRefused({'0@example.com': (550, b'No')}),
+            2: smtplib.SMTPRecipientsRefused(
+                {'3@example.com': (450, b'Later')}),
+        })
+        toaddrs = ['%d@example.com' % i for i in range(4)]
+        with self.assertRaises(smtplib.SMTPRecipientsRefused) as exc:
+            mailer.send(self.fromaddr, toaddrs, self.msgtext)
+        self.assertEqual(exc.exception.recipients, {
+            '0@example.com': (550, b'No'), '3@example.com': (450, b'Later')})
+
+    def test_max_recipients_all_chunks_fail(self):
+        mailer, calls = self._chunkedMailer(fail={
+            1: smtplib.SMTPDataError(554, b'No thanks'),
+            2: smtplib.SMTPDataError(554, b'Nope')})
+        with self.assertRaises(smtplib.SMTPDataError) as exc:
+            mailer.send(self.fromaddr, ['a', 'b', 'c'], self.msgtext)
+        self.assertEqual(exc.exception.smtp_error, b'No thanks')
+
+    def test_max_recipients_disconnected(self):
+        mailer, calls = self._chunkedMailer(fail={
+            2: smtplib.SMTPServerDisconnected('Gone')})
+        toaddrs = ['%d@example.com' % i for i in range(6)]
+        refused = mailer.send(self.fromaddr, toaddrs, self.msgtext)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(sorted(refused), toaddrs[2:])
+        self.assertEqual(refused['2@example.com'], (451, b'Gone'))
+        self.assertEqual(refused['4@example.com'], (451, b'Not sent: Gone'))
+        # the broken connection is not reused
+        self.assertTrue(self.smtps[0].closed)
+        self._send(mailer)
+        self.assertEqual(len(self.smtps), 2)
+
+    def test_vote_abort(self):
+        mailer = self._makeMailer()
+        mailer.vote(self.fromaddr, self.toaddrs, self.msgtext)
+        connection = mailer.connection
+        # voting again (another message in the same transaction) keeps
+        # the connection
+        mailer.vote(self.fromaddr, self.toaddrs, self.msgtext)
+        self.assertIs(mailer.connection, connection)
+        mailer.abort()
+        self.assertIsNone(mailer.connection)
+        self.assertFalse(connection.closed)
+        self._send(mailer)
+        self.assertEqual(len(self.smtps), 1)
+
+    def test_prepare_fails(self):
+        mailer = self._makeMailer(force_tls=True)
+        make_smtp = mailer.smtp
+
+        def _make_smtp(host, port):
+            smtp = make_smtp(host, port)
+            smtp.has_extn = lambda ext: False
+            return smtp
+
+        mailer.smtp = _make_smtp
+        with self.assertRaisesRegex(RuntimeError, 'TLS is not available'):
+            self._send(mailer)
+        self.assertTrue(self.smtps[0].quitted)
+        self.assertEqual(mailer.pool._messages, {})
+
+    def test_connect_fails(self):
+        mailer = self._makeMailer(pool_size=1)
+
+        def fail(host, port):
+            raise OSError('Connection refused')
+
+        mailer.smtp = fail
+        with self.assertRaises(OSError):
+            self._send(mailer)
+        self.assertEqual(mailer.pool._opening, 0)
+
+    def test_bounded(self):
+
+        from zope.sendmail.mailer import SMTPConnectionPool
+        opened = []
+
+        def connect():
+            smtp = SMTP('localhost', '25')
+            opened.append(smtp)
+            return smtp
+
+        pool = SMTPConnectionPool(connect, 1)
+        first = pool.checkout()
+        got = []
+        thread = threading.Thread(target=lambda: got.append(pool.checkout()))
+        thread.start()
+        thread.join(0.1)
+        # the second checkout waits for the connection to be returned
+        self.assertTrue(thread.is_alive())
+        pool.checkin(first)
+        thread.join(10)
+        self.assertEqual(got, [first])
+        self.assertEqual(opened, [first])
+
+        # discarding frees the slot for a new connection
+        thread = threading.Thread(target=lambda: got.append(pool.checkout()))
+        thread.start()
+        pool.discard(first)
+        thread.join(10)
+        self.assertEqual(len(opened), 2)
+        self.assertIs(got[-1], opened[-1])
+
+    def test_checkout_timeout(self):
+        from zope.sendmail.mailer import PoolTimeoutError
+        from zope.sendmail.mailer import SMTPConnectionPool
+        pool = SMTPConnectionPool(lambda: SMTP('localhost', '25'), 1,
+                                  timeout=0.05)
+        first = pool.checkout()
+        start = time.monotonic()
+        with self.assertRaises(PoolTimeoutError):
+            pool.checkout()
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+        pool.checkin(first)
+        self.assertIs(pool.checkout(), first)
+
+    def test_vote_pool_timeout(self):
+        # a hung session does not block the other transactions for ever
+        from zope.sendmail.mailer import PoolTimeoutError
+        mailer = self._makeMailer(pool_size=1, pool_timeout=0.05)
+        mailer.vote(self.fromaddr, self.toaddrs, self.msgtext)
+        errors = []
+
+        def vote():
+            try:
+                mailer.vote(self.fromaddr, self.toaddrs, self.msgtext)
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=vote)
+        thread.start()
+        thread.join(10)
+        self.assertEqual([type(e) for e in errors], [PoolTimeoutError])
+        mailer.abort()
+
+
+class SocketStub:
+
+    timeout = 'default'
+
+    def __init__(self):
+        self.shut_down = threading.Event()
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def shutdown(self, how):
+        self.shut_down.set()
+
+
+class TestSMTPMailerTimeouts(unittest.TestCase):
+
+    def setUp(self):
+        threads = set(threading.enumerate())
+        # the watchdogs of the sends are gone when they return
+        self.addCleanup(lambda: self.assertEqual(
+            set(threading.enumerate()) - threads, set()))
+
+    def _makeMailer(self, **kw):
+        mailer = SMTPMailer(**kw)
+        self.opened = []
+
+        def _make_smtp(host, port, **kw):
+            smtp = SMTP(host, port)
+            smtp.kw = kw
+            smtp.sock = SocketStub()
+            self.opened.append(smtp)
+            return smtp
+
+        mailer.smtp = _make_smtp
+        return mailer
+
+    def test_no_timeouts_by_default(self):
+        mailer = self._makeMailer()
+        mailer.send('me@example.com', ('you@example.com',), 'text')
+        smtp = self.opened[0]
+        self.assertEqual(smtp.kw, {})
+        self.assertEqual(smtp.sock.timeout, 'default')
+
+    def test_connect_timeout(self):
+        mailer = self._makeMailer(connect_timeout=5)
+        mailer.send('me@example.com', ('you@example.com',), 'text')
+        smtp = self.opened[0]
+        self.assertEqual(smtp.kw, {'timeout': 5})
+        # the commands are not limited by the connect timeout
+        self.assertIsNone(smtp.sock.timeout)
+
+    def test_command_timeout(self):
+        mailer = self._makeMailer(connect_timeout=5, command_timeout=20)
+        mailer.send('me@example.com', ('you@example.com',), 'text')
+        smtp = self.opened[0]
+        self.assertEqual(smtp.kw, {'timeout': 5})
+        self.assertEqual(smtp.sock.timeout, 20)
+        self.assertEqual(smtp.timeout, 20)
+
+    def test_send_timeout(self):
+        mailer = self._makeMailer(send_timeout=0.05)
+        mailer.vote('me@example.com', ('you@example.com',), 'text')
+        smtp = self.opened[0]
+
+        def sendmail(fromaddr, toaddrs, message):
+            # a server that never answers; the watchdog shuts the
+            # socket down, which ends the wait
+            if not smtp.sock.shut_down.wait(10):
+                raise AssertionError('not shut down')
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly'
+                                                 ' closed')
+
+        smtp.sendmail = sendmail
+        with self.assertRaises(SendTimeoutError) as exc:
+            mailer.send('me@example.com', ('you@example.com',), 'text')
+        self.assertIsInstance(exc.exception.__cause__,
+                              smtplib.SMTPServerDisconnected)
+        self.assertTrue(smtp.closed)
+        self.assertFalse(smtp.quitted)
+        self.assertIsNone(mailer.connection)
+
+    def test_command_timeout_while_sending(self):
+        # the server may have got the message when the reply timed out
+        mailer = self._makeMailer(command_timeout=20)
+        mailer.vote('me@example.com', ('you@example.com',), 'text')
+        smtp = self.opened[0]
+
+        def sendmail(fromaddr, toaddrs, message):
+            raise TimeoutError('timed out')
+
+        smtp.sendmail = sendmail
+        with self.assertRaises(SendTimeoutError):
+            mailer.send('me@example.com', ('you@example.com',), 'text')
+        self.assertTrue(smtp.closed)
+        self.assertIsNone(mailer.connection)
+
+    def test_send_timeout_not_reached(self):
+        mailer = self._makeMailer(send_timeout=10)
+        mailer.send('me@example.com', ('you@example.com',), 'text')
+        smtp = self.opened[0]
+        self.assertTrue(smtp.quitted)
+        self.assertFalse(smtp.sock.shut_down.is_set())
+
+    def test_send_timeout_other_error(self):
+        mailer = self._makeMailer(send_timeout=10)
+        mailer.vote('me@example.com', ('you@example.com',), 'text')
+        smtp = self.opened[0]
+
+        def sendmail(fromaddr, toaddrs, message):
+            raise smtplib.SMTPDataError(554, 'Rejected')
+
+        smtp.sendmail = sendmail
+        with self.assertRaises(smtplib.SMTPDataError):
+            mailer.send('me@example.com', ('you@example.com',), 'text')
+
+
+class ContextStub:
+
+    check_hostname = False
+
+    def __init__(self):
+        self.wrapped = []
+
+    def wrap_socket(self, sock, server_hostname=None, session=None):
+        self.wrapped.append((sock, server_hostname, session))
+        return SSLSocketStub('session-%d' % len(self.wrapped))
+
+
+class SSLSocketStub:
+
+    def __init__(self, session):
+        self.session = session
+
+
+class TestSMTPMailerTLS(unittest.TestCase):
+
+    def test_default_context(self):
+        # like smtplib, the server certificate is not checked by default
+        mailer = SMTPMailer()
+        self.assertIsInstance(mailer.ssl_context, ssl.SSLContext)
+        self.assertEqual(mailer.ssl_context.verify_mode, ssl.CERT_NONE)
+        self.assertFalse(mailer.ssl_context.check_hostname)
+
+    def test_verify(self):
+        mailer = SMTPMailer(tls_verify=True, tls_minimum_version='TLSv1_2')
+        self.assertEqual(mailer.ssl_context.verify_mode, ssl.CERT_REQUIRED)
+        self.assertTrue(mailer.ssl_context.check_hostname)
+        self.assertEqual(mailer.ssl_context.minimum_version,
+                         ssl.TLSVersion.TLSv1_2)
+
+    def test_ca_file_not_found(self):
+        with self.assertRaises(OSError):
+            SMTPMailer(tls_ca_file='/this/file/does/not/exist.pem')
+
+    def test_custom_context(self):
+        context = ContextStub()
+        mailer = SMTPMailer(ssl_context=context)
+        self.assertIs(mailer.ssl_context, context)
+
+    def test_starttls_resumes_session(self):
+        context = ContextStub()
+        mailer = SMTPMailer(ssl_context=context)
+        opened = []
+
+        class TLSSMTP(SMTP):
+            def starttls(self, context=None):
+                self.sock = context.wrap_socket(
+                    'plain', server_hostname=self.hostname)
+
+        def _make_smtp(host, port):
+            smtp = TLSSMTP(host, port)
+            opened.append(smtp)
+            return smtp
+
+        mailer.smtp = _make_smtp
+        for _ in range(3):
+            mailer.send('me@example.com', ('you@example.com',), 'text')
+        self.assertEqual(len(opened), 3)
+        # one context for all connections, the first makes a full
+        # handshake, the others resume the previous session
+        self.assertEqual(context.wrapped,
+                         [('plain', 'localhost', None),
+                          ('plain', 'localhost', 'session-1'),
+                          ('plain', 'localhost', 'session-2')])
+
+    def test_implicit_tls_uses_context(self):
+        context = ContextStub()
+        mailer = SMTPMailer(implicit_tls=True, ssl_context=context)
+        contexts = []
+
+        def _make_smtp(host, port, context=None):
+            contexts.append(context)
+            smtp = SMTP(host, port)
+            smtp.sock = context.wrap_socket('plain', server_hostname=host)
+            return smtp
+
+        mailer.smtp = _make_smtp
+        mailer.send('me@example.com', ('you@example.com',), 'text')
+        mailer.send('me@example.com', ('you@example.com',), 'text')
+        self.assertEqual(contexts, [mailer._tls_context] * 2)
+        self.assertEqual([session for _, _, session in context.wrapped],
+                         [None, 'session-1'])
+
+
+class ResolverStub:
+
+    def __init__(self, *addresses):
+        self.addresses = list(addresses)
+        self.calls = []
+
+    def __call__(self, host, port, family=0, type=0):
+        self.calls.append((host, port))
+        return [(socket.AF_INET6 if ':' in address else socket.AF_INET,
+                 type, 6, '', (address, port))
+                for address in self.addresses]
+
+
+class UnconnectedSMTP(SMTP):
+
+    def __init__(self, refused, greetings, **kw):
+        self.hostname = self.port = None
+        self.quitted = False
+        self.closed = False
+        # addresses that refuse connections, and greetings of the others
+        self.refused = refused
+        self.greetings = greetings
+        self.kw = kw
+
+    def connect(self, host, port):
+        self.address = host
+        if host in self.refused:
+            raise ConnectionRefusedError(host)
+        self.port = port
+        return self.greetings.get(host, (220, 'Ready'))
+
+
+class TestSMTPMailerAddressCache(unittest.TestCase):
+
+    def _makeMailer(self, resolver, dns_cache_ttl=60, **kw):
+        mailer = SMTPMailer('smarthost', 2525, dns_cache_ttl=dns_cache_ttl,
+                            resolver=resolver, **kw)
+        self.opened = []
+        self.refused = set()
+        self.greetings = {}
+
+        def _make_smtp(**kw):
+            smtp = UnconnectedSMTP(self.refused, self.greetings, **kw)
+            self.opened.append(smtp)
+            return smtp
+
+        mailer.smtp = _make_smtp
+        return mailer
+
+    def _send(self, mailer):
+        mailer.send('me@example.com', ('you@example.com',), 'text')
+        return self.opened[-1]
+
+    def test_no_cache_by_default(self):
+        self.assertIsNone(SMTPMailer().address_cache)
+
+    def test_resolves_once(self):
+        resolver = ResolverStub('192.0.2.1')
+        mailer = self._makeMailer(resolver)
+        for _ in range(3):
+            smtp = self._send(mailer)
+            self.assertEqual(smtp.address, '192.0.2.1')
+            self.assertEqual(smtp.port, 2525)
+            # needed for TLS
+            self.assertEqual(smtp._host, 'smarthost')
+            self.assertTrue(smtp.quitted)
+        self.assertEqual(resolver.calls, [('smarthost', 2525)])
+
+    def test_ttl_expired(self):
+        resolver = ResolverStub('192.0.2.1')
+        mailer = self._makeMailer(resolver, dns_cache_ttl=0)
+        self._send(mailer)
+        resolver.addresses = ['192.0.2.2']
+        smtp = self._send(mailer)
+        self.assertEqual(len(resolver.calls), 2)
+        self.assertEqual(smtp.address, '192.0.2.2')
+
+    def test_rotates(self):
+        resolver = ResolverStub('192.0.2.1', '2001:db8::1', '192.0.2.1',
+                                '192.0.2.2')
+        mailer = self._makeMailer(resolver)
+        used = [self._send(mailer).address for _ in range(4)]
+        self.assertEqual(used, ['192.0.2.1', '2001:db8::1', '192.0.2.2',
+                                '192.0.2.1'])
+
+    def test_failover(self):
+        resolver = ResolverStub('192.0.2.1', '192.0.2.2', '192.0.2.3')
+        mailer = self._makeMailer(resolver)
+        self.refused.add('192.0.2.1')
+        self.greetings['192.0.2.2'] = (421, 'Too busy')
+        smtp = self._send(mailer)
+        self.assertEqual(smtp.address, '192.0.2.3')
+        self.assertEqual([s.address for s in self.opened],
+                         ['192.0.2.1', '192.0.2.2', '192.0.2.3'])
+        self.assertTrue(self.opened[0].closed)
+        self.assertTrue(self.opened[1].closed)
+
+    def test_no_address(self):
+        mailer = self._makeMailer(ResolverStub())
+        with self.assertRaises(OSError):
+            self._send(mailer)
+        self.assertEqual(self.opened, [])
+
+    def test_all_fail(self):
+        resolver = ResolverStub('192.0.2.1', '192.0.2.2')
+        mailer = self._makeMailer(resolver, connect_timeout=5)
+        self.refused.update(['192.0.2.1', '192.0.2.2'])
+        with self.assertRaises(ConnectionRefusedError):
+            self._send(mailer)
+        self.assertEqual(len(self.opened), 2)
+        self.assertEqual(self.opened[0].kw, {'timeout': 5})
+        # the addresses are resolved again next time
+        self.refused.clear()
+        self._send(mailer)
+        self.assertEqual(len(resolver.calls), 2)
+
+
+class FakeLMTPHandler(socketserver.StreamRequestHandler):
+    """A minimal LMTP (or SMTP) server talking over a UNIX socket.
+
+    The server's `rcpt_replies` and `data_replies` map recipients to the
+    replies to give instead of ``250``.
+    """
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        server.sessions += 1
+        self.reply('220 localhost ready')
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command = line.decode('ascii').strip()
+            verb = command[:4].upper()
+            server.commands.append(verb)
+            if verb in ('LHLO', 'EHLO'):
+                self.reply('250-localhost')
+                self.reply('250-STARTTLS')
+                self.reply('250 8BITMIME')
+            elif verb == 'HELO':
+                self.reply('250 localhost')
+            elif verb == 'MAIL':
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                recip = command.split(':', 1)[1].strip()[1:-1]
+                reply = server.rcpt_replies.get(recip, '250 OK')
+                if reply.startswith('250'):
+                    recipients.append(recip)
+                self.reply(reply)
+            elif verb == 'DATA':
+                self.reply('354 go ahead')
+                data = []
+                while True:
+                    line = self.rfile.readline()
+                    if line == b'.\r\n':
+                        break
+                    data.append(line)
+                server.messages.append(b''.join(data))
+                replies = [server.data_replies.get(r, '250 OK')
+                           for r in recipients]
+                if not server.lmtp:
+                    replies = replies[:1]
+                for reply in replies:
+                    self.reply(reply)
+            elif verb in ('NOOP', 'RSET'):
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 bye')
+                break
+            else:
+                self.reply('502 unknown command')
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'needs UNIX sockets')
+class TestLMTPMailer(unittest.TestCase):
+
+    lmtp = True
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'lmtp')
+        server = socketserver.ThreadingUnixStreamServer(
+            self.path, FakeLMTPHandler)
+        server.daemon_threads = True
+        server.lmtp = self.lmtp
+        server.sessions = 0
+        server.commands = []
+        server.messages = []
+        server.rcpt_replies = {}
+        server.data_replies = {}
+        self.server = server
+        thread = threading.Thread(target=server.serve_forever,
+                                  args=(0.01,))
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.mailer = LMTPMailer(self.path, lmtp=self.lmtp,
+                                 command_timeout=10)
+        self.addCleanup(self.mailer.close)
+
+    def test_interface(self):
+        verifyObject(ILMTPMailer, self.mailer)
+
+    def test_send(self):
+        refused = self.mailer.send(
+            'me@example.com', ('you@example.com', 'him@example.com'),
+            b'Subject: test\r\n\r\nbody\r\n')
+        self.assertEqual(refused, {})
+        self.assertEqual(self.server.messages,
+                         [b'Subject: test\r\n\r\nbody\r\n'])
+        greeting = 'LHLO' if self.lmtp else 'EHLO'
+        self.assertEqual(self.server.commands,
+                         [greeting, 'MAIL', 'RCPT', 'RCPT', 'DATA'])
+
+    def test_session_is_reused(self):
+        for i in range(3):
+            self.mailer.send('me@example.com', ('you@example.com',),
+                             b'Subject: %d\r\n\r\nbody\r\n' % i)
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertEqual(self.server.sessions, 1)
+        self.assertEqual(self.server.commands.count('STAR'), 0)
+
+    def test_per_recipient_status(self):
+        self.server.rcpt_replies['nobody@example.com'] = (
+            '550 5.1.1 No such user')
+        self.server.data_replies['you@example.com'] = (
+            '452 4.2.2 Mailbox full')
+        refused = self.mailer.send(
+            'me@example.com',
+            ('you@example.com', 'nobody@example.com', 'him@example.com'),
+            b'Subject: test\r\n\r\nbody\r\n')
+        self.assertEqual(refused, {
+            'nobody@example.com': (550, b'5.1.1 No such user'),
+            'you@example.com': (452, b'4.2.2 Mailbox full'),
+        })
+        # all replies were read, the session can be used for the next one
+        self.assertEqual(
+            self.mailer.send('me@example.com', ('him@example.com',),
+                             b'Subject: next\r\n\r\nbody\r\n'),
+            {})
+        self.assertEqual(self.server.sessions, 1)
+
+    def test_nobody_got_it(self):
+        self.server.data_replies['you@example.com'] = '550 5.7.1 Spam'
+        self.server.data_replies['him@example.com'] = (
+            '452 4.2.2 Mailbox full')
+        with self.assertRaises(smtplib.SMTPRecipientsRefused) as exc:
+            self.mailer.send(
+                'me@example.com', ('you@example.com', 'him@example.com'),
+                b'Subject: test\r\n\r\nbody\r\n')
+        # every recipient has its reply, so that the message is tried
+        # again for the transient failure only
+        self.assertEqual(exc.exception.recipients, {
+            'you@example.com': (550, b'5.7.1 Spam'),
+            'him@example.com': (452, b'4.2.2 Mailbox full'),
+        })
+        self.server.data_replies.clear()
+        self.mailer.send('me@example.com', ('him@example.com',), b'body')
+        self.assertEqual(self.server.sessions, 1)
+        self.assertIn('RSET', self.server.commands)
+
+
+class TestLMTPMailerSMTP(TestLMTPMailer):
+
+    lmtp = False
+
+    def test_per_recipient_status(self):
+        self.skipTest('SMTP has no per-recipient status after DATA')
+
+    test_nobody_got_it = test_per_recipient_status
+
+
+# answers the greeting and EHLO, then hangs
+HANGING_SENDMAIL = """
+import sys, time
+out = sys.stdout
+out.write('220 hello\\r\\n')
+out.flush()
+sys.stdin.readline()
+out.write('250 hello\\r\\n')
+out.flush()
+time.sleep(60)
+"""
+
+
+class TestSendmailMailer(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def _makeMailer(self, *args, **kw):
+        script = os.path.join(os.path.dirname(__file__), 'fake_sendmail.py')
+        mailer = SendmailMailer(
+            (sys.executable, script, self.directory) + args, **kw)
+        self.addCleanup(mailer.close)
+        return mailer
+
+    def _send(self, mailer, i=0):
+        mailer.send('me@example.com', ('you@example.com',),
+                    b'Subject: %d\r\n\r\nbody\r\n' % i)
+
+    def _counts(self):
+        # how many messages each process delivered, the most first
+        return sorted((len(m) for m in self._delivered()), reverse=True)
+
+    def _delivered(self):
+        # the messages delivered by each process
+        delivered = {}
+        for name in sorted(os.listdir(self.directory),
+                           key=lambda n: int(n.split('-')[1])):
+            pid = name.split('-')[0]
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                delivered.setdefault(pid, []).append(f.read())
+        return list(delivered.values())
+
+    def test_interface(self):
+        verifyObject(ISendmailMailer, SendmailMailer())
+
+    def test_one_process(self):
+        mailer = self._makeMailer()
+        for i in range(3):
+            self._send(mailer, i)
+        self.assertEqual(self._delivered(), [
+            [b'Subject: %d\r\n\r\nbody\r\n' % i for i in range(3)]])
+
+    def test_vote_abort(self):
+        mailer = self._makeMailer()
+        mailer.vote('me@example.com', ('you@example.com',), b'body')
+        process = mailer.connection.sock.process
+        mailer.abort()
+        self.assertIsNone(process.poll())
+        self._send(mailer)
+        self.assertEqual(len(self._delivered()), 1)
+        mailer.close()
+        self.assertEqual(process.wait(10), 0)
+
+    def test_restart_after_failure(self):
+        # the process exits after every other message
+        mailer = self._makeMailer('2')
+        for i in range(5):
+            self._send(mailer, i)
+        self.assertEqual(self._counts(), [2, 2, 1])
+
+    def test_max_messages(self):
+        mailer = self._makeMailer(pool_max_messages=3)
+        for i in range(4):
+            self._send(mailer, i)
+        self.assertEqual(self._counts(), [3, 1])
+
+    def test_send_timeout(self):
+        mailer = SendmailMailer((sys.executable, '-c', HANGING_SENDMAIL),
+                                send_timeout=0.2)
+        self.addCleanup(mailer.close)
+        with self.assertRaises(TimeoutError):
+            self._send(mailer)
+        self.assertIsNone(mailer.connection)
+
+    def test_no_such_program(self):
+        mailer = SendmailMailer(os.path.join(self.directory, 'sendmail'))
+        with self.assertRaises(FileNotFoundError):
+            self._send(mailer)
+
+
+class TestPickupDirectoryMailer(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.fsyncs = []
+        orig_fsync = os.fsync
+
+        def fsync(fd):
+            # whether a directory was synced
+            self.fsyncs.append(stat.S_ISDIR(os.fstat(fd).st_mode))
+            orig_fsync(fd)
+
+        os.fsync = fsync
+        self.addCleanup(setattr, os, 'fsync', orig_fsync)
+
+    def _files(self):
+        result = []
+        for name in sorted(os.listdir(self.path)):
+            with open(os.path.join(self.path, name), 'rb') as f:
+                result.append((name, f.read()))
+        return result
+
+    def test_interface(self):
+        verifyObject(IPickupDirectoryMailer, PickupDirectoryMailer(self.path))
+
+    def test_unknown_envelope(self):
+        with self.assertRaises(ValueError):
+            PickupDirectoryMailer(self.path, envelope='mbox')
+
+    def test_send(self):
+        mailer = PickupDirectoryMailer(self.path)
+        mailer.vote('me@example.com', ('you@example.com',), 'text')
+        mailer.send('me@example.com', ('you@example.com',),
+                    'Subject: \xc4\n\nbody\n')
+        mailer.abort()
+        (name, data), = self._files()
+        self.assertFalse(name.startswith('.'))
+        self.assertEqual(data, 'Subject: \xc4\n\nbody\n'.encode())
+        # the file and the directory
+        self.assertEqual(self.fsyncs, [False, True])
+
+    def test_envelope_x_sender(self):
+        mailer = PickupDirectoryMailer(self.path, envelope='x-sender')
+        mailer.send('me@example.com', ('you@example.com', 'him@example.com'),
+                    b'Subject: test\r\n\r\nbody\r\n')
+        (name, data), = self._files()
+        self.assertEqual(data,
+                         b'X-Sender: me@example.com\r\n'
+                         b'X-Receiver: you@example.com\r\n'
+                         b'X-Receiver: him@example.com\r\n'
+                         b'Subject: test\r\n\r\nbody\r\n')
+
+    def test_envelope_zope(self):
+        mailer = PickupDirectoryMailer(self.path, envelope='zope')
+        mailer.send('me@example.com', ('you@example.com', 'him@example.com'),
+                    b'Subject: test\n\nbody\n')
+        (name, data), = self._files()
+        self.assertEqual(data,
+                         b'X-Zope-From: me@example.com\n'
+                         b'X-Zope-To: you@example.com, him@example.com\n'
+                         b'Subject: test\n\nbody\n')
+
+    def test_no_fsync(self):
+        mailer = PickupDirectoryMailer(self.path, fsync=False)
+        mailer.send('me@example.com', ('you@example.com',), b'body')
+        self.assertEqual(len(self._files()), 1)
+        self.assertEqual(self.fsyncs, [])
+
+    def test_sendMany(self):
+        mailer = PickupDirectoryMailer(self.path)
+        results = mailer.sendMany([
+            ('me@example.com', ('you@example.com',), b'one'),
+            ('me@example.com', ('you@example.com',), None),
+            ('me@example.com', ('him@example.com',), b'two'),
+        ])
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], TypeError)
+        self.assertIsNone(results[2])
+        self.assertEqual(sorted(data for _, data in self._files()),
+                         [b'one', b'two'])
+        # one per file, but only one for the directory
+        self.assertEqual(self.fsyncs, [False, False, True])
+
+    def test_write_fails(self):
+        mailer = PickupDirectoryMailer(self.path)
+        with self.assertRaises(TypeError):
+            mailer.send('me@example.com', ('you@example.com',), None)
+        # nothing is left behind
+        self.assertEqual(self._files(), [])
+        self.assertEqual(self.fsyncs, [])
+
+    def test_vote_no_directory(self):
+        mailer = PickupDirectoryMailer(os.path.join(self.path, 'missing'))
+        with self.assertRaises(FileNotFoundError):
+            mailer.vote('me@example.com', ('you@example.com',), b'body')
+
+    @unittest.skipIf(hasattr(os, 'geteuid') and os.geteuid() == 0,
+                     'root can write anywhere')
+    def test_vote_not_writable(self):
+        os.chmod(self.path, 0o500)
+        self.addCleanup(os.chmod, self.path, 0o700)
+        mailer = PickupDirectoryMailer(self.path)
+        with self.assertRaises(PermissionError):
+            mailer.vote('me@example.com', ('you@example.com',), b'body')
+
+
+class FakeMailAPIHandler(http.server.BaseHTTPRequestHandler):
+    """A mail service API keeping its connections alive.
+
+    The server answers with the status in `statuses` for the recipient of
+    a message, 202 otherwise.  Batches are answered with a list of such
+    statuses.  A status of 0 closes the connection without an answer.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _status(self, message):
+        return self.server.statuses.get(message['to'][0], 202)
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        payload = json.loads(self.rfile.read(length))
+        server = self.server
+        server.requests.append(
+            (self.path, self.headers.get('Authorization'),
+             self.client_address))
+        if self.path == '/batch':
+            messages = payload['messages']
+            status = server.batch_status
+            body = json.dumps({'results': [
+                {'status': self._status(m), 'error': 'no'}
+                for m in messages]}).encode('ascii')
+        else:
+            messages = [payload]
+            status = self._status(payload)
+            body = b'{}'
+        if not status:
+            self.close_connection = True
+            return
+        if status < 300:
+            server.messages.extend(
+                (m['from'], m['to'], base64.b64decode(m['raw']))
+                for m in messages if self._status(m) < 300)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestHTTPMailer(unittest.TestCase):
+
+    def setUp(self):
+        server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), FakeMailAPIHandler)
+        server.daemon_threads = True
+        server.requests = []
+        server.messages = []
+        server.statuses = {}
+        server.batch_status = 200
+        self.server = server
+        thread = threading.Thread(target=server.serve_forever,
+                                  args=(0.01,))
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.base = 'http://127.0.0.1:%d' % server.server_address[1]
+        self.mailer = self._makeMailer()
+
+    def _makeMailer(self, **kw):
+        kw.setdefault('batch_url', self.base + '/batch')
+        mailer = HTTPMailer(self.base + '/send', api_key='secret',
+                            timeout=10, **kw)
+        self.addCleanup(mailer.close)
+        return mailer
+
+    def test_interface(self):
+        verifyObject(IHTTPMailer, self.mailer)
+
+    def test_send(self):
+        self.mailer.send('me@example.com', ('you@example.com',),
+                         'Subject: test\r\n\r\nbody\r\n')
+        self.assertEqual(self.server.messages, [
+            ('me@example.com', ['you@example.com'],
+             b'Subject: test\r\n\r\nbody\r\n')])
+        (path, auth, _), = self.server.requests
+        self.assertEqual(path, '/send')
+        self.assertEqual(auth, 'Bearer secret')
+
+    def test_connection_is_kept_alive(self):
+        for i in range(3):
+            self.mailer.send('me@example.com', ('you@example.com',),
+                             b'Subject: %d\r\n\r\nbody\r\n' % i)
+        self.assertEqual(len(self.server.messages), 3)
+        clients = {client for _, _, client in self.server.requests}
+        self.assertEqual(len(clients), 1)
+
+    def test_idle_timeout(self):
+        mailer = self._makeMailer(pool_idle_timeout=0)
+        for i in range(2):
+            mailer.send('me@example.com', ('you@example.com',), b'body')
+        clients = {client for _, _, client in self.server.requests}
+        self.assertEqual(len(clients), 2)
+
+    def test_closed_connection_is_replaced(self):
+        self.mailer.send('me@example.com', ('you@example.com',), b'1')
+        # the server closes the idle connection
+        (connection, _), = self.mailer._idle[('http', self.base[7:])]
+        connection.sock.shutdown(socket.SHUT_RDWR)
+        self.mailer.send('me@example.com', ('you@example.com',), b'2')
+        self.assertEqual([m for _, _, m in self.server.messages],
+                         [b'1', b'2'])
+
+    def test_connection_closed_after_request_is_not_retried(self):
+        self.mailer.send('me@example.com', ('you@example.com',), b'1')
+        # the server drops the connection after it read the request
+        self.server.statuses = {'you@example.com': 0}
+        with self.assertRaises(ConnectionResetError):
+            self.mailer.send('me@example.com', ('you@example.com',), b'2')
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_status_mapping(self):
+        self.server.statuses = {'busy@example.com': 429,
+                                'down@example.com': 503,
+                                'bad@example.com': 422}
+        with self.assertRaises(HTTPMailerError) as exc:
+            self.mailer.send('me@example.com', ('busy@example.com',), b'')
+        self.assertEqual(exc.exception.status, 429)
+        self.assertEqual(exc.exception.smtp_code, 451)
+        with self.assertRaises(HTTPMailerError) as exc:
+            self.mailer.send('me@example.com', ('down@example.com',), b'')
+        self.assertEqual(exc.exception.smtp_code, 451)
+        with self.assertRaises(HTTPMailerError) as exc:
+            self.mailer.send('me@example.com', ('bad@example.com',), b'')
+        self.assertEqual(exc.exception.status, 422)
+        self.assertEqual(exc.exception.smtp_code, 554)
+        self.assertEqual(HTTPMailerError(401).smtp_code, 421)
+        self.assertEqual(HTTPMailerError(404).smtp_code, 421)
+        self.assertEqual(HTTPMailerError(408).smtp_code, 451)
+
+    def test_sendMany(self):
+        self.server.statuses = {'bad@example.com': 400}
+        results = self.mailer.sendMany([
+            ('me@example.com', ('you@example.com',), b'1'),
+            ('me@example.com', ('bad@example.com',), b'2'),
+            ('me@example.com', ('him@example.com',), b'3'),
+        ])
+        self.assertIsNone(results[0])
+        self.assertEqual(results[1].smtp_code, 554)
+        self.assertIsNone(results[2])
+        self.assertEqual([m for _, _, m in self.server.messages],
+                         [b'1', b'3'])
+        self.assertEqual([path for path, _, _ in self.server.requests],
+                         ['/batch'])
+
+    def test_sendMany_batch_fails(self):
+        self.server.batch_status = 503
+        with self.assertRaises(HTTPMailerError) as exc:
+            self.mailer.sendMany([
+                ('me@example.com', ('you@example.com',), b'1')])
+        self.assertEqual(exc.exception.smtp_code, 451)
+
+    def test_sendMany_without_batch_url(self):
+        self.server.statuses = {'bad@example.com': 400}
+        mailer = self._makeMailer(batch_url=None)
+        results = mailer.sendMany([
+            ('me@example.com', ('you@example.com',), b'1'),
+            ('me@example.com', ('bad@example.com',), b'2'),
+        ])
+        self.assertIsNone(results[0])
+        self.assertEqual(results[1].status, 400)
+        self.assertEqual([path for path, _, _ in self.server.requests],
+                         ['/send', '/send'])
+
+    def test_batchResults(self):
+        self.assertEqual(self.mailer._batchResults(b'', 2), [None, None])
+        self.assertEqual(
+            self.mailer._batchResults(b'{"results": []}', 1), [None])
+
+    def test_connection_refused(self):
+        self.server.shutdown()
+        self.server.server_close()
+        with self.assertRaises(OSError):
+            self.mailer.send('me@example.com', ('you@example.com',), b'')
+
+
+class RelayStub:
+    """A mailer recording what it sends, failing with `error` if set."""
+
+    error = None
+    delay = 0
+
+    def __init__(self, name):
+        self.name = name
+        self.sent = []
+        self.log = []
+
+    def vote(self, fromaddr, toaddrs, message):
+        self.log.append('vote')
+        if self.error is not None:
+            raise self.error
+
+    def abort(self):
+        self.log.append('abort')
+
+    def send(self, fromaddr, toaddrs, message):
+        self.log.append('send')
+        if self.delay:
+            time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        self.sent.append(message)
+        return {}
+
+
+class TestBalancingMailer(unittest.TestCase):
+
+    def setUp(self):
+        self.a = RelayStub('a')
+        self.b = RelayStub('b')
+
+    def _makeMailer(self, **kw):
+        kw.setdefault('retry_after', 3600)
+        return BalancingMailer([self.a, self.b], **kw)
+
+    def _send(self, mailer, count=1):
+        for i in range(count):
+            mailer.send('me@example.com', ('you@example.com',), 'msg%d' % i)
+
+    def test_interface(self):
+        verifyObject(IBalancingMailer, self._makeMailer())
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            BalancingMailer([])
+        with self.assertRaises(ValueError):
+            BalancingMailer([self.a, self.b], weights=[1])
+        with self.assertRaises(ValueError):
+            BalancingMailer([self.a], weights=[0])
+        with self.assertRaises(ValueError):
+            BalancingMailer([self.a], strategy='random')
+
+    def test_weighted_round_robin(self):
+        mailer = self._makeMailer(weights=[2, 1])
+        self._send(mailer, 6)
+        self.assertEqual(len(self.a.sent), 4)
+        self.assertEqual(len(self.b.sent), 2)
+
+    def test_least_outstanding(self):
+        mailer = self._makeMailer(strategy='least-outstanding')
+        mailer._relays[0].outstanding = 1
+        self._send(mailer)
+        self.assertEqual(self.b.sent, ['msg0'])
+
+    def test_failover(self):
+        self.a.error = smtplib.SMTPServerDisconnected('gone')
+        mailer = self._makeMailer(max_failures=2)
+        self._send(mailer, 4)
+        self.assertEqual(len(self.b.sent), 4)
+        # a was taken out of rotation after two failures
+        self.assertEqual(self.a.log, ['send', 'send'])
+        self.assertIsNotNone(mailer._relays[0].down_until)
+
+    def test_permanent_error_is_raised(self):
+        self.a.error = smtplib.SMTPDataError(554, 'spam')
+        mailer = self._makeMailer(weights=[1, 1])
+        with self.assertRaises(smtplib.SMTPDataError):
+            self._send(mailer)
+        self.assertEqual(self.b.log, [])
+        self.assertEqual(mailer._relays[0].failures, 0)
+
+    def test_all_fail(self):
+        self.a.error = self.b.error = ConnectionRefusedError()
+        mailer = self._makeMailer(max_failures=1)
+        with self.assertRaises(ConnectionRefusedError):
+            self._send(mailer)
+        with self.assertRaises(ConnectionError) as exc:
+            self._send(mailer)
+        self.assertIn('out of rotation', str(exc.exception))
+
+    def test_slow_relay_is_taken_out(self):
+        self.a.delay = 0.02
+        mailer = self._makeMailer(max_failures=1, slow_threshold=0.01)
+        self._send(mailer, 3)
+        # the slow send still succeeded
+        self.assertEqual(self.a.sent, ['msg0'])
+        self.assertEqual(self.b.sent, ['msg1', 'msg2'])
+
+    def test_half_open_probe(self):
+        self.a.error = OSError()
+        mailer = self._makeMailer(max_failures=1, retry_after=0)
+        self._send(mailer)
+        self.assertEqual(self.b.sent, ['msg0'])
+        # the probe fails, b sends the message
+        self._send(mailer)
+        self.assertEqual(self.b.sent, ['msg0', 'msg0'])
+        self.assertIsNotNone(mailer._relays[0].down_until)
+        # the probe succeeds, a is back in rotation
+        self.a.error = None
+        self._send(mailer)
+        self.assertEqual(self.a.sent, ['msg0'])
+        self.assertIsNone(mailer._relays[0].down_until)
+
+    def test_vote_and_send_use_the_same_mailer(self):
+        mailer = self._makeMailer()
+        mailer.vote('me@example.com', ('you@example.com',), 'msg')
+        mailer.send('me@example.com', ('you@example.com',), 'msg')
+        self.assertEqual(self.a.log, ['vote', 'send'])
+        self.assertEqual(self.b.log, [])
+
+    def test_probes_after_vote(self):
+        # a relay that is listed for a probe but not called (because the
+        # relay that voted sends the message) stays due for a probe
+        c = RelayStub('c')
+        self.b.error = c.error = OSError()
+        mailer = BalancingMailer([self.a, self.b, c], max_failures=1,
+                                 retry_after=0)
+        self._send(mailer, 3)
+        self.assertIsNotNone(mailer._relays[1].down_until)
+        self.assertIsNotNone(mailer._relays[2].down_until)
+        self.b.error = c.error = None
+        for _ in range(20):
+            mailer.vote('me@example.com', ('you@example.com',), 'msg')
+            mailer.send('me@example.com', ('you@example.com',), 'msg')
+        self.assertEqual(
+            [(r.down_until, r.probing) for r in mailer._relays],
+            [(None, False)] * 3)
+        self.assertTrue(self.b.sent)
+        self.assertTrue(c.sent)
+
+    def test_probe_in_progress_is_skipped(self):
+        self.a.error = OSError()
+        mailer = self._makeMailer(max_failures=1, retry_after=0)
+        self._send(mailer)
+        # another message is probing a
+        mailer._relays[0].probing = True
+        self.a.error = None
+        self._send(mailer)
+        self.assertEqual(self.a.sent, [])
+        self.assertEqual(self.b.sent, ['msg0', 'msg0'])
+
+    def test_vote_failover_and_abort(self):
+        self.a.error = OSError()
+        mailer = self._makeMailer()
+        mailer.vote('me@example.com', ('you@example.com',), 'msg')
+        mailer.abort()
+        self.assertEqual(self.a.log, ['vote'])
+        self.assertEqual(self.b.log, ['vote', 'abort'])
+
+    def test_close(self):
+        closed = []
+        self.b.close = lambda: closed.append(True)
+        self._makeMailer().close()
+        self.assertEqual(closed, [True])
+
+
+class TestRoutingMailer(PlacelessSetup, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.internal = RelayStub('internal')
+        self.provider = RelayStub('provider')
+        gsm = zope.component.getGlobalSiteManager()
+        gsm.registerUtility(self.internal, IMailer, 'internal')
+        gsm.registerUtility(self.provider, IMailer, 'provider')
+        self.mailer = RoutingMailer([
+            Route('internal', domain='example.com'),
+            Route('provider', key='bulk'),
+            Route('internal', sender='@example.org'),
+        ], default='provider')
+
+    def _send(self, fromaddr, toaddrs, route=None):
+        return self.mailer.send(fromaddr, toaddrs, 'msg', route=route)
+
+    def test_interface(self):
+        verifyObject(IRoutingMailer, self.mailer)
+
+    def test_route_matches(self):
+        route = Route('m', domain='.Example.COM')
+        self.assertTrue(route.matches('', 'Bob <bob@example.com>'))
+        self.assertTrue(route.matches('', 'bob@mail.example.com'))
+        self.assertFalse(route.matches('', 'bob@badexample.com'))
+        route = Route('m', sender='Me@example.com', key='k')
+        self.assertTrue(route.matches('me@example.com', 'x@y', 'k'))
+        self.assertFalse(route.matches('me@example.com', 'x@y'))
+        self.assertFalse(route.matches('you@example.com', 'x@y', 'k'))
+        self.assertEqual(repr(route),
+                         "<Route sender='me@example.com' key='k' to 'm'>")
+
+    def test_split_by_domain(self):
+        refused = self._send('me@example.net',
+                             ('a@example.com', 'b@gmail.com', 'c@example.com'))
+        self.assertEqual(refused, {})
+        self.assertEqual(self.internal.log, ['send'])
+        self.assertEqual(self.provider.log, ['send'])
+
+    def test_rules_in_order(self):
+        # the domain rule comes before the routing key
+        self._send('me@example.org', ('a@example.com',), route='bulk')
+        self.assertEqual(self.internal.log, ['send'])
+        self._send('me@example.org', ('a@gmail.com',), route='bulk')
+        self.assertEqual(self.provider.log, ['send'])
+        # the sender rule
+        self._send('me@example.org', ('a@gmail.com',))
+        self.assertEqual(self.internal.log, ['send', 'send'])
+
+    def test_no_route(self):
+        self.mailer.default = None
+        with self.assertRaises(ValueError):
+            self._send('me@example.net', ('a@gmail.com',))
+
+    def test_single_route_error_is_raised(self):
+        self.internal.error = smtplib.SMTPDataError(451, 'later')
+        with self.assertRaises(smtplib.SMTPDataError):
+            self._send('me@example.net', ('a@example.com', 'b@example.com'))
+
+    def test_partial_failure_refuses_recipients(self):
+        self.internal.error = OSError('down')
+        refused = self._send('me@example.net',
+                             ('a@example.com', 'b@gmail.com'))
+        self.assertEqual(refused, {'a@example.com': (451, b'down')})
+        self.internal.error = smtplib.SMTPDataError(554, 'spam')
+        refused = self._send('me@example.net',
+                             ('a@example.com', 'b@gmail.com'))
+        self.assertEqual(refused, {'a@example.com': (554, b'spam')})
+
+    def test_partial_failure_recipients_refused(self):
+        # the replies of the server are kept, so that a recipient refused
+        # permanently is not tried again
+        self.internal.error = smtplib.SMTPRecipientsRefused({
+            'a@example.com': (550, b'No such user'),
+            'c@example.com': (450, b'Greylisted')})
+        refused = self._send('me@example.net',
+                             ('a@example.com', 'b@gmail.com', 'c@example.com'))
+        self.assertEqual(refused, {'a@example.com': (550, b'No such user'),
+                                   'c@example.com': (450, b'Greylisted')})
+        self.assertEqual(self.provider.sent, ['msg'])
+
+    def test_all_routes_fail(self):
+        self.internal.error = OSError('down')
+        self.provider.error = OSError('gone')
+        with self.assertRaises(OSError) as exc:
+            self._send('me@example.net', ('a@example.com', 'b@gmail.com'))
+        self.assertEqual(str(exc.exception), 'down')
+
+    def test_vote_and_abort(self):
+        self.mailer.vote('me@example.net', ('a@example.com', 'b@gmail.com'),
+                         'msg')
+        self.mailer.abort()
+        self.assertEqual(self.internal.log, ['vote', 'abort'])
+        self.assertEqual(self.provider.log, ['vote', 'abort'])
+        self.mailer.vote('me@example.net', ('a@example.com',), 'msg')
+        self.mailer.send('me@example.net', ('a@example.com',), 'msg')
+        self.mailer.abort()
+        self.assertEqual(self.internal.log, ['vote', 'abort', 'vote', 'send'])
+
+
 class TestSMTPMailerWithNoEHLO(TestSMTPMailer):
 
     SMTPClass = SMTPWithNoEHLO
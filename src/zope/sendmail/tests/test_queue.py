@@ -15,16 +15,25 @@
 
 Simple implementation of the MailDelivery, Mailers and MailEvents.
 """
+import collections
+import email
 import errno
 import io
 import os.path
 import shutil
+import ssl
 import sys
+import threading
+import time
 import unittest
 from contextlib import contextmanager
 from tempfile import mkdtemp
 
+from zope.interface import implementer
+
 from zope.sendmail import queue
+from zope.sendmail.interfaces import IBatchMailer
+from zope.sendmail.interfaces import IRoutingMailer
 from zope.sendmail.queue import ConsoleApp
 from zope.sendmail.tests.test_delivery import BizzarreMailError
 from zope.sendmail.tests.test_delivery import BrokenMailerStub
@@ -179,6 +188,20 @@ class TestQueueProcessorThread(unittest.TestCase):
         self.assertEqual(t, ('bar@example.com', 'baz@example.com'))
         self.assertEqual(m, msg)
 
+    def test_parseEnvelope(self):
+        hdr = (b'X-Zope-From: foo@example.com\n'
+               b'X-Zope-To: bar@example.com\n'
+               b'X-Zope-Expires: 1234\n')
+        msg = (b'X-Zope-Unknown: value\n'
+               b'\n'
+               b'Body\n')
+        f, t, o, m = self.thread._parseEnvelope(hdr + msg)
+        self.assertEqual(f, 'foo@example.com')
+        self.assertEqual(t, ('bar@example.com',))
+        self.assertEqual(o, {'expires': '1234'})
+        self.assertEqual(m, msg)
+        self.assertEqual(self.thread._parseMessage(hdr + msg), (f, t, m))
+
     def test_parseMessage_error(self):
         msg = b"bad message"
         f, t, m = self.thread._parseMessage(msg)
@@ -215,7 +238,57 @@ class TestQueueProcessorThread(unittest.TestCase):
 
         # File must remain were it was, so it will be retried
         self._assertMessagePathExists("message")
-        self._assertErrorLog()
+        self._assertEmptyErrorLog()
+        self.assertEqual(len(self.thread.log.warnings), 1)
+        # this maildir cannot defer it, so it is released for the next pass
+        self.assertFalse(os.path.exists(self.md.stub_getTmpFilename()))
+
+    def _assertReleasedOn(self, error):
+        class FailingMailerStub:
+            def send(self, fromaddr, toaddrs, message):
+                raise error
+
+        self.thread.setMailer(FailingMailerStub())
+        self.filename = self.md.stub_createFile('message')
+
+        self.thread.run(forever=False)
+
+        self._assertMessagePathExists("message")
+        self.assertFalse(os.path.exists(self.md.stub_getTmpFilename()))
+        self._assertErrorLog(exception_kind=type(error))
+
+    def test_timeout_is_transient(self):
+        self._assertReleasedOn(TimeoutError('timed out'))
+
+    def test_connection_error_is_transient(self):
+        self._assertReleasedOn(ConnectionRefusedError('refused'))
+
+    def test_disconnect_is_transient(self):
+        import smtplib
+        self._assertReleasedOn(smtplib.SMTPServerDisconnected('gone'))
+
+    def test_other_errors_keep_claim(self):
+        # we don't know whether the message was sent, so it is only
+        # retried after MAX_SEND_TIME
+        class FailingMailerStub:
+            def send(self, fromaddr, toaddrs, message):
+                raise RuntimeError('TLS is not available')
+
+        self.thread.setMailer(FailingMailerStub())
+        self.filename = self.md.stub_createFile('message')
+        self.thread.run(forever=False)
+        self._assertMessagePathExists("message")
+        self.assertTrue(os.path.exists(self.md.stub_getTmpFilename()))
+
+    def test_isTransient(self):
+        import smtplib
+
+        from zope.sendmail.queue import _isTransient
+        self.assertTrue(_isTransient(smtplib.SMTPDataError(421, 'busy')))
+        self.assertFalse(_isTransient(smtplib.SMTPDataError(554, 'no')))
+        self.assertFalse(_isTransient(smtplib.SMTPNotSupportedError()))
+        self.assertFalse(_isTransient(RuntimeError('TLS is required')))
+        self.assertTrue(_isTransient(OSError('network is unreachable')))
 
     def test_smtp_response_error_permanent(self):
         # Test a permanent error
@@ -251,6 +324,83 @@ class TestQueueProcessorThread(unittest.TestCase):
                          [('Email recipients refused: %s',
                            (self.md.STUB_DEFAULT_MESSAGE_RECPT[0],), {})])
 
+    def test_min_priority(self):
+        calls = []
+        test = self
+
+        class Maildir:
+            def __iter__(self):
+                raise AssertionError("Should not list all messages")
+
+            def messages(self, min_priority):
+                calls.append(min_priority)
+                return iter([test.md.stub_createFile()])
+
+        self.thread.min_priority = 5
+        self.thread.setMaildir(Maildir())
+        self.thread.run(forever=False)
+        self.assertEqual(calls, [5])
+        self.assertEqual(self.mailer.sent_messages,
+                         [self.md.STUB_DEFAULT_MESSAGE_SENT])
+
+    def _createExpiringFile(self, expires):
+        lines = WritableMaildirStub.STUB_DEFAULT_MESSAGE_LINES
+        return self.md.stub_createFile(
+            lines=lines[:2] + (b'X-Zope-Expires: %d\n' % expires,)
+            + lines[2:])
+
+    def test_expired(self):
+        self._createExpiringFile(time.time() - 1)
+        self.thread.setMailer(BrokenMailerStub())
+        self.thread.run(forever=False)
+
+        self._assertMessagePathDoesNotExist()
+        self._assertTmpMessagePathDoesNotExist()
+        self.assertTrue(os.path.exists(
+            os.path.join(self.dir, '.expired-message')))
+        self.assertEqual(self.thread.log.warnings,
+                         [('Discarding expired email from %s to %s',
+                           ('foo@example.com',
+                            'bar@example.com, baz@example.com'), {})])
+        self._assertEmptyErrorLog()
+
+    def test_expired_discard(self):
+        self._createExpiringFile(time.time() - 1)
+        self.thread.discard_expired = True
+        self.thread.run(forever=False)
+
+        self.assertEqual(os.listdir(self.dir), [])
+        self.assertEqual(self.mailer.sent_messages, [])
+
+    def test_not_expired(self):
+        self._createExpiringFile(time.time() + 3600)
+        self.thread.run(forever=False)
+
+        self.assertEqual(self.mailer.sent_messages,
+                         [self.md.STUB_DEFAULT_MESSAGE_SENT])
+        self.assertEqual(self.thread.log.warnings, [])
+
+    def test_expires_garbage(self):
+        self.assertFalse(self.thread._hasExpired({'expires': 'soon'}))
+
+    def test_route_is_passed_to_routing_mailer(self):
+        @implementer(IRoutingMailer)
+        class RoutingMailerStub(MailerStub):
+            def send(self, fromaddr, toaddrs, message, route=None):
+                self.routes.append(route)
+                MailerStub.send(self, fromaddr, toaddrs, message)
+
+        mailer = RoutingMailerStub()
+        mailer.routes = []
+        lines = WritableMaildirStub.STUB_DEFAULT_MESSAGE_LINES
+        self.md.stub_createFile(
+            lines=lines[:2] + (b'X-Zope-Route: bulk\n',) + lines[2:])
+        self.thread.setMailer(mailer)
+        self.thread.run(forever=False)
+        self.assertEqual(mailer.routes, ['bulk'])
+        self.assertEqual(mailer.sent_messages,
+                         [self.md.STUB_DEFAULT_MESSAGE_SENT])
+
     def test_stop_while_running(self):
         test = self
 
@@ -373,22 +523,1329 @@ class TestQueueProcessorThread(unittest.TestCase):
         self._assertEmptyErrorLog()
 
     def test_run_forever(self):
-        import time
-
         class DoneSleeping(Exception):
             pass
 
-        def sleep(i):
-            self.assertEqual(i, self.thread.interval)
+        def wait(timeout):
+            self.assertEqual(timeout, self.thread.interval)
             raise DoneSleeping()
 
-        with patched(time, 'sleep', sleep):
+        with patched(self.thread._wakeup, 'wait', wait):
             with self.assertRaises(DoneSleeping):
                 self.thread.run()
 
+    def test_stop_interrupts_wait(self):
+        import time
+        self.thread.interval = 3600
+        self.thread.start()
+        start = time.monotonic()
+        self.thread.stop()
+        self.thread.join(10)
+        self.assertFalse(self.thread.is_alive())
+        self.assertLess(time.monotonic() - start, 10)
+
+    def test_drain_stopped_thread(self):
+        self.thread.start()
+        self.assertTrue(self.thread.drain(10))
+        self.assertFalse(self.thread.is_alive())
+
+    def test_drain_before_send_releases_claim(self):
+        self.md.stub_createFile()
+        parse = self.thread._parseEnvelope
+
+        def parseEnvelope(message):
+            # we are asked to stop after claiming but before sending
+            self.thread._stopped = True
+            return parse(message)
+
+        self.thread._parseEnvelope = parseEnvelope
+        self.thread.run(forever=False)
+
+        self.assertEqual(self.mailer.sent_messages, [])
+        self._assertMessagePathExists()
+        self._assertTmpMessagePathDoesNotExist()
+        self.assertEqual(self.thread._claims, set())
+        self._assertEmptyErrorLog()
+
+    def test_drain_releases_claims_and_closes_mailer(self):
+        self.md.stub_createFile()
+        tmp_filename = self.md.stub_createTmpFile()
+        self.thread._claims.add(tmp_filename)
+        closed = []
+        self.mailer.close = lambda: closed.append(True)
+
+        self.assertTrue(self.thread.drain(0))
+
+        self._assertMessagePathExists()
+        self._assertTmpMessagePathDoesNotExist()
+        self.assertEqual(closed, [True])
+
+    def test_drain_timeout_while_sending(self):
+        # a message being sent keeps its claim
+        self.md.stub_createFile()
+        tmp_filename = self.md.stub_createTmpFile()
+        self.thread._lock.acquire()
+        self.addCleanup(self.thread._lock.release)
+
+        self.assertFalse(self.thread.drain(0))
+        self.assertTrue(os.path.exists(tmp_filename))
+
+    def test_drain_mailer_close_fails(self):
+        def close():
+            raise BizzarreMailError()
+
+        self.mailer.close = close
+        self.assertTrue(self.thread.drain())
+        self.assertEqual(self.thread.log.errors[0][0],
+                         "Error while closing the mailer")
+
+
+@implementer(IBatchMailer)
+class BatchMailerStub(MailerStub):
+
+    batch_size = 2
+
+    def __init__(self, errors=None):
+        super().__init__()
+        self.batches = []
+        # recipient -> exception to report for it
+        self.errors = errors or {}
+
+    def sendMany(self, messages):
+        self.batches.append(len(messages))
+        results = []
+        for fromaddr, toaddrs, message in messages:
+            error = self.errors.get(toaddrs[0])
+            if error is None:
+                self.sent_messages.append((fromaddr, toaddrs, message))
+            results.append(error)
+        return results
+
+
+class TestQueueProcessorBatches(unittest.TestCase):
+
+    def setUp(self):
+        from zope.sendmail.maildir import Maildir
+        self.dir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.maildir = Maildir(os.path.join(self.dir, 'queue'), True)
+        self.thread = queue.QueueProcessorThread()
+        self.thread.setMaildir(self.maildir)
+        self.thread.log = LoggerStub()
+
+    def _queue(self, *recipients):
+        for to in recipients:
+            writer = self.maildir.newMessage()
+            writer.write(b'X-Zope-From: foo@example.com\n'
+                         b'X-Zope-To: %s\n'
+                         b'Subject: test\n\nBody\n' % to.encode())
+            writer.commit()
+
+    def _files(self):
+        # all files in the queue, claims and rejected messages included
+        return sorted(
+            name for subdir in ('new', 'cur')
+            for name in os.listdir(os.path.join(self.maildir.path, subdir)))
+
+    def test_batches(self):
+        mailer = BatchMailerStub()
+        self.thread.setMailer(mailer)
+        self._queue('a@example.com', 'b@example.com', 'c@example.com',
+                    'd@example.com', 'e@example.com')
+        self.thread.run(forever=False)
+        # the last message is sent alone with ``send``
+        self.assertEqual(mailer.batches, [2, 2])
+        self.assertEqual(sorted(to for _, (to,), _ in mailer.sent_messages),
+                         ['a@example.com', 'b@example.com', 'c@example.com',
+                          'd@example.com', 'e@example.com'])
+        self.assertEqual(self._files(), [])
+        self.assertEqual(len(self.thread.log.infos), 5)
+
+    def test_single_message_uses_send(self):
+        mailer = BatchMailerStub()
+        self.thread.setMailer(mailer)
+        self._queue('a@example.com')
+        self.thread.run(forever=False)
+        self.assertEqual(mailer.batches, [])
+        self.assertEqual(len(mailer.sent_messages), 1)
+
+    def test_errors_per_message(self):
+        import smtplib
+        mailer = BatchMailerStub({
+            'a@example.com': smtplib.SMTPDataError(554, 'Rejected'),
+            'b@example.com': TimeoutError('timed out'),
+        })
+        mailer.batch_size = 10
+        self.thread.setMailer(mailer)
+        self._queue('a@example.com', 'b@example.com', 'c@example.com')
+        self.thread.run(forever=False)
+        self.assertEqual([to for _, (to,), _ in mailer.sent_messages],
+                         ['c@example.com'])
+        files = self._files()
+        # the rejected message is set aside, the other one is released
+        # for the next pass
+        self.assertEqual(len(files), 2)
+        self.assertEqual(len([f for f in files
+                              if f.startswith('.rejected-')]), 1)
+        self.assertEqual(len([f for f in files if not f.startswith('.')]),
+                         1)
+
+    def test_batch_fails(self):
+        mailer = BatchMailerStub()
+
+        def sendMany(messages):
+            raise ConnectionRefusedError('refused')
+
+        mailer.sendMany = sendMany
+        self.thread.setMailer(mailer)
+        self._queue('a@example.com', 'b@example.com')
+        self.thread.run(forever=False)
+        self.assertEqual(len(self._files()), 2)
+        self.assertFalse([f for f in self._files() if f.startswith('.')])
+        self.assertEqual(len(self.thread.log.errors), 2)
+
+    def test_stopped_before_sending(self):
+        mailer = BatchMailerStub()
+        self.thread.setMailer(mailer)
+        self._queue('a@example.com', 'b@example.com')
+        claims = [self.thread._claim(f) for f in self.maildir]
+        self.thread._stopped = True
+        self.thread._deliver(claims)
+        self.assertEqual(mailer.batches, [])
+        self.assertEqual(len(self._files()), 2)
+        self.assertFalse([f for f in self._files() if f.startswith('.')])
+
+
+class CountingMailerStub(MailerStub):
+
+    error = None
+
+    def __init__(self):
+        super().__init__()
+        self.attempts = 0
+
+    def send(self, fromaddr, toaddrs, message):
+        self.attempts += 1
+        if self.error is not None:
+            raise self.error
+        super().send(fromaddr, toaddrs, message)
+
+
+class TestQueueProcessorCircuitBreaker(unittest.TestCase):
+
+    setUp = TestQueueProcessorBatches.setUp
+    _queue = TestQueueProcessorBatches._queue
+    _files = TestQueueProcessorBatches._files
+
+    def _fill(self, count=10):
+        self._queue(*['%d@example.com' % i for i in range(count)])
+
+    def _outage(self):
+        self.mailer = CountingMailerStub()
+        self.mailer.error = ConnectionRefusedError('refused')
+        self.thread.setMailer(self.mailer)
+        self.thread.breaker_threshold = 3
+        self._fill()
+        self.thread.run(forever=False)
+
+    def _probeIsDue(self):
+        self.thread._open_until = time.monotonic() - 1
+
+    def test_pass_stops_after_threshold(self):
+        self._outage()
+        self.assertEqual(self.mailer.attempts, 3)
+        # nothing was lost or left claimed
+        self.assertEqual(len(self._files()), 10)
+        self.assertFalse([f for f in self._files() if f.startswith('.')])
+        errors = self.thread.log.errors
+        # two tracebacks and the summary
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(errors[2][0],
+                         'Cannot reach the mail server after %d attempts in'
+                         ' %d seconds (%s), pausing delivery for %d seconds.')
+        self.assertEqual(errors[2][1][0], 3)
+        self.assertEqual(errors[2][1][3], 30)
+
+        # nothing is attempted before the backoff is over
+        self.thread.run(forever=False)
+        self.assertEqual(self.mailer.attempts, 3)
+
+    def test_failed_probe_doubles_backoff(self):
+        self._outage()
+        for backoff in (60, 120):
+            self._probeIsDue()
+            self.thread.run(forever=False)
+            self.assertEqual(self.thread.log.errors[-1][1][3], backoff)
+        # a single message probes the server every time, without traceback
+        self.assertEqual(self.mailer.attempts, 5)
+        self.assertEqual(len(self.thread.log.errors), 5)
+        self.thread.breaker_max_backoff = 100
+        self._probeIsDue()
+        self.thread.run(forever=False)
+        self.assertEqual(self.thread.log.errors[-1][1][3], 100)
+
+    def test_successful_probe_resumes(self):
+        self._outage()
+        self.mailer.error = None
+        self._probeIsDue()
+        self.thread.run(forever=False)
+        self.assertEqual(len(self.mailer.sent_messages), 10)
+        self.assertEqual(self._files(), [])
+        self.assertIsNone(self.thread._open_until)
+        self.assertEqual(self.thread.log.infos[0][0],
+                         'The mail server can be reached again after %d'
+                         ' failed attempts in %d seconds.')
+
+    def test_success_resets_count(self):
+        self.thread.breaker_threshold = 2
+        self.thread._recordOutcome(ConnectionRefusedError())
+        self.thread._recordOutcome(None)
+        self.assertFalse(
+            self.thread._recordOutcome(ConnectionRefusedError()))
+        self.assertFalse(self.thread._breakerOpen())
+
+    def test_message_errors_do_not_count(self):
+        import smtplib
+        mailer = CountingMailerStub()
+        mailer.error = smtplib.SMTPDataError(450, 'mailbox busy')
+        self.thread.setMailer(mailer)
+        self.thread.breaker_threshold = 3
+        self._fill()
+        self.thread.run(forever=False)
+        self.assertEqual(mailer.attempts, 10)
+
+    def test_disabled(self):
+        mailer = CountingMailerStub()
+        mailer.error = ConnectionRefusedError('refused')
+        self.thread.setMailer(mailer)
+        self.thread.breaker_threshold = 0
+        self._fill()
+        self.thread.run(forever=False)
+        self.assertEqual(mailer.attempts, 10)
+        self.assertEqual(len(self.thread.log.errors), 10)
+
+    def test_isConnectionFailure(self):
+        import smtplib
+
+        from zope.sendmail.mailer import HTTPMailerError
+        from zope.sendmail.queue import _isConnectionFailure
+        self.assertTrue(_isConnectionFailure(TimeoutError()))
+        self.assertTrue(_isConnectionFailure(
+            smtplib.SMTPServerDisconnected('gone')))
+        self.assertTrue(_isConnectionFailure(
+            smtplib.SMTPConnectError(554, 'go away')))
+        self.assertTrue(_isConnectionFailure(
+            smtplib.SMTPDataError(421, 'closing')))
+        self.assertFalse(_isConnectionFailure(
+            smtplib.SMTPDataError(451, 'later')))
+        self.assertFalse(_isConnectionFailure(
+            smtplib.SMTPRecipientsRefused({})))
+        self.assertTrue(_isConnectionFailure(HTTPMailerError(401)))
+        self.assertFalse(_isConnectionFailure(HTTPMailerError(429)))
+
+
+class TestQueueProcessorPolling(unittest.TestCase):
+
+    setUp = TestQueueProcessorBatches.setUp
+    _queue = TestQueueProcessorBatches._queue
+
+    def _age(self):
+        # make the folders look old, directory times are coarse
+        for dirpath, dirnames, filenames in os.walk(self.maildir.path):
+            os.utime(dirpath, (1000, 1000))
+
+    def test_fixed_interval(self):
+        self.thread.interval = 2
+        self.assertEqual(self.thread._nextDelay(), 2)
+        self.thread._progress = 1
+        self.assertEqual(self.thread._nextDelay(), 2)
+        self.assertIsNone(self.thread._queueVersion())
+
+    def test_nextDelay(self):
+        self.thread.interval = 2
+        self.thread.max_interval = 10
+        self.assertEqual([self.thread._nextDelay() for i in range(4)],
+                         [2, 4, 8, 10])
+        self.thread._progress = 3
+        self.assertEqual(self.thread._nextDelay(), 0)
+        self.thread._progress = 0
+        self.assertEqual(self.thread._nextDelay(), 2)
+
+    def test_run_rescans_while_there_is_work(self):
+        self.thread.setMailer(MailerStub())
+        self.thread.interval = 2
+        self.thread.max_interval = 5
+        self._queue('a@example.com', 'b@example.com')
+        timeouts = []
+
+        def idle(timeout, version):
+            timeouts.append(timeout)
+            if len(timeouts) == 4:
+                self.thread._stopped = True
+
+        self.thread._idle = idle
+        self.thread.run()
+        self.assertEqual(timeouts, [0, 2, 4, 5])
+
+    def test_idle_snaps_back_on_new_messages(self):
+        self.thread.interval = 0.01
+        self.thread.max_interval = 60
+        self.thread._delay = 60
+        self._age()
+        version = self.thread._queueVersion()
+        timer = threading.Timer(0.05, self._queue, ('a@example.com',))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        start = time.monotonic()
+        self.thread._idle(60, version)
+        self.assertLess(time.monotonic() - start, 30)
+        self.assertEqual(self.thread._delay, 0)
+
+    def test_idle_without_changes(self):
+        self.thread.interval = 0.01
+        self.thread.max_interval = 60
+        self._age()
+        version = self.thread._queueVersion()
+        self.thread._idle(0.05, version)
+        self.assertEqual(self.thread._queueVersion(), version)
+
+    def test_idle_ignores_new_messages_while_breaker_is_open(self):
+        self.thread.interval = 0.01
+        self.thread.max_interval = 60
+        self._age()
+        version = self.thread._queueVersion()
+        self._queue('a@example.com')
+        self.thread._open_until = time.monotonic() + 60
+        start = time.monotonic()
+        self.thread._idle(0.05, version)
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+
+class SlowMailerStub(MailerStub):
+
+    def __init__(self, delay=0.05, error=None):
+        super().__init__()
+        self.delay = delay
+        self.error = error
+        self.in_flight = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def send(self, fromaddr, toaddrs, message):
+        with self._lock:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        try:
+            time.sleep(self.delay)
+            if self.error is not None:
+                raise self.error
+            super().send(fromaddr, toaddrs, message)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+class TestAdaptiveLimit(unittest.TestCase):
+
+    def _makeOne(self, *args, **kw):
+        from zope.sendmail.queue import _AdaptiveLimit
+        return _AdaptiveLimit(*args, **kw)
+
+    def test_additive_increase(self):
+        limit = self._makeOne(1, 4)
+        self.assertEqual(limit.limit, 1)
+        limit.observe(0.1)
+        self.assertEqual(limit.limit, 2)
+        # about one more per round of sends
+        limit.observe(0.1)
+        limit.observe(0.1)
+        self.assertEqual(limit.limit, 2)
+        limit.observe(0.1)
+        self.assertEqual(limit.limit, 3)
+        for i in range(20):
+            limit.observe(0.1)
+        self.assertEqual(limit.limit, 4)
+
+    def test_multiplicative_decrease(self):
+        limit = self._makeOne(2, 16)
+        limit.value = 16.0
+        limit.observe(0.1, throttled=True)
+        self.assertEqual(limit.limit, 8)
+        # the sends in flight with it report the same congestion
+        for i in range(8):
+            limit.observe(0.1, throttled=True)
+        self.assertEqual(limit.limit, 8)
+        limit.observe(0.1, throttled=True)
+        self.assertEqual(limit.limit, 4)
+        limit.value = 3.0
+        limit._holdoff = 0
+        limit.observe(0.1, throttled=True)
+        self.assertEqual(limit.limit, 2)
+
+    def test_latency_target(self):
+        limit = self._makeOne(1, 8, latency_target=1.0)
+        limit.value = 8.0
+        limit.observe(0.5)
+        self.assertEqual(limit.limit, 8)
+        limit.observe(2.0)
+        self.assertEqual(limit.limit, 4)
+
+    def test_isThrottling(self):
+        import smtplib
+
+        from zope.sendmail.queue import _isThrottling
+        self.assertTrue(_isThrottling(smtplib.SMTPDataError(421, 'busy')))
+        self.assertTrue(_isThrottling(smtplib.SMTPDataError(451, 'later')))
+        self.assertTrue(_isThrottling(TimeoutError()))
+        self.assertFalse(_isThrottling(smtplib.SMTPDataError(550, 'no')))
+        self.assertFalse(_isThrottling(ConnectionRefusedError()))
+
+
+class TestQueueProcessorConcurrency(unittest.TestCase):
+
+    setUp = TestQueueProcessorBatches.setUp
+    _queue = TestQueueProcessorBatches._queue
+    _files = TestQueueProcessorBatches._files
+
+    def _fill(self, count=12):
+        self._queue(*['%d@example.com' % i for i in range(count)])
+
+    def test_sequential_by_default(self):
+        mailer = SlowMailerStub(0.01)
+        self.thread.setMailer(mailer)
+        self._fill(4)
+        self.thread.run(forever=False)
+        self.assertEqual(mailer.peak, 1)
+        self.assertEqual(self.thread.concurrency, 1)
+        self.assertEqual(len(mailer.sent_messages), 4)
+
+    def test_concurrent_sends(self):
+        mailer = SlowMailerStub()
+        self.thread.setMailer(mailer)
+        self.thread.max_concurrency = 4
+        self._fill()
+        self.thread.run(forever=False)
+        self.assertEqual(len(mailer.sent_messages), 12)
+        self.assertEqual(self._files(), [])
+        self.assertGreater(mailer.peak, 1)
+        self.assertLessEqual(mailer.peak, 4)
+        self.assertEqual(self.thread.concurrency, 4)
+        self.assertEqual(self.thread.in_flight, 0)
+        self.assertEqual(len(self.thread.log.infos), 12)
+
+    def test_throttling_lowers_concurrency(self):
+        import smtplib
+        mailer = SlowMailerStub(0.01, smtplib.SMTPDataError(451, 'slow down'))
+        self.thread.setMailer(mailer)
+        self.thread.min_concurrency = 2
+        self.thread.max_concurrency = 8
+        self.thread.breaker_threshold = 0
+        self._makeLimiter(8)
+        self._fill(4)
+        self.thread.run(forever=False)
+        self.assertEqual(mailer.sent_messages, [])
+        self.assertLess(self.thread.concurrency, 8)
+        self.assertGreaterEqual(self.thread.concurrency, 2)
+        # the messages stay in the queue, to be tried again later
+        self.assertEqual(len(self.maildir.scheduled()), 4)
+
+    def test_slow_sends_lower_concurrency(self):
+        mailer = SlowMailerStub(0.02)
+        self.thread.setMailer(mailer)
+        self.thread.max_concurrency = 8
+        self.thread.latency_target = 0.01
+        self._makeLimiter(8)
+        self._fill(1)
+        self.thread.run(forever=False)
+        self.assertEqual(self.thread.concurrency, 4)
+
+    def _makeLimiter(self, value):
+        self.thread._makeExecutor().shutdown()
+        self.thread._limiter.value = float(value)
+
+    def test_limit_is_kept_between_passes(self):
+        self.thread.setMailer(SlowMailerStub(0))
+        self.thread.max_concurrency = 8
+        self._makeLimiter(5)
+        self.thread.run(forever=False)
+        self.assertEqual(self.thread.concurrency, 5)
+        self.thread.max_concurrency = 3
+        self.thread.run(forever=False)
+        self.assertEqual(self.thread.concurrency, 1)
+
+    def test_drain_waits_for_sends_in_flight(self):
+        mailer = SlowMailerStub(0.2)
+        self.thread.setMailer(mailer)
+        self.thread.max_concurrency = 4
+        self._makeLimiter(4)
+        self._fill(4)
+        self.thread.start()
+        deadline = time.monotonic() + 10
+        while not mailer.in_flight and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(self.thread.drain(10))
+        self.assertEqual(self.thread.in_flight, 0)
+        self.assertEqual(mailer.in_flight, 0)
+        # nothing is lost: a message was either sent or is still queued
+        self.assertEqual(len(mailer.sent_messages) + len(self._files()), 4)
+
+    def test_drain_timeout_while_sending_concurrently(self):
+        self.thread._inflight = 1
+        self.assertFalse(self.thread.drain(0))
+
+
+class LargeMailerStub(MailerStub):
+    """Takes its time with large messages, until it is told to go on."""
+
+    def __init__(self):
+        super().__init__()
+        self.go_on = threading.Event()
+        self.order = []
+
+    def send(self, fromaddr, toaddrs, message):
+        large = len(message) > 1000
+        if large:
+            self.go_on.wait(10)
+        super().send(fromaddr, toaddrs, message)
+        self.order.append(toaddrs[0])
+
+
+class TestQueueProcessorLargeMessages(unittest.TestCase):
+
+    setUp = TestQueueProcessorBatches.setUp
+    _queue = TestQueueProcessorBatches._queue
+    _files = TestQueueProcessorBatches._files
+
+    def _queueLarge(self, to):
+        writer = self.maildir.newMessage()
+        writer.write(b'X-Zope-From: foo@example.com\n'
+                     b'X-Zope-To: %s\n'
+                     b'Subject: large\n\n' % to.encode())
+        writer.write(b'x' * 5000 + b'\n')
+        writer.commit()
+
+    def test_small_messages_are_not_held_up(self):
+        mailer = LargeMailerStub()
+        self.thread.setMailer(mailer)
+        self.thread.large_message_size = 1000
+        self._queueLarge('large@example.com')
+        self._queue('a@example.com', 'b@example.com')
+        # the large message can only be sent after the small ones
+        send = mailer.send
+
+        def sendSmall(fromaddr, toaddrs, message):
+            send(fromaddr, toaddrs, message)
+            if toaddrs == ('b@example.com',):
+                mailer.go_on.set()
+
+        mailer.send = sendSmall
+        self.thread.run(forever=False)
+        self.assertEqual(mailer.order, ['a@example.com', 'b@example.com',
+                                        'large@example.com'])
+        self.assertEqual(self._files(), [])
+        self.assertEqual(self.thread.in_flight, 0)
+        self.assertIsNone(self.thread._largeExecutor)
+
+    def test_all_messages_alike_by_default(self):
+        mailer = LargeMailerStub()
+        mailer.go_on.set()
+        self.thread.setMailer(mailer)
+        self._queueLarge('large@example.com')
+        self._queue('a@example.com')
+        self.thread.run(forever=False)
+        self.assertEqual(mailer.order, ['large@example.com', 'a@example.com'])
+
+    def test_busy_large_lane(self):
+        mailer = LargeMailerStub()
+        self.thread.setMailer(mailer)
+        self.thread.large_message_size = 1000
+        self._queueLarge('large1@example.com')
+        self._queueLarge('large2@example.com')
+        self._queue('a@example.com')
+        self.thread._processQueue()
+        self.assertEqual(mailer.order, ['a@example.com'])
+        self.assertEqual(self.thread.large_in_flight, 1)
+        # the second large message was left alone for the next pass
+        self.assertEqual(len([name for name in self._files()
+                              if name.startswith('.sending-')]), 1)
+        self.assertEqual(len(self._files()), 3)
+        mailer.go_on.set()
+        self.thread._stopWorkers()
+        self.assertEqual(self.thread.large_in_flight, 0)
+        self.assertEqual(len(mailer.order), 2)
+        self.thread.run(forever=False)
+        self.assertEqual(len(mailer.order), 3)
+        self.assertEqual(self._files(), [])
+
+    def test_large_sends_do_not_count_as_congestion(self):
+        mailer = LargeMailerStub()
+        mailer.go_on.set()
+        self.thread.setMailer(mailer)
+        self.thread.large_message_size = 1000
+        self.thread.max_concurrency = 4
+        self.thread.latency_target = 0
+        self._queueLarge('large@example.com')
+        self.thread.run(forever=False)
+        self.assertEqual(mailer.order, ['large@example.com'])
+        self.assertEqual(self.thread.concurrency, 1)
+        self.assertEqual(self.thread._limiter._holdoff, 0)
+
+
+class TenantMailerStub(SlowMailerStub):
+    """Keeps track of the messages of each tenant in flight."""
+
+    def __init__(self, delay=0):
+        super().__init__(delay)
+        self.tenants = []
+        self.tenant_in_flight = collections.Counter()
+        self.tenant_peak = collections.Counter()
+
+    def send(self, fromaddr, toaddrs, message):
+        tenant = message.split(b'\n', 1)[0].decode()
+        with self._lock:
+            self.tenants.append(tenant)
+            self.tenant_in_flight[tenant] += 1
+            self.tenant_peak[tenant] = max(self.tenant_peak[tenant],
+                                           self.tenant_in_flight[tenant])
+        try:
+            super().send(fromaddr, toaddrs, message)
+        finally:
+            with self._lock:
+                self.tenant_in_flight[tenant] -= 1
+
+
+class TestQueueProcessorFairness(unittest.TestCase):
+
+    setUp = TestQueueProcessorBatches.setUp
+    _files = TestQueueProcessorBatches._files
+
+    def _queue(self, tenant, count=1, priority=0, sender=None):
+        for i in range(count):
+            writer = self.maildir.newMessage(priority)
+            writer.write(b'X-Zope-From: %s\n'
+                         b'X-Zope-To: to@example.com\n'
+                         % (sender or 'foo@example.com').encode())
+            if sender is None:
+                writer.write(b'X-Zope-Tenant: %s\n' % tenant.encode())
+            # the tenant is also the first line of the message
+            writer.write(b'%s\nSubject: test\n\nBody\n' % tenant.encode())
+            writer.commit()
+
+    def test_in_queue_order_by_default(self):
+        mailer = TenantMailerStub()
+        self.thread.setMailer(mailer)
+        self._queue('a', 3)
+        self._queue('b', 1)
+        self.thread.run(forever=False)
+        self.assertEqual(mailer.tenants, ['a', 'a', 'a', 'b'])
+
+    def test_round_robin(self):
+        mailer = TenantMailerStub()
+        self.thread.setMailer(mailer)
+        self.thread.fair_scheduling = True
+        self.thread.fair_quantum = 1
+        self._queue('a', 5)
+        self._queue('b', 2)
+        self._queue('c', 1)
+        self.thread.run(forever=False)
+        self.assertEqual(mailer.tenants,
+                         ['a', 'b', 'c', 'a', 'b', 'a', 'a', 'a'])
+        self.assertEqual(self._files(), [])
+        # the envelopes of sent messages are forgotten in the next pass
+        self.assertEqual(len(self.thread._heads), 8)
+        self.thread.run(forever=False)
+        self.assertEqual(self.thread._heads, {})
+
+    def test_quantum(self):
+        mailer = TenantMailerStub()
+        self.thread.setMailer(mailer)
+        self.thread.fair_scheduling = True
+        self._queue('a', 5)
+        self._queue('b', 2)
+        size = os.path.getsize(next(iter(self.maildir)))
+        # two messages per turn
+        self.thread.fair_quantum = size * 2
+        self.thread.run(forever=False)
+        self.assertEqual(mailer.tenants,
+                         ['a', 'a', 'b', 'b', 'a', 'a', 'a'])
+
+    def test_grouped_by_sender_without_tenant(self):
+        mailer = TenantMailerStub()
+        self.thread.setMailer(mailer)
+        self.thread.fair_scheduling = True
+        self.thread.fair_quantum = 1
+        self._queue('a', 3, sender='a@example.com')
+        self._queue('b', 1, sender='b@example.com')
+        self.thread.run(forever=False)
+        self.assertEqual(mailer.tenants, ['a', 'b', 'a', 'a'])
+
+    def test_priority_lanes_come_first(self):
+        mailer = TenantMailerStub()
+        self.thread.setMailer(mailer)
+        self.thread.fair_scheduling = True
+        self.thread.fair_quantum = 1
+        self._queue('a', 2)
+        self._queue('b', 2)
+        self._queue('urgent', 1, priority=5)
+        self.thread.run(forever=False)
+        self.assertEqual(mailer.tenants, ['urgent', 'a', 'b', 'a', 'b'])
+
+    def test_tenant_max_in_flight(self):
+        mailer = TenantMailerStub(0.05)
+        self.thread.setMailer(mailer)
+        self.thread.fair_scheduling = True
+        self.thread.max_concurrency = 4
+        self.thread.tenant_max_in_flight = 1
+        self.thread.tenant_limits = {'b': 2}
+        self.thread._makeExecutor().shutdown()
+        self.thread._limiter.value = 4.0
+        self._queue('a', 6)
+        self._queue('b', 4)
+        self.thread.run(forever=False)
+        self.assertEqual(len(mailer.tenants), 10)
+        self.assertEqual(self.thread._groupInflight, {})
+        self.assertEqual(mailer.tenant_peak['a'], 1)
+        self.assertEqual(mailer.tenant_peak['b'], 2)
+        self.assertLessEqual(mailer.peak, 3)
+
+
+class TestQueueProcessorMerging(unittest.TestCase):
+
+    setUp = TestQueueProcessorBatches.setUp
+    _files = TestQueueProcessorBatches._files
+
+    def _queue(self, *recipients, fromaddr='foo@example.com',
+               body=b'Body', route=None):
+        for i, to in enumerate(recipients):
+            writer = self.maildir.newMessage()
+            writer.write(b'X-Zope-From: %s\n'
+                         b'X-Zope-To: %s\n' % (fromaddr.encode(), to.encode()))
+            if route is not None:
+                writer.write(b'X-Zope-Route: %s\n' % route.encode())
+            writer.write(b'Message-Id: <%d.%s>\n'
+                         b'Subject: news\n\n%s\n' % (i, to.encode(), body))
+            writer.commit()
+
+    def _recipients(self, mailer):
+        return sorted(sorted(to) for _, to, _ in mailer.sent_messages)
+
+    def test_not_merged_by_default(self):
+        mailer = MailerStub()
+        self.thread.setMailer(mailer)
+        self._queue('a@example.com', 'b@example.com')
+        self.thread.run(forever=False)
+        self.assertEqual(len(mailer.sent_messages), 2)
+
+    def test_merge(self):
+        mailer = MailerStub()
+        self.thread.setMailer(mailer)
+        self.thread.merge_window = 100
+        self._queue('a@example.com', 'b@example.com', 'c@example.com')
+        self._queue('d@example.com', body=b'Other')
+        self._queue('e@example.com', fromaddr='bar@example.com')
+        self._queue('f@example.com', route='bulk')
+        self.thread.run(forever=False)
+        self.assertEqual(self._recipients(mailer), [
+            ['a@example.com', 'b@example.com', 'c@example.com'],
+            ['d@example.com'], ['e@example.com'], ['f@example.com']])
+        self.assertEqual(self._files(), [])
+        # every message is logged
+        self.assertEqual(len(self.thread.log.infos), 6)
+
+    def test_merge_max_recipients(self):
+        mailer = MailerStub()
+        self.thread.setMailer(mailer)
+        self.thread.merge_window = 100
+        self.thread.merge_max_recipients = 2
+        self._queue('a@example.com', 'b@example.com', 'c@example.com',
+                    'd@example.com', 'e@example.com')
+        self.thread.run(forever=False)
+        self.assertEqual(sorted(len(to) for _, to, _ in mailer.sent_messages),
+                         [1, 2, 2])
+        self.assertEqual(self._files(), [])
+
+    def test_merge_with_batch_mailer(self):
+        mailer = BatchMailerStub()
+        self.thread.setMailer(mailer)
+        self.thread.merge_window = 100
+        self._queue('a@example.com', 'b@example.com')
+        self._queue('c@example.com', body=b'Other')
+        self._queue('d@example.com', body=b'Third')
+        self.thread.run(forever=False)
+        self.assertEqual(mailer.batches, [2])
+        self.assertEqual(self._recipients(mailer), [
+            ['a@example.com', 'b@example.com'], ['c@example.com'],
+            ['d@example.com']])
+        self.assertEqual(self._files(), [])
+
+    def test_merge_window(self):
+        mailer = MailerStub()
+        self.thread.setMailer(mailer)
+        self.thread.merge_window = 2
+        self._queue('a@example.com', 'b@example.com', 'c@example.com')
+        self.thread.run(forever=False)
+        self.assertEqual(sorted(len(to) for _, to, _ in mailer.sent_messages),
+                         [1, 2])
+
+    def test_merged_permanent_failure(self):
+        self.thread.setMailer(SMTPResponseExceptionMailerStub(550))
+        self.thread.merge_window = 100
+        self._queue('a@example.com', 'b@example.com', 'c@example.com')
+        self.thread.run(forever=False)
+        files = self._files()
+        self.assertEqual(len(files), 3)
+        self.assertTrue(all(name.startswith('.rejected-') for name in files))
+
+    def test_merged_transient_failure(self):
+        mailer = CountingMailerStub()
+        mailer.error = ConnectionRefusedError('refused')
+        self.thread.setMailer(mailer)
+        self.thread.merge_window = 100
+        self.thread.breaker_threshold = 2
+        self._queue('a@example.com', 'b@example.com', 'c@example.com')
+        self.thread.run(forever=False)
+        self.assertEqual(mailer.attempts, 1)
+        # one attempt to reach the server, not three
+        self.assertEqual(self.thread._failures, 1)
+        self.assertFalse(self.thread._breakerOpen())
+        files = self._files()
+        self.assertEqual(len(files), 3)
+        self.assertFalse(any(name.startswith('.') for name in files))
+
+    def test_stopped_releases_window(self):
+        mailer = MailerStub()
+        self.thread.setMailer(mailer)
+        self.thread.merge_window = 100
+        self._queue('a@example.com', 'b@example.com')
+        claim = self.thread._claim
+
+        def stopping(filename):
+            self.thread._stopped = True
+            return claim(filename)
+
+        self.thread._claim = stopping
+        self.thread.run(forever=False)
+        self.assertEqual(mailer.sent_messages, [])
+        self.assertEqual(len(self._files()), 2)
+        self.assertEqual(self.thread._claims, set())
+
+
+class RefusingMailerStub(MailerStub):
+    """Refuses some recipients, like an SMTP server that accepted the
+    message for the others."""
+
+    def __init__(self, refused):
+        super().__init__()
+        self.refused = refused
+
+    def send(self, fromaddr, toaddrs, message):
+        super().send(fromaddr, toaddrs, message)
+        return {addr: reply for addr, reply in self.refused.items()
+                if addr in toaddrs}
+
+
+class TestQueueProcessorRefusedRecipients(unittest.TestCase):
+
+    setUp = TestQueueProcessorBatches.setUp
+    _files = TestQueueProcessorBatches._files
+    _queue = TestQueueProcessorMerging._queue
+
+    def _deferred(self):
+        # the message deferred by the last pass and when it is due
+        (due, priority, filename), = self.maildir.scheduled()
+        self.assertAlmostEqual(due, time.time() + 60, delta=5)
+        return filename
+
+    def test_requeue_refused_recipients(self):
+        mailer = RefusingMailerStub({
+            'b@example.com': (452, b'Too many recipients'),
+            'c@example.com': (550, b'No such user')})
+        self.thread.setMailer(mailer)
+        writer = self.maildir.newMessage()
+        writer.write(b'X-Zope-From: foo@example.com\n'
+                     b'X-Zope-To: a@example.com, b@example.com, '
+                     b'c@example.com\n'
+                     b'X-Zope-Route: bulk\n'
+                     b'X-Zope-Tenant: acme\n'
+                     b'Subject: news\n\nBody\n')
+        writer.commit()
+        filename, = self.maildir
+        self.thread.run(forever=False)
+        # the message stays queued for the recipient that was deferred,
+        # to be tried again later
+        with open(self._deferred(), 'rb') as f:
+            self.assertEqual(f.read(),
+                             b'X-Zope-From: foo@example.com\n'
+                             b'X-Zope-To: b@example.com\n'
+                             b'X-Zope-Route: bulk\n'
+                             b'X-Zope-Tenant: acme\n'
+                             b'X-Zope-Attempts: 1\n'
+                             b'Subject: news\n\nBody\n')
+        self.assertEqual(self.thread._progress, 0)
+        # and is set aside for the one that was refused
+        head, tail = os.path.split(filename)
+        self.assertEqual(self._files(), ['.rejected-' + tail])
+        with open(os.path.join(head, '.rejected-' + tail), 'rb') as f:
+            self.assertEqual(f.read().split(b'\n')[:2], [
+                b'X-Zope-From: foo@example.com',
+                b'X-Zope-To: c@example.com'])
+        self.assertEqual(self.thread.log.infos, [(
+            'Mail from %s to %s sent.',
+            ('foo@example.com', 'a@example.com'), {})])
+        self.assertEqual(self.thread.log.warnings, [(
+            'Mail from %s to %s deferred: %s',
+            ('foo@example.com', 'b@example.com', b'Too many recipients'),
+            {})])
+        self.assertEqual(self.thread.log.errors, [(
+            'Email recipients refused: %s', ('c@example.com',), {})])
+
+        mailer.refused = {}
+        self.thread.run(forever=False)
+        self.assertEqual(len(mailer.sent_messages), 1)
+        with patched(time, 'time', lambda: 2 ** 40):
+            self.thread.run(forever=False)
+        self.assertEqual(mailer.sent_messages[-1][1], ('b@example.com',))
+        self.assertEqual(self._files(), ['.rejected-' + tail])
+        self.assertEqual(self.maildir.scheduled(), [])
+
+    def test_retry_delay_doubles(self):
+        mailer = RefusingMailerStub({'a@example.com': (450, b'Later')})
+        self.thread.setMailer(mailer)
+        self.thread.retry_max_delay = 150
+        self._queue('a@example.com')
+        dues = []
+        now = time.time()
+        for i in range(4):
+            with patched(time, 'time', lambda: now):
+                self.thread.run(forever=False)
+            (due, priority, filename), = self.maildir.scheduled()
+            dues.append(due - int(now))
+            now = due
+        self.assertEqual(len(mailer.sent_messages), 4)
+        self.assertEqual(dues, [60, 120, 150, 150])
+        with open(filename, 'rb') as f:
+            self.assertIn(b'X-Zope-Attempts: 4\n', f.read())
+
+    def test_no_pause_without_progress(self):
+        # deferred recipients are not tried again right away, even when
+        # the processor polls quickly while it finds work
+        mailer = RefusingMailerStub({'b@example.com': (450, b'Later')})
+        self.thread.setMailer(mailer)
+        self.thread.interval = 0.01
+        self.thread.max_interval = 60
+        self._queue('a@example.com, b@example.com')
+        self.thread.start()
+        time.sleep(0.3)
+        self.thread.stop()
+        self.thread.join(5)
+        self.assertEqual(len(mailer.sent_messages), 1)
+        self.assertEqual(len(self.maildir.scheduled()), 1)
+
+    def test_message_deferred(self):
+        # a 4xx reply to this message does not concern the others, the
+        # circuit breaker leaves it alone
+        import smtplib
+        mailer = CountingMailerStub()
+        mailer.error = smtplib.SMTPDataError(452, 'Mailbox full')
+        self.thread.setMailer(mailer)
+        self._queue('a@example.com')
+        self.thread.run(forever=False)
+        self.thread.run(forever=False)
+        self.assertEqual(mailer.attempts, 1)
+        self.assertEqual(self._files(), [])
+        with open(self._deferred(), 'rb') as f:
+            self.assertIn(b'X-Zope-Attempts: 1\n', f.read())
+        self.assertEqual(self.thread.log.errors, [])
+        self.assertEqual(self.thread.log.warnings, [(
+            'Mail from %s to %s deferred: %s',
+            ('foo@example.com', 'a@example.com', mailer.error), {})])
+
+    def test_send_timeout_deferred(self):
+        # the server may have got the message, it is not sent again by
+        # the next pass
+        from zope.sendmail.mailer import SendTimeoutError
+        mailer = CountingMailerStub()
+        mailer.error = SendTimeoutError('timed out')
+        self.thread.setMailer(mailer)
+        self._queue('a@example.com')
+        self.thread.run(forever=False)
+        self.thread.run(forever=False)
+        self.assertEqual(mailer.attempts, 1)
+        self._deferred()
+
+    def test_connection_failure_released(self):
+        # the circuit breaker paces these
+        mailer = CountingMailerStub()
+        mailer.error = ConnectionRefusedError('refused')
+        self.thread.setMailer(mailer)
+        self._queue('a@example.com')
+        self.thread.run(forever=False)
+        self.thread.run(forever=False)
+        self.assertEqual(mailer.attempts, 2)
+        self.assertEqual(self.maildir.scheduled(), [])
+        self.assertEqual(len(self._files()), 1)
+
+    def test_all_recipients_refused(self):
+        # nobody got the message, but it is only tried again for the
+        # recipients refused temporarily
+        self.thread.setMailer(SMTPRecipientsRefusedMailerStub({
+            'a@example.com': (550, b'No such user'),
+            'b@example.com': (450, b'Greylisted')}))
+        writer = self.maildir.newMessage()
+        writer.write(b'X-Zope-From: foo@example.com\n'
+                     b'X-Zope-To: a@example.com, b@example.com\n'
+                     b'Subject: news\n\nBody\n')
+        writer.commit()
+        filename, = self.maildir
+        self.thread.run(forever=False)
+        head, tail = os.path.split(filename)
+        self.assertEqual(self._files(), ['.rejected-' + tail])
+        with open(self._deferred(), 'rb') as f:
+            self.assertEqual(f.read().split(b'\n')[1],
+                             b'X-Zope-To: b@example.com')
+        with open(os.path.join(head, '.rejected-' + tail), 'rb') as f:
+            self.assertEqual(f.read().split(b'\n')[1],
+                             b'X-Zope-To: a@example.com')
+        self.assertEqual(self.thread.log.infos, [])
+        self.assertEqual(len(self.thread.log.warnings), 1)
+
+    def test_all_recipients_refused_permanently(self):
+        self.thread.setMailer(SMTPRecipientsRefusedMailerStub({
+            'a@example.com': (550, b'No such user')}))
+        self._queue('a@example.com')
+        self.thread.run(forever=False)
+        files = self._files()
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].startswith('.rejected-'))
+
+    def test_merged_parts(self):
+        mailer = RefusingMailerStub({'b@example.com': (421, b'Busy')})
+        self.thread.setMailer(mailer)
+        self.thread.merge_window = 100
+        self._queue('a@example.com', 'b@example.com', 'c@example.com')
+        self.thread.run(forever=False)
+        self.assertEqual(len(mailer.sent_messages), 1)
+        with open(self._deferred(), 'rb') as f:
+            self.assertEqual(f.read().split(b'\n')[:4], [
+                b'X-Zope-From: foo@example.com',
+                b'X-Zope-To: b@example.com',
+                b'X-Zope-Attempts: 1',
+                b'Message-Id: <1.b@example.com>'])
+        self.assertEqual(len(self.thread.log.infos), 2)
+        self.assertEqual(len(self.thread.log.warnings), 1)
+
+
+class TestQueueProcessorDigests(unittest.TestCase):
+
+    setUp = TestQueueProcessorBatches.setUp
+    _files = TestQueueProcessorBatches._files
+
+    def _queue(self, to='a@example.com', subject=b'New comment',
+               digest=b'comments', route=None):
+        writer = self.maildir.newMessage()
+        writer.write(b'X-Zope-From: foo@example.com\n'
+                     b'X-Zope-To: %s\n' % to.encode())
+        if route is not None:
+            writer.write(b'X-Zope-Route: %s\n' % route.encode())
+        if digest is not None:
+            writer.write(b'X-Zope-Digest: %s\n' % digest)
+        writer.write(b'Subject: %s\n\nBody\n' % subject)
+        writer.commit()
+
+    def test_digest(self):
+        mailer = MailerStub()
+        self.thread.setMailer(mailer)
+        for _ in range(3):
+            self._queue()
+        self._queue(to='b@example.com')
+        self._queue(digest=b'likes')
+        self._queue(route='bulk')
+        self._queue(digest=None)
+        self.thread.run(forever=False)
+        self.assertEqual(len(mailer.sent_messages), 5)
+        digests = [m for _, _, m in mailer.sent_messages
+                   if b'multipart/digest' in m]
+        self.assertEqual(len(digests), 1)
+        message = email.message_from_bytes(digests[0])
+        self.assertEqual(message['Subject'], 'New comment (3 messages)')
+        self.assertEqual(len(message.get_payload()), 3)
+        self.assertEqual(self._files(), [])
+        # every message is logged
+        self.assertEqual(len(self.thread.log.infos), 7)
+
+    def test_combiner(self):
+        mailer = MailerStub()
+        self.thread.setMailer(mailer)
+        calls = []
+
+        def combiner(fromaddr, toaddrs, messages):
+            calls.append((fromaddr, toaddrs, messages))
+            return 'Subject: %d\n\n' % len(messages)
+
+        self.thread.digest_combiner = combiner
+        self._queue(subject=b'One')
+        self._queue(subject=b'Two')
+        self.thread.run(forever=False)
+        self.assertEqual(calls, [(
+            'foo@example.com', ('a@example.com',),
+            [b'Subject: One\n\nBody\n', b'Subject: Two\n\nBody\n'])])
+        self.assertEqual(mailer.sent_messages, [
+            ('foo@example.com', ('a@example.com',), b'Subject: 2\n\n')])
+
+    def test_combiner_fails(self):
+        mailer = MailerStub()
+        self.thread.setMailer(mailer)
+
+        def combiner(fromaddr, toaddrs, messages):
+            raise ValueError('cannot')
+
+        self.thread.digest_combiner = combiner
+        self._queue()
+        self._queue()
+        self.thread.run(forever=False)
+        # sent one by one
+        self.assertEqual(len(mailer.sent_messages), 2)
+        self.assertEqual(len(self.thread.log.errors), 1)
+        self.assertEqual(self._files(), [])
+
+    def test_max_messages(self):
+        mailer = MailerStub()
+        self.thread.setMailer(mailer)
+        self.thread.digest_max_messages = 2
+        for _ in range(5):
+            self._queue()
+        self.thread.run(forever=False)
+        self.assertEqual(len(mailer.sent_messages), 3)
+        self.assertEqual(self._files(), [])
+
+    def test_permanent_failure(self):
+        self.thread.setMailer(SMTPResponseExceptionMailerStub(550))
+        self._queue()
+        self._queue()
+        self.thread.run(forever=False)
+        files = self._files()
+        self.assertEqual(len(files), 2)
+        self.assertTrue(all(name.startswith('.rejected-') for name in files))
+
+
+class TestQueueProcessorScheduling(unittest.TestCase):
+
+    def setUp(self):
+        from zope.sendmail.maildir import Maildir
+        self.dir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.maildir = Maildir(os.path.join(self.dir, 'queue'), True)
+        self.thread = queue.QueueProcessorThread()
+        self.thread.setMaildir(self.maildir)
+        self.mailer = MailerStub()
+        self.thread.setMailer(self.mailer)
+        self.thread.log = LoggerStub()
+
+    def _schedule(self, send_after, priority=0):
+        writer = self.maildir.newMessage(priority, send_after)
+        writer.writelines(WritableMaildirStub.STUB_DEFAULT_MESSAGE_LINES)
+        writer.commit()
+
+    def test_not_due(self):
+        self._schedule(time.time() + 3600)
+        self.thread.run(forever=False)
+        self.assertEqual(self.mailer.sent_messages, [])
+        self.assertEqual(len(self.maildir.scheduled()), 1)
+
+    def test_due(self):
+        self._schedule(time.time() + 3600)
+        self.thread.run(forever=False)
+        with patched(time, 'time', lambda: 2 ** 40):
+            self.thread.run(forever=False)
+        self.assertEqual(self.mailer.sent_messages,
+                         [WritableMaildirStub.STUB_DEFAULT_MESSAGE_SENT])
+        self.assertEqual(self.maildir.scheduled(), [])
+        self.assertEqual(list(self.maildir), [])
+
+    def test_index_not_rebuilt_without_changes(self):
+        self._schedule(time.time() + 3600)
+        # the folder was changed long enough ago
+        new = os.path.join(self.maildir.path, '.scheduled', 'new')
+        os.utime(new, (time.time() - 60, time.time() - 60))
+        self.thread.run(forever=False)
+        calls = []
+        scheduled = self.maildir.scheduled
+
+        def counting():
+            calls.append(1)
+            return scheduled()
+
+        self.maildir.scheduled = counting
+        self.thread.run(forever=False)
+        self.assertEqual(calls, [])
+        # a new message changes the folder
+        self._schedule(time.time() + 7200)
+        self.thread.run(forever=False)
+        self.assertEqual(calls, [1])
+
+    def test_index_rebuilt_within_mtime_tick(self):
+        # a message renamed in right after the listing may not change the
+        # time of the folder
+        version = time.time_ns()
+        scheduled = []
+
+        class MaildirStub:
+            def scheduledVersion(self):
+                return version
+
+            def scheduled(self):
+                calls.append(1)
+                return list(scheduled)
+
+        calls = []
+        index = queue._ScheduleIndex(MaildirStub())
+        self.assertEqual(index.due(time.time()), ([], None))
+        scheduled.append((1, 0, '/queue/.scheduled/new/1.0.a'))
+        self.assertEqual(index.due(time.time()),
+                         (['/queue/.scheduled/new/1.0.a'], None))
+        self.assertEqual(calls, [1, 1])
+        # once the folder has settled, its time tells about all changes
+        version = time.time_ns() - 10 ** 10
+        index.due(time.time())
+        index.due(time.time())
+        self.assertEqual(calls, [1, 1, 1])
+
+    def test_min_priority(self):
+        self._schedule(1, priority=0)
+        self._schedule(1, priority=5)
+        self.thread.min_priority = 5
+        self.thread.run(forever=False)
+        self.assertEqual(len(self.mailer.sent_messages), 1)
+        self.assertEqual(len(self.maildir.scheduled()), 1)
+
+    def test_wait_until_due(self):
+        self._schedule(time.time() + 1)
+        waits = []
+
+        def wait(timeout):
+            waits.append(timeout)
+            self.thread._stopped = True
+
+        self.thread.interval = 3600
+        with patched(self.thread._wakeup, 'wait', wait):
+            self.thread.run()
+        self.assertLessEqual(waits[0], 1)
+
+    def test_release_error(self):
+        self._schedule(1)
+
+        def releaseScheduled(filename):
+            raise OSError(errno.EACCES, filename)
+
+        self.maildir.releaseScheduled = releaseScheduled
+        self.thread.run(forever=False)
+        self.assertEqual(self.thread.log.errors[0][0],
+                         "Error while releasing scheduled mail")
+
 
 test_ini = """[app:zope-sendmail]
 interval = 33
+max_interval = 300
 hostname = testhost
 port = 2525
 username = Chris
@@ -396,6 +1853,24 @@ password = Rossi
 force_tls = False
 no_tls = True
 queue_path = hammer/dont/hurt/em
+drain_timeout = 12
+min_priority = 10
+connect_timeout = 5
+send_timeout = 60
+tls_verify = True
+tls_minimum_version = TLSv1_2
+dns_cache_ttl = 120
+max_recipients = 50
+socket = /var/run/dovecot/lmtp
+breaker_threshold = 0
+breaker_backoff = 10
+max_concurrency = 6
+latency_target = 2.5
+large_message_size = 1000000
+fair_scheduling = yes
+tenant_max_in_flight = 20
+merge_window = 500
+digest_max_messages = 25
 """
 
 
@@ -432,12 +1907,28 @@ class TestConsoleApp(unittest.TestCase):
         self.assertEqual(self.dir, app.queue_path)
         self.assertFalse(app.daemon)
         self.assertEqual(3, app.interval)
+        self.assertIsNone(app.max_interval)
         self.assertEqual("localhost", app.hostname)
         self.assertEqual(25, app.port)
         self.assertEqual(None, app.username)
         self.assertEqual(None, app.password)
         self.assertFalse(app.force_tls)
         self.assertFalse(app.no_tls)
+        self.assertEqual(30, app.drain_timeout)
+        self.assertIsNone(app.min_priority)
+        self.assertEqual(5, app.breaker_threshold)
+        self.assertEqual(30, app.breaker_backoff)
+        self.assertEqual(1, app.min_concurrency)
+        self.assertEqual(1, app.max_concurrency)
+        self.assertIsNone(app.latency_target)
+        self.assertIsNone(app.large_message_size)
+        self.assertEqual(1, app.large_concurrency)
+        self.assertFalse(app.fair_scheduling)
+        self.assertEqual(65536, app.fair_quantum)
+        self.assertIsNone(app.tenant_max_in_flight)
+        self.assertIsNone(app.merge_window)
+        self.assertEqual(100, app.merge_max_recipients)
+        self.assertEqual(100, app.digest_max_messages)
 
     def test_args_processing_no_queue_path(self):
         # simplest case that doesn't work: no queue path specified
@@ -452,7 +1943,16 @@ class TestConsoleApp(unittest.TestCase):
         # use (almost) all of the options
         cmdline = (
             "zope-sendmail --daemon --interval 7 --hostname foo --port 75 "
-            "--username chris --password rossi --force-tls "
+            "--username chris --password rossi --force-tls --min-priority 3 "
+            "--connect-timeout 4 --command-timeout 5 --send-timeout 6 "
+            "--tls-verify --tls-minimum-version TLSv1_3 --dns-cache-ttl 30 "
+            "--max-recipients 100 "
+            "--breaker-threshold 10 --breaker-backoff 60 --max-interval 90 "
+            "--min-concurrency 2 --max-concurrency 8 --latency-target 1.5 "
+            "--large-message-size 500000 --large-concurrency 2 "
+            "--fair-scheduling --fair-quantum 4096 --tenant-max-in-flight 3 "
+            "--merge-window 1000 --merge-max-recipients 50 "
+            "--digest-max-messages 10 "
             "%s" % self.dir
         )
         app = self._make_one(cmdline)
@@ -466,6 +1966,29 @@ class TestConsoleApp(unittest.TestCase):
         self.assertEqual("rossi", app.password)
         self.assertTrue(app.force_tls)
         self.assertFalse(app.no_tls)
+        self.assertEqual(3, app.min_priority)
+        self.assertEqual(4, app.mailer.connect_timeout)
+        self.assertEqual(5, app.mailer.command_timeout)
+        self.assertEqual(6, app.mailer.send_timeout)
+        self.assertTrue(app.mailer.tls_verify)
+        self.assertEqual(ssl.TLSVersion.TLSv1_3,
+                         app.mailer.ssl_context.minimum_version)
+        self.assertEqual(30, app.mailer.address_cache.ttl)
+        self.assertEqual(100, app.mailer.max_recipients)
+        self.assertEqual(10, app.breaker_threshold)
+        self.assertEqual(60, app.breaker_backoff)
+        self.assertEqual(90, app.max_interval)
+        self.assertEqual(2, app.min_concurrency)
+        self.assertEqual(8, app.max_concurrency)
+        self.assertEqual(1.5, app.latency_target)
+        self.assertEqual(500000, app.large_message_size)
+        self.assertEqual(2, app.large_concurrency)
+        self.assertTrue(app.fair_scheduling)
+        self.assertEqual(4096, app.fair_quantum)
+        self.assertEqual(3, app.tenant_max_in_flight)
+        self.assertEqual(1000, app.merge_window)
+        self.assertEqual(50, app.merge_max_recipients)
+        self.assertEqual(10, app.digest_max_messages)
 
         # Add an extra argument
         cmdline += ' another-one'
@@ -474,6 +1997,27 @@ class TestConsoleApp(unittest.TestCase):
 
         self.assertIn('unrecognized argument', self._get_output())
 
+    def test_args_processing_socket(self):
+        cmdline = ("zope-sendmail --socket /var/spool/postfix/public/smtp "
+                   "--socket-protocol smtp --command-timeout 5 %s"
+                   % self.dir)
+        app = self._make_one(cmdline)
+        self.assertEqual('/var/spool/postfix/public/smtp', app.mailer.path)
+        self.assertFalse(app.mailer.lmtp)
+        self.assertEqual(5, app.mailer.command_timeout)
+
+        cmdline = "zope-sendmail --socket-protocol ftp %s" % self.dir
+        with self.assertRaises(SystemExit):
+            self._make_one(cmdline)
+        self.assertIn('invalid choice', self._get_output())
+
+    def test_args_processing_sendmail(self):
+        cmdline = ("zope-sendmail --sendmail /usr/lib/sendmail "
+                   "--send-timeout 5 %s" % self.dir)
+        app = self._make_one(cmdline)
+        self.assertEqual('/usr/lib/sendmail', app.mailer.command)
+        self.assertEqual(5, app.mailer.send_timeout)
+
     def test_args_processing_username_without_password(self):
         # test username without password
         cmdline = "zope-sendmail --username chris %s" % self.dir
@@ -511,6 +2055,32 @@ class TestConsoleApp(unittest.TestCase):
         self.assertEqual("Rossi", app.password)
         self.assertFalse(app.force_tls)
         self.assertTrue(app.no_tls)
+        self.assertEqual(12, app.drain_timeout)
+        self.assertEqual(10, app.min_priority)
+        self.assertEqual(5, app.connect_timeout)
+        self.assertIsNone(app.command_timeout)
+        self.assertEqual(60, app.send_timeout)
+        self.assertTrue(app.tls_verify)
+        self.assertIsNone(app.tls_ca_file)
+        self.assertEqual('TLSv1_2', app.tls_minimum_version)
+        self.assertEqual(120, app.dns_cache_ttl)
+        self.assertEqual(50, app.max_recipients)
+        self.assertEqual('/var/run/dovecot/lmtp', app.socket)
+        self.assertEqual('lmtp', app.socket_protocol)
+        self.assertEqual('/var/run/dovecot/lmtp', app.mailer.path)
+        self.assertTrue(app.mailer.lmtp)
+        self.assertEqual(60, app.mailer.send_timeout)
+        self.assertEqual(0, app.breaker_threshold)
+        self.assertEqual(10, app.breaker_backoff)
+        self.assertEqual(300, app.max_interval)
+        self.assertEqual(1, app.min_concurrency)
+        self.assertEqual(6, app.max_concurrency)
+        self.assertEqual(2.5, app.latency_target)
+        self.assertEqual(1000000, app.large_message_size)
+        self.assertTrue(app.fair_scheduling)
+        self.assertEqual(20, app.tenant_max_in_flight)
+        self.assertEqual(500, app.merge_window)
+        self.assertEqual(25, app.digest_max_messages)
         # override nothing, make sure defaults come through
         with open(ini_path, "w") as f:
             f.write("[app:zope-sendmail]\n\nqueue_path=foo\n")
@@ -565,6 +2135,88 @@ class TestConsoleApp(unittest.TestCase):
                 patched(ConsoleApp, 'MailerKind', MailerStub):
             queue.run(cmdline)
 
+    def test_run_daemon_drains_on_sigterm(self):
+        import signal
+        test = self
+
+        class QueueStub(MailerStub):
+            interval = None
+            drained = None
+            alive = True
+
+            def __init__(self, interval, min_priority):
+                pass
+
+            def setMailer(self, mailer):
+                pass
+
+            setQueuePath = setMailer
+
+            def start(self):
+                # simulate receiving SIGTERM once we are running
+                handler = signal.getsignal(signal.SIGTERM)
+                test.assertIsNot(handler, previous)
+                handler(signal.SIGTERM, None)
+
+            def is_alive(self):
+                return self.alive
+
+            def drain(self, timeout):
+                QueueStub.drained = timeout
+                self.alive = False
+
+        previous = signal.getsignal(signal.SIGTERM)
+        cmdline = ['sendmail', '--daemon', '--drain-timeout', '7', self.dir]
+        with patched(ConsoleApp, 'QueueProcessorKind', QueueStub), \
+                patched(ConsoleApp, 'MailerKind', MailerStub):
+            app = self._make_one(cmdline)
+            app.main()
+
+        self.assertEqual(QueueStub.drained, 7)
+        self.assertIs(signal.getsignal(signal.SIGTERM), previous)
+
+    @unittest.skipUnless(hasattr(os, 'kill'), 'needs signals')
+    def test_run_daemon_exits_with_hung_send(self):
+        # the drain deadline holds at exit, too, even if the send that is
+        # in progress never returns
+        import signal
+        import subprocess
+
+        from zope.sendmail.maildir import Maildir
+        path = os.path.join(self.dir, 'queue')
+        writer = Maildir(path, True).newMessage()
+        writer.write(b'X-Zope-From: foo@example.com\n'
+                     b'X-Zope-To: bar@example.com\n'
+                     b'Subject: test\n\nBody\n')
+        writer.commit()
+        sending = os.path.join(self.dir, 'sending')
+        script = """if 1:
+            import sys, threading
+            from zope.sendmail import queue
+
+            class HungMailer:
+                def __init__(self, *args, **kw):
+                    pass
+                def send(self, fromaddr, toaddrs, message):
+                    open(sys.argv[1], 'w').close()
+                    threading.Event().wait()
+
+            queue.ConsoleApp.MailerKind = HungMailer
+            queue.run(['zope-sendmail', '--daemon', '--interval', '0.1',
+                       '--drain-timeout', '1', sys.argv[2]])
+        """
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        process = subprocess.Popen(
+            [sys.executable, '-c', script, sending, path], env=env)
+        self.addCleanup(process.kill)
+        deadline = time.monotonic() + 30
+        while not os.path.exists(sending):
+            self.assertIsNone(process.poll())
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+        process.send_signal(signal.SIGTERM)
+        self.assertEqual(process.wait(30), 0)
+
     def test_help(self):
         cmdline = ['prog', '--help']
 
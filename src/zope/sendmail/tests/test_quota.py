@@ -0,0 +1,310 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Queue quota tests
+"""
+import os
+import shutil
+import threading
+import time
+import unittest
+from tempfile import mkdtemp
+
+import transaction
+from zope.interface.verify import verifyObject
+
+from zope.sendmail import quota
+from zope.sendmail.delivery import QueuedMailDelivery
+from zope.sendmail.interfaces import IQueueQuota
+from zope.sendmail.maildir import Maildir
+from zope.sendmail.queue import QueueProcessorThread
+from zope.sendmail.quota import QueueFullError
+from zope.sendmail.quota import QueueQuota
+from zope.sendmail.tests.test_delivery import LoggerStub
+from zope.sendmail.tests.test_delivery import MailerStub
+
+
+class TestQueueQuota(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'queue')
+        self.maildir = Maildir(self.path, True)
+        self.addCleanup(quota._usages.pop, os.path.realpath(self.path), None)
+
+    def _queue(self, fromaddr='foo@example.com', tenant=None, body=b'Body'):
+        writer = self.maildir.newMessage()
+        writer.write(b'X-Zope-From: %s\n' % fromaddr.encode())
+        writer.write(b'X-Zope-To: bar@example.com\n')
+        if tenant is not None:
+            writer.write(b'X-Zope-Tenant: %s\n' % tenant.encode())
+        writer.write(b'Subject: test\n\n%s\n' % body)
+        writer.commit()
+        return writer._new_filename
+
+    def test_interface(self):
+        verifyObject(IQueueQuota, QueueQuota())
+
+    def test_counts_the_queue_once(self):
+        self._queue()
+        self._queue(tenant='acme')
+        limits = QueueQuota(max_messages=3)
+        limits.reserve(self.path, 'foo@example.com', 10)
+        usage = quota._usage(self.path)
+        self.assertEqual(usage.messages, 3)
+        self.assertEqual(usage.group_messages,
+                         {'foo@example.com': 2, 'acme': 1})
+        # no more counting, the reservations are added up
+        self._queue()
+        scanned = usage.scanned
+        with self.assertRaises(QueueFullError) as exc:
+            limits.reserve(self.path, 'foo@example.com', 10)
+        self.assertEqual(exc.exception.reason, 'The queue holds 3 messages')
+        self.assertEqual(usage.scanned, scanned)
+
+    def test_max_bytes(self):
+        filename = self._queue()
+        size = os.path.getsize(filename)
+        limits = QueueQuota(max_bytes=size + 100)
+        limits.reserve(self.path, 'foo@example.com', 100)
+        with self.assertRaises(QueueFullError):
+            limits.reserve(self.path, 'foo@example.com', 1)
+
+    def test_tenant_limits(self):
+        self._queue(tenant='acme')
+        self._queue(fromaddr='bar@example.com')
+        limits = QueueQuota(max_tenant_messages=1)
+        with self.assertRaises(QueueFullError) as exc:
+            limits.reserve(self.path, 'acme', 10)
+        self.assertEqual(exc.exception.reason,
+                         'The queue holds 1 messages of acme')
+        with self.assertRaises(QueueFullError):
+            limits.reserve(self.path, 'bar@example.com', 10)
+        limits.reserve(self.path, 'foo@example.com', 10)
+        limits = QueueQuota(max_tenant_bytes=1000)
+        limits.reserve(self.path, 'acme', 500)
+        with self.assertRaises(QueueFullError):
+            limits.reserve(self.path, 'acme', 500)
+
+    def test_min_free_bytes(self):
+        free = shutil.disk_usage(self.path).free
+        QueueQuota(min_free_bytes=0).reserve(self.path, 'foo', 10)
+        with self.assertRaises(QueueFullError) as exc:
+            QueueQuota(min_free_bytes=free * 2).reserve(self.path, 'foo', 10)
+        self.assertTrue(
+            exc.exception.reason.endswith('bytes are free on disk'))
+
+    def test_release(self):
+        limits = QueueQuota(max_messages=1)
+        limits.reserve(self.path, 'foo', 10)
+        limits.release(self.path, 'foo', 10)
+        limits.reserve(self.path, 'foo', 10)
+        usage = quota._usage(self.path)
+        self.assertEqual((usage.messages, usage.bytes), (1, 10))
+
+    def test_removed_unknown_queue(self):
+        quota.removed(self.path, 'foo', 10)
+        quota.removed(None, 'foo', 10)
+        self.assertIsNone(quota._usage(self.path, create=False))
+
+    def test_block_until_removed(self):
+        limits = QueueQuota(max_messages=1, timeout=10)
+        limits.reserve(self.path, 'foo', 10)
+        timer = threading.Timer(0.05, quota.removed,
+                                (self.path, 'foo', 10))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        start = time.monotonic()
+        limits.reserve(self.path, 'foo', 10)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_block_timeout(self):
+        limits = QueueQuota(max_messages=1, timeout=0.05)
+        limits.reserve(self.path, 'foo', 10)
+        start = time.monotonic()
+        with self.assertRaises(QueueFullError):
+            limits.reserve(self.path, 'foo', 10)
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+    def test_recount_when_full(self):
+        # messages sent by another process are noticed when the queue
+        # seems to be full
+        filename = self._queue()
+        limits = QueueQuota(max_messages=1)
+        with self.assertRaises(QueueFullError):
+            limits.reserve(self.path, 'foo', 10)
+        os.unlink(filename)
+        with self.assertRaises(QueueFullError):
+            limits.reserve(self.path, 'foo', 10)
+        limits.rescan_interval = 0
+        limits.reserve(self.path, 'foo', 10)
+
+    def test_recount_keeps_reservations(self):
+        # messages that have room reserved are not in the queue yet
+        limits = QueueQuota(max_messages=1, rescan_interval=0)
+        limits.reserve(self.path, 'foo', 10)
+        with self.assertRaises(QueueFullError):
+            limits.reserve(self.path, 'foo', 10)
+        # once committed, the message is counted in the queue instead
+        self._queue(fromaddr='foo')
+        limits.commit(self.path, 'foo', 10)
+        with self.assertRaises(QueueFullError):
+            limits.reserve(self.path, 'foo', 10)
+        usage = quota._usage(self.path)
+        self.assertEqual(usage.messages, 1)
+        self.assertEqual(usage.reserved.messages, 0)
+
+    def test_count_without_lock(self):
+        limits = QueueQuota(max_messages=1, rescan_interval=0)
+        limits.reserve(self.path, 'foo', 10)
+        usage = quota._usage(self.path)
+        count = usage._count
+        committed = []
+
+        def counting():
+            # deliveries are not held up while the queue is counted
+            thread = threading.Thread(target=limits.commit,
+                                      args=(self.path, 'foo', 10))
+            thread.start()
+            thread.join(5)
+            committed.append(not thread.is_alive())
+            return count()
+
+        usage._count = counting
+        with self.assertRaises(QueueFullError):
+            limits.reserve(self.path, 'bar', 10)
+        self.assertEqual(committed, [True])
+        # the message committed meanwhile was not seen, but is counted
+        self.assertEqual(usage.group_messages, {'foo': 1})
+        self.assertEqual(usage.reserved.messages, 0)
+
+    def _slowCount(self):
+        usage = quota._usage(self.path)
+        count = usage._count
+        counts = []
+        done = threading.Event()
+        self.addCleanup(done.set)
+
+        def counting():
+            counts.append(threading.current_thread())
+            done.wait(10)
+            return count()
+
+        usage._count = counting
+        return usage, counts, done
+
+    def test_prepare(self):
+        self._queue()
+        usage, counts, done = self._slowCount()
+        limits = QueueQuota(max_messages=2)
+        limits.prepare(self.path)
+        done.set()
+        usage.thread.join(5)
+        self.assertEqual(usage.messages, 1)
+        # not counted in the thread of the delivery
+        self.assertEqual(counts, [usage.thread])
+        limits.reserve(self.path, 'foo', 10)
+        self.assertEqual(len(counts), 1)
+
+    def test_wait_for_count_with_timeout(self):
+        usage, counts, done = self._slowCount()
+        limits = QueueQuota(max_messages=1, timeout=0.05)
+        with self.assertRaises(QueueFullError) as exc:
+            limits.reserve(self.path, 'foo', 10)
+        self.assertEqual(exc.exception.reason, 'The queue is being counted')
+        # callers wait for the count in progress instead of counting
+        with self.assertRaises(QueueFullError):
+            limits.reserve(self.path, 'foo', 10)
+        self.assertEqual(counts, [usage.thread])
+        done.set()
+        limits.reserve(self.path, 'foo', 10)
+        self.assertEqual(len(counts), 1)
+
+    def test_recount_with_timeout(self):
+        filename = self._queue()
+        limits = QueueQuota(max_messages=1, timeout=0.05, rescan_interval=0)
+        with self.assertRaises(QueueFullError):
+            limits.reserve(self.path, 'foo', 10)
+        usage, counts, done = self._slowCount()
+        os.unlink(filename)
+        start = time.monotonic()
+        with self.assertRaises(QueueFullError):
+            limits.reserve(self.path, 'foo', 10)
+        self.assertLess(time.monotonic() - start, 5)
+        done.set()
+        usage.thread.join(5)
+        limits.reserve(self.path, 'foo', 10)
+        self.assertEqual(len(counts), 1)
+
+    def test_count_fails(self):
+        usage = quota._usage(self.path)
+
+        def failing():
+            raise PermissionError('not allowed')
+
+        usage._count = failing
+        limits = QueueQuota(max_messages=1)
+        with self.assertRaises(PermissionError):
+            limits.reserve(self.path, 'foo', 10)
+        del usage._count
+        limits.reserve(self.path, 'foo', 10)
+
+
+class TestQueuedMailDeliveryQuota(unittest.TestCase):
+
+    setUp = TestQueueQuota.setUp
+
+    def _send(self, delivery, **options):
+        delivery.send('jim@example.com', ('guido@example.com',),
+                      b'Subject: news\n\nWhat is new\n', **options)
+
+    def test_send(self):
+        delivery = QueuedMailDelivery(self.path, quota=QueueQuota(
+            max_messages=1))
+        self._send(delivery)
+        # refused before the transaction is committed
+        with self.assertRaises(QueueFullError):
+            self._send(delivery)
+        transaction.commit()
+        self.assertEqual(len(list(self.maildir)), 1)
+        usage = quota._usage(self.path)
+        self.assertEqual(usage.bytes,
+                         os.path.getsize(next(iter(self.maildir))))
+        self.assertEqual(usage.reserved.messages, 0)
+
+    def test_abort_gives_room_back(self):
+        delivery = QueuedMailDelivery(self.path, quota=QueueQuota(
+            max_tenant_messages=1))
+        self._send(delivery, tenant='acme')
+        transaction.abort()
+        self._send(delivery, tenant='acme')
+        self._send(delivery, tenant='other')
+        transaction.commit()
+        self.assertEqual(quota._usage(self.path).group_messages,
+                         {'acme': 1, 'other': 1})
+
+    def test_sent_messages_give_room_back(self):
+        delivery = QueuedMailDelivery(self.path, quota=QueueQuota(
+            max_messages=1))
+        self._send(delivery, ttl=3600)
+        transaction.commit()
+        thread = QueueProcessorThread()
+        thread.setMaildir(self.maildir)
+        thread.setMailer(MailerStub())
+        thread.log = LoggerStub()
+        thread.run(forever=False)
+        usage = quota._usage(self.path)
+        self.assertEqual((usage.messages, usage.bytes), (0, 0))
+        self._send(delivery)
+        transaction.commit()
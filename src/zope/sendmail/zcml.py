@@ -18,10 +18,14 @@ __docformat__ = 'restructuredtext'
 from zope.component import getUtility
 from zope.component.zcml import handler
 from zope.configuration.exceptions import ConfigurationError
+from zope.configuration.fields import GlobalObject
 from zope.configuration.fields import Path
+from zope.configuration.fields import Tokens
 from zope.interface import Interface
 from zope.schema import ASCIILine
 from zope.schema import Bool
+from zope.schema import Choice
+from zope.schema import Float
 from zope.schema import Int
 from zope.schema import TextLine
 
@@ -29,8 +33,17 @@ from zope.sendmail.delivery import DirectMailDelivery
 from zope.sendmail.delivery import QueuedMailDelivery
 from zope.sendmail.interfaces import IMailDelivery
 from zope.sendmail.interfaces import IMailer
+from zope.sendmail.mailer import ENVELOPE_FORMATS
+from zope.sendmail.mailer import BalancingMailer
+from zope.sendmail.mailer import HTTPMailer
+from zope.sendmail.mailer import LMTPMailer
+from zope.sendmail.mailer import PickupDirectoryMailer
+from zope.sendmail.mailer import Route
+from zope.sendmail.mailer import RoutingMailer
+from zope.sendmail.mailer import SendmailMailer
 from zope.sendmail.mailer import SMTPMailer
 from zope.sendmail.queue import QueueProcessorThread
+from zope.sendmail.quota import QueueQuota
 
 
 try:
@@ -89,6 +102,159 @@ class IQueuedDeliveryDirective(IDeliveryDirective):
         required=False,
         default=True)
 
+    ttl = Int(
+        title="Time To Live",
+        description=("Number of seconds after which queued messages are "
+                     "no longer sent, unless a different time is given "
+                     "when sending them.  By default they never expire."),
+        required=False)
+
+    maxMessages = Int(
+        title="Maximum Messages",
+        description="The number of messages the queue may hold.",
+        required=False)
+
+    maxBytes = Int(
+        title="Maximum Bytes",
+        description="The size of the messages the queue may hold.",
+        required=False)
+
+    maxTenantMessages = Int(
+        title="Maximum Messages per Tenant",
+        description=("The number of messages of one tenant (or sender) "
+                     "the queue may hold."),
+        required=False)
+
+    maxTenantBytes = Int(
+        title="Maximum Bytes per Tenant",
+        description=("The size of the messages of one tenant (or sender) "
+                     "the queue may hold."),
+        required=False)
+
+    minFreeBytes = Int(
+        title="Minimum Free Bytes",
+        description=("The disk space that must be left free when a "
+                     "message was queued."),
+        required=False)
+
+    quotaTimeout = Float(
+        title="Quota Timeout",
+        description=("Seconds to wait for space in a full queue before "
+                     "sending fails.  By default it fails right away."),
+        required=False)
+
+    interval = Float(
+        title="Interval",
+        description=("Seconds between the passes of the queue processor "
+                     "over the queue."),
+        required=False,
+        default=3.0)
+
+    maxInterval = Float(
+        title="Maximum Interval",
+        description=("When the queue stays empty, check it less and less "
+                     "often, up to every this many seconds.  In between, "
+                     "new messages are looked for every interval seconds "
+                     "by checking the modification times of the queue "
+                     "folders."),
+        required=False)
+
+    minConcurrency = Int(
+        title="Minimum Concurrency",
+        description="The lowest number of messages sent at the same time.",
+        required=False,
+        default=1)
+
+    maxConcurrency = Int(
+        title="Maximum Concurrency",
+        description=("Send up to this many messages at the same time.  The "
+                     "number is raised step by step while the mail server "
+                     "keeps up and halved when it throttles the queue "
+                     "processor.  The mailer must be safe to use from "
+                     "several threads."),
+        required=False,
+        default=1)
+
+    latencyTarget = Float(
+        title="Latency Target",
+        description=("Also send fewer messages at the same time when "
+                     "sending one takes longer than this many seconds."),
+        required=False)
+
+    largeMessageSize = Int(
+        title="Large Message Size",
+        description=("Messages of at least this many bytes are sent by "
+                     "worker threads of their own, so that they do not "
+                     "hold up the small messages behind them."),
+        required=False)
+
+    largeConcurrency = Int(
+        title="Large Message Concurrency",
+        description="The number of large messages sent at the same time.",
+        required=False,
+        default=1)
+
+    fairScheduling = Bool(
+        title="Fair Scheduling",
+        description=("Group the queued messages by tenant (or sender) and "
+                     "take turns between the groups, so that one of them "
+                     "cannot hold up the others."),
+        required=False,
+        default=False)
+
+    fairQuantum = Int(
+        title="Fair Quantum",
+        description=("With fair scheduling, the number of bytes a group "
+                     "may send per turn."),
+        required=False,
+        default=65536)
+
+    tenantMaxInFlight = Int(
+        title="Maximum Messages In Flight per Tenant",
+        description=("With fair scheduling, the number of messages of one "
+                     "group sent at the same time."),
+        required=False)
+
+    mergeWindow = Int(
+        title="Merge Window",
+        description=("Look for messages with the same sender and body "
+                     "among this many queued messages, and send them in "
+                     "one transaction."),
+        required=False)
+
+    mergeMaxRecipients = Int(
+        title="Maximum Recipients of Merged Messages",
+        description=("The number of recipients of merged messages sent in "
+                     "one transaction."),
+        required=False,
+        default=100)
+
+    digestWindow = Float(
+        title="Digest Window",
+        description=("Hold messages queued with a digest key back for this "
+                     "many seconds, counted from the first message of the "
+                     "digest, and send them together."),
+        required=False)
+
+    digestCombiner = GlobalObject(
+        title="Digest Combiner",
+        description=("The function that puts the messages of a digest "
+                     "together.  zope.sendmail.digest.combine by default."),
+        required=False)
+
+    digestMaxMessages = Int(
+        title="Maximum Messages per Digest",
+        description="The number of messages sent in one digest.",
+        required=False,
+        default=100)
+
+    reservedPriority = Int(
+        title="Reserved Priority",
+        description=("If given, start another queue processor thread that "
+                     "only sends messages with at least this priority, so "
+                     "that urgent mail is not held up by bulk mail."),
+        required=False)
+
 
 def _get_mailer(mailer):
     try:
@@ -98,10 +264,43 @@ def _get_mailer(mailer):
 
 
 def queuedDelivery(_context, queuePath, mailer, permission=None, name="Mail",
-                   processorThread=True):
+                   processorThread=True, reservedPriority=None, ttl=None,
+                   interval=3.0, maxInterval=None, minConcurrency=1,
+                   maxConcurrency=1, latencyTarget=None,
+                   largeMessageSize=None, largeConcurrency=1,
+                   fairScheduling=False, fairQuantum=65536,
+                   tenantMaxInFlight=None, maxMessages=None, maxBytes=None,
+                   maxTenantMessages=None, maxTenantBytes=None,
+                   minFreeBytes=None, quotaTimeout=None, mergeWindow=None,
+                   mergeMaxRecipients=100, digestWindow=None,
+                   digestCombiner=None, digestMaxMessages=100):
+
+    def startThread(thread, mailerObject):
+        thread.min_concurrency = minConcurrency
+        thread.max_concurrency = maxConcurrency
+        thread.latency_target = latencyTarget
+        thread.large_message_size = largeMessageSize
+        thread.large_concurrency = largeConcurrency
+        thread.fair_scheduling = fairScheduling
+        thread.fair_quantum = fairQuantum
+        thread.tenant_max_in_flight = tenantMaxInFlight
+        thread.merge_window = mergeWindow
+        thread.merge_max_recipients = mergeMaxRecipients
+        thread.digest_combiner = digestCombiner
+        thread.digest_max_messages = digestMaxMessages
+        thread.setMailer(mailerObject)
+        thread.setQueuePath(queuePath)
+        thread.start()
 
     def createQueuedDelivery():
-        delivery = QueuedMailDelivery(queuePath)
+        quota = None
+        if (maxMessages, maxBytes, maxTenantMessages, maxTenantBytes,
+                minFreeBytes) != (None,) * 5:
+            quota = QueueQuota(maxMessages, maxBytes, maxTenantMessages,
+                               maxTenantBytes, minFreeBytes, quotaTimeout)
+            # counted while the server starts
+            quota.prepare(queuePath)
+        delivery = QueuedMailDelivery(queuePath, ttl, quota, digestWindow)
         if permission is not None:
             delivery = _assertPermission(permission, IMailDelivery, delivery)
 
@@ -110,10 +309,15 @@ def queuedDelivery(_context, queuePath, mailer, permission=None, name="Mail",
         mailerObject = _get_mailer(mailer)
 
         if processorThread:
-            thread = QueueProcessorThread()
-            thread.setMailer(mailerObject)
-            thread.setQueuePath(queuePath)
-            thread.start()
+            startThread(
+                QueueProcessorThread(interval, max_interval=maxInterval),
+                mailerObject)
+
+            if reservedPriority is not None:
+                startThread(
+                    QueueProcessorThread(interval, reservedPriority,
+                                         maxInterval),
+                    mailerObject)
 
     _context.action(
         discriminator=('utility', IMailDelivery, name),
@@ -183,13 +387,452 @@ class ISMTPMailerDirective(IMailerDirective):
         required=False,
         default=False)
 
+    poolSize = Int(
+        title="Connection Pool Size",
+        description=("Keep up to this many connections to the SMTP server "
+                     "open for reuse, and never open more than this many at "
+                     "the same time.  By default connections are not "
+                     "reused."),
+        required=False)
+
+    poolIdleTimeout = Float(
+        title="Connection Pool Idle Timeout",
+        description=("Close pooled connections that were not used for this "
+                     "many seconds."),
+        required=False)
+
+    poolMaxMessages = Int(
+        title="Messages per Pooled Connection",
+        description="Close pooled connections after this many messages.",
+        required=False)
+
+    poolTimeout = Float(
+        title="Connection Pool Timeout",
+        description=("Seconds to wait for a pooled connection when all of "
+                     "them are in use.  Waits as long as it takes by "
+                     "default."),
+        required=False)
+
+    connectTimeout = Float(
+        title="Connect Timeout",
+        description="Seconds to wait for the connection to the server.",
+        required=False)
+
+    commandTimeout = Float(
+        title="Command Timeout",
+        description="Seconds to wait for the server to answer a command.",
+        required=False)
+
+    sendTimeout = Float(
+        title="Send Timeout",
+        description="Seconds sending a single message may take in total.",
+        required=False)
+
+    tlsCAFile = Path(
+        title="TLS CA File",
+        description=("File with the certificates of the authorities that "
+                     "may sign the certificate of the SMTP server."),
+        required=False)
+
+    tlsVerify = Bool(
+        title="Verify TLS",
+        description=("Check the certificate and host name of the SMTP "
+                     "server.  Not enabled by default."),
+        required=False,
+        default=False)
+
+    tlsMinimumVersion = Choice(
+        title="Minimum TLS Version",
+        description="The oldest TLS version to accept.",
+        values=("TLSv1", "TLSv1_1", "TLSv1_2", "TLSv1_3"),
+        required=False)
+
+    dnsCacheTTL = Float(
+        title="DNS Cache TTL",
+        description=("Remember the addresses of the SMTP server for this "
+                     "many seconds, use them in turn and fail over to the "
+                     "next one when a connection fails."),
+        required=False)
+
+    maxRecipients = Int(
+        title="Maximum Recipients",
+        description=("Send a message to at most this many recipients per "
+                     "transaction, in several transactions over the same "
+                     "connection.  Unlimited by default."),
+        required=False,
+        min=1)
+
 
 def smtpMailer(_context, name, hostname="localhost", port="25",
-               username=None, password=None, implicit_tls=False):
+               username=None, password=None, implicit_tls=False,
+               poolSize=None, poolIdleTimeout=None, poolMaxMessages=None,
+               connectTimeout=None, commandTimeout=None, sendTimeout=None,
+               tlsCAFile=None, tlsVerify=False, tlsMinimumVersion=None,
+               dnsCacheTTL=None, maxRecipients=None, poolTimeout=None):
+    _context.action(
+        discriminator=('utility', IMailer, name),
+        callable=handler,
+        args=('registerUtility',
+              SMTPMailer(hostname, port, username, password,
+                         implicit_tls=implicit_tls,
+                         pool_size=poolSize,
+                         pool_idle_timeout=poolIdleTimeout,
+                         pool_max_messages=poolMaxMessages,
+                         connect_timeout=connectTimeout,
+                         command_timeout=commandTimeout,
+                         send_timeout=sendTimeout,
+                         tls_ca_file=tlsCAFile,
+                         tls_verify=tlsVerify,
+                         tls_minimum_version=tlsMinimumVersion,
+                         dns_cache_ttl=dnsCacheTTL,
+                         max_recipients=maxRecipients,
+                         pool_timeout=poolTimeout),
+              IMailer, name)
+    )
+
+
+class ILMTPMailerDirective(IMailerDirective):
+    """Registers a mailer handing mail to a local MTA over a UNIX socket."""
+
+    path = Path(
+        title="Socket Path",
+        description="Path of the UNIX domain socket of the MTA.",
+        required=True)
+
+    lmtp = Bool(
+        title="LMTP",
+        description="Speak LMTP, or SMTP if this is false.",
+        required=False,
+        default=True)
+
+    username = TextLine(
+        title="Username",
+        description="A username for authentication.",
+        required=False)
+
+    password = TextLine(
+        title="Password",
+        description="A password for authentication.",
+        required=False)
+
+    poolSize = Int(
+        title="Sessions",
+        description="How many sessions with the MTA to keep open at most.",
+        required=False,
+        default=1)
+
+    poolIdleTimeout = Float(
+        title="Session Idle Timeout",
+        description="Close sessions that were not used for this many "
+                    "seconds.",
+        required=False)
+
+    poolTimeout = Float(
+        title="Session Timeout",
+        description="Seconds to wait for a session when all of them are in "
+                    "use.  Waits as long as it takes by default.",
+        required=False)
+
+    commandTimeout = Float(
+        title="Command Timeout",
+        description="Seconds to wait for the MTA to answer a command.",
+        required=False)
+
+    sendTimeout = Float(
+        title="Send Timeout",
+        description="Seconds handing over a single message may take.",
+        required=False)
+
+
+def lmtpMailer(_context, name, path, lmtp=True, username=None,
+               password=None, poolSize=1, poolIdleTimeout=None,
+               commandTimeout=None, sendTimeout=None, poolTimeout=None):
+    _context.action(
+        discriminator=('utility', IMailer, name),
+        callable=handler,
+        args=('registerUtility',
+              LMTPMailer(path, lmtp, username, password,
+                         pool_size=poolSize,
+                         pool_idle_timeout=poolIdleTimeout,
+                         pool_timeout=poolTimeout,
+                         command_timeout=commandTimeout,
+                         send_timeout=sendTimeout),
+              IMailer, name)
+    )
+
+
+class ISendmailMailerDirective(IMailerDirective):
+    """Registers a mailer talking to a long running ``sendmail -bs``."""
+
+    command = Path(
+        title="Command",
+        description="Path of the sendmail program.",
+        required=False,
+        default="/usr/sbin/sendmail")
+
+    poolSize = Int(
+        title="Processes",
+        description="How many sendmail processes to run at most.",
+        required=False,
+        default=1)
+
+    poolIdleTimeout = Float(
+        title="Process Idle Timeout",
+        description="Stop processes that were not used for this many "
+                    "seconds.",
+        required=False)
+
+    poolMaxMessages = Int(
+        title="Messages per Process",
+        description="Start a new process after this many messages.",
+        required=False)
+
+    poolTimeout = Float(
+        title="Process Timeout",
+        description="Seconds to wait for a process when all of them are in "
+                    "use.  Waits as long as it takes by default.",
+        required=False)
+
+    sendTimeout = Float(
+        title="Send Timeout",
+        description="Seconds handing over a single message may take.",
+        required=False)
+
+
+def sendmailMailer(_context, name, command="/usr/sbin/sendmail", poolSize=1,
+                   poolIdleTimeout=None, poolMaxMessages=None,
+                   sendTimeout=None, poolTimeout=None):
+    _context.action(
+        discriminator=('utility', IMailer, name),
+        callable=handler,
+        args=('registerUtility',
+              SendmailMailer(command,
+                             pool_size=poolSize,
+                             pool_idle_timeout=poolIdleTimeout,
+                             pool_max_messages=poolMaxMessages,
+                             pool_timeout=poolTimeout,
+                             send_timeout=sendTimeout),
+              IMailer, name)
+    )
+
+
+class IPickupDirectoryMailerDirective(IMailerDirective):
+    """Registers a mailer dropping messages into a pickup directory."""
+
+    path = Path(
+        title="Path",
+        description="The pickup directory of the MTA.",
+        required=True)
+
+    envelope = Choice(
+        title="Envelope Format",
+        description=("How the sender and the recipients are written before "
+                     "the message: 'none', 'x-sender' (X-Sender and "
+                     "X-Receiver lines) or 'zope' (X-Zope-From and "
+                     "X-Zope-To lines)."),
+        values=sorted(ENVELOPE_FORMATS),
+        required=False,
+        default='none')
+
+    batchSize = Int(
+        title="Batch Size",
+        description=("How many messages the queue processor writes at once, "
+                     "syncing the directory only once."),
+        required=False,
+        default=100)
+
+    fsync = Bool(
+        title="Fsync",
+        description="Make the messages durable before going on.",
+        required=False,
+        default=True)
+
+
+def pickupDirectoryMailer(_context, name, path, envelope='none',
+                          batchSize=100, fsync=True):
+    _context.action(
+        discriminator=('utility', IMailer, name),
+        callable=handler,
+        args=('registerUtility',
+              PickupDirectoryMailer(path, envelope, batchSize, fsync),
+              IMailer, name)
+    )
+
+
+class IHTTPMailerDirective(IMailerDirective):
+    """Registers a mailer submitting messages to an HTTP mail API."""
+
+    url = TextLine(
+        title="URL",
+        description="The URL to post single messages to.",
+        required=True)
+
+    batchUrl = TextLine(
+        title="Batch URL",
+        description="The URL to post several messages to at once.",
+        required=False)
+
+    apiKey = TextLine(
+        title="API Key",
+        description="Sent as bearer token in the Authorization header.",
+        required=False)
+
+    timeout = Float(
+        title="Timeout",
+        description="Seconds to wait for connecting and for an answer.",
+        required=False)
+
+    batchSize = Int(
+        title="Batch Size",
+        description="How many messages to post at once at most.",
+        required=False,
+        default=100)
+
+    poolSize = Int(
+        title="Idle Connections",
+        description="How many idle connections to keep open at most.",
+        required=False,
+        default=2)
+
+    poolIdleTimeout = Float(
+        title="Connection Idle Timeout",
+        description="Close connections that were not used for this many "
+                    "seconds.",
+        required=False)
+
+
+def httpMailer(_context, name, url, batchUrl=None, apiKey=None, timeout=None,
+               batchSize=100, poolSize=2, poolIdleTimeout=None):
     _context.action(
         discriminator=('utility', IMailer, name),
         callable=handler,
         args=('registerUtility',
-              SMTPMailer(hostname, port, username, password, implicit_tls),
+              HTTPMailer(url,
+                         batch_url=batchUrl,
+                         api_key=apiKey,
+                         timeout=timeout,
+                         batch_size=batchSize,
+                         pool_size=poolSize,
+                         pool_idle_timeout=poolIdleTimeout),
               IMailer, name)
     )
+
+
+class IBalancingMailerDirective(IMailerDirective):
+    """Registers a mailer spreading the messages over other mailers."""
+
+    mailers = Tokens(
+        title="Mailers",
+        description="Names of the mailers to use, separated by spaces.",
+        value_type=TextLine(),
+        required=True)
+
+    weights = Tokens(
+        title="Weights",
+        description="Weights of the mailers, separated by spaces.",
+        value_type=Int(min=1),
+        required=False)
+
+    strategy = Choice(
+        title="Strategy",
+        description="How to choose a mailer.",
+        values=BalancingMailer.STRATEGIES,
+        required=False,
+        default='round-robin')
+
+    maxFailures = Int(
+        title="Maximum Failures",
+        description=("Take a mailer out of rotation after this many "
+                     "consecutive failures."),
+        required=False,
+        default=3)
+
+    slowThreshold = Float(
+        title="Slow Threshold",
+        description="Count sends taking longer than this many seconds as "
+                    "failures.",
+        required=False)
+
+    retryAfter = Float(
+        title="Retry After",
+        description="Seconds before a mailer out of rotation is probed.",
+        required=False,
+        default=30.0)
+
+
+def balancingMailer(_context, name, mailers, weights=None,
+                    strategy='round-robin', maxFailures=3, slowThreshold=None,
+                    retryAfter=30.0):
+
+    def createBalancingMailer():
+        mailer = BalancingMailer([_get_mailer(m) for m in mailers],
+                                 weights=weights,
+                                 strategy=strategy,
+                                 max_failures=maxFailures,
+                                 slow_threshold=slowThreshold,
+                                 retry_after=retryAfter)
+        handler('registerUtility', mailer, IMailer, name)
+
+    _context.action(
+        discriminator=('utility', IMailer, name),
+        callable=createBalancingMailer,
+        args=())
+
+
+class IRoutingMailerDirective(IMailerDirective):
+    """Registers a mailer handing the messages to other mailers by route.
+
+    The routes are given by ``route`` subdirectives, which are tried in
+    order.
+    """
+
+    default = TextLine(
+        title="Default Mailer",
+        description="Name of the mailer for recipients matching no route.",
+        required=False)
+
+
+class IRouteSubdirective(Interface):
+    """A route of a routing mailer; all given conditions must hold."""
+
+    mailer = TextLine(
+        title="Mailer",
+        description="Name of the mailer sending the matching mail.",
+        required=True)
+
+    domain = TextLine(
+        title="Recipient Domain",
+        description="The domain of the recipient, or a parent domain.",
+        required=False)
+
+    sender = TextLine(
+        title="Sender",
+        description=("The sender address, or @domain for any sender in "
+                     "the domain."),
+        required=False)
+
+    key = TextLine(
+        title="Routing Key",
+        description="The route given when the message was queued.",
+        required=False)
+
+
+class RoutingMailerDirective:
+
+    def __init__(self, _context, name, default=None):
+        self._context = _context
+        self.name = name
+        self.default = default
+        self.routes = []
+
+    def route(self, _context, mailer, domain=None, sender=None, key=None):
+        self.routes.append(Route(mailer, domain, sender, key))
+
+    def __call__(self):
+        self._context.action(
+            discriminator=('utility', IMailer, self.name),
+            callable=handler,
+            args=('registerUtility',
+                  RoutingMailer(self.routes, self.default),
+                  IMailer, self.name)
+        )